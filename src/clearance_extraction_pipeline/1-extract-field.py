@@ -27,9 +27,49 @@
 import os
 import csv
 import sys
-import shutil
 from datetime import datetime
 
+import numpy as np
+import pandas as pd
+
+import cohortcube
+import pipelinepool
+import pipelinemanifest
+
+
+#-------------------------------------------------------
+# Projected reader for the raw clearance exports
+#
+# Reads the data records (the header lines must already
+# have been consumed) from the open file `csvfile' in a
+# single pass, converting only the region name column
+# `regionndx' and the value columns `valndxs'.  Returns the
+# list of region names and a (regions x len(valndxs))
+# float64 array.  Empty values are returned as NaN.  If a
+# region appears more than once the last record is kept.
+#-------------------------------------------------------
+def readProjectedColumns(csvfile, regionndx, valndxs):
+    usecols = [regionndx] + list(valndxs)
+
+    frame = pd.read_csv(csvfile, header=None, usecols=usecols,
+                        dtype={regionndx: str}, keep_default_na=False, na_values={c: [''] for c in valndxs},
+                        float_precision='round_trip')
+
+    names = frame[regionndx].tolist()
+    values = frame[list(valndxs)].to_numpy(dtype=np.float64)
+
+    # keep the last record of a repeated region (at the position
+    # of its first appearance)
+    rowof = {}
+    for row in range(len(names)):
+        rowof[names[row]] = row
+
+    if len(rowof) != len(names):
+        names = list(rowof.keys())
+        values = values[list(rowof.values())]
+
+    return names, values
+
 
 #-------------------------------------------------------
 # Class for manipulating patient data
@@ -42,7 +82,9 @@ class patient:
     # construct a patient using an (integer) ID
     # and a path to a csv file for this patient.
     # [optional] datafield: the data field you want to extract for this patient into the
-    #                       reformatted file.  (Default = 'Mean')
+    #                       reformatted file.  (Default = 'Median')  A list of fields
+    #                       (e.g. ['Median', 'Mean', 'StdDev', 'NVoxels']) extracts
+    #                       all of them in a single pass over the raw file.
     # [optional] timepointstr: this field indicates the search
     #               string corresponding to a data point.  Extraction
     #               occurs based on finding fields that contain this
@@ -54,16 +96,27 @@ class patient:
         self.records = {}
         self.timepointid = timepointstr
 
-        self.extractval = datafield
+        if isinstance(datafield, str):
+            datafield = [datafield]
+
+        # the extracted fields; the first one is the primary field
+        self.extractfields = list(datafield)
+        self.extractval = self.extractfields[0]
 
         self.normalized = False
 
-        self.valndxs = []
+        # column indices of every extracted field
+        self.valndxs = {fld: [] for fld in self.extractfields}
         self.timevals = []
 
         self.regionndx = -1
 
-        self.data = {}
+        # region names and the (fields x regions x times) array of
+        # the extracted data, i.e. self.data[f, r, t] is the value of
+        # field self.extractfields[f] in region self.regions[r] at
+        # time self.timevals[t]
+        self.regions = []
+        self.data = np.empty((len(self.extractfields), 0, 0), dtype=np.float64)
 
         # read in the patient data from the indicated CSV file
         self.__readdata()
@@ -106,8 +159,8 @@ class patient:
 
                 timen += 1
 
-    # this function extracts the row indices for the datafield specified
-    #   by self.extractval.  It is assumed that each patient file format
+    # this function extracts the row indices for the datafields specified
+    #   by self.extractfields.  It is assumed that each patient file format
     #   has the same set of value indices for each time (for instance,
     #   each time has an associated data field called 'Mean', 'Median', 'StdDev', etc)
     def __extractValueIndices(self, header, regionName='StructName'):
@@ -122,71 +175,72 @@ class patient:
             if(h == regionName):
                 self.regionndx = header.index(regionName)
             else:
-                if (h == self.extractval):
+                if (h in self.valndxs):
                     #thisndx = header.index(self.extractval, searchndx)
-                    self.valndxs.append(searchndx)
+                    self.valndxs[h].append(searchndx)
 
             searchndx += 1
 
-    # (Private) parse a data record according to the stored indices
-    def __parsedata(self, record):
-        # This line is assumed to have the following format
-        #  ... [Field name] .... [data value] ... [data value] ... [data value]
-        # where
-        # [Field name] is the anatomical region identifier (e.g. Left-Hippocampus, etc)
-        # ... represent intermediate data values (which we are not interested in)
-        # [data value] is the data corresponding to the index entries for the heading
-        #   of interest whose identifier is stored in self.extractval.  Examples include
-        #   'Mean', 'StdDev', 'Min', etc
-
-        if self.regionndx == -1:
-            print(f"[Error] Incorrect region index for patient {self.patid}.  Something went wrong")
-        else:
-            # create the data dictionary entry for this region
-            region = record[self.regionndx]
-
-            # extract the data field and the values
-            self.data[region] = []
-
-            for i in range(len(self.valndxs)):
-                idxat = self.valndxs[i]
-                self.data[region].append(record[idxat])
-
     # (Private) read in data from the raw csv file whose path is
-    #   contained in the internal field self.csvin
+    #   contained in the internal field self.csvin.
+    #
+    #   The two header lines are parsed once.  The records are then
+    #   read in a single projected pass that only converts the region
+    #   column and the columns of the requested data fields (as float64)
     def __readdata(self):
-        with open(self.csvin) as csvfile:
-            csv_reader = csv.reader(csvfile, delimiter=',')
-            line=0
-
-            for row in csv_reader:
-                if line==0:
-                    # If this is the header (first line) we populate the times
-                    # dictionary with the numeric time (in days since the first
-                    # measurement) as the keys and the indices of the column as
-                    # the values
-                    self.__populateTimesFromHeader(row)
-                elif line == 1:
-                    # This is the second line of the header.  This is where we
-                    # extract the field name index
-                    self.__extractValueIndices(row)
-                else:
-                    # These are all data records.  We read the values for this row
-                    # and populate the patient structure according to the desired ID.
-                    self.__parsedata(row)
-                line +=1
-
-    # writes the extracted patient data to a CSV file.
+        with open(self.csvin, newline='') as csvfile:
+            # If this is the header (first line) we populate the times
+            # dictionary with the numeric time (in days since the first
+            # measurement) as the keys and the indices of the column as
+            # the values
+            header = next(csv.reader([csvfile.readline()], delimiter=','), [])
+            self.__populateTimesFromHeader(header)
+
+            # This is the second line of the header.  This is where we
+            # extract the field name index
+            header = next(csv.reader([csvfile.readline()], delimiter=','), [])
+            self.__extractValueIndices(header)
+
+            if self.regionndx == -1:
+                print(f"[Error] Incorrect region index for patient {self.patid}.  Something went wrong")
+                return
+
+            # These are all data records.  Only the region name and the
+            # value columns (of all requested fields) are parsed.
+            allndxs = []
+            for fld in self.extractfields:
+                allndxs += self.valndxs[fld]
+
+            self.regions, values = readProjectedColumns(csvfile, self.regionndx, allndxs)
+
+            ntimes = len(self.timevals)
+            self.data = np.full((len(self.extractfields), len(self.regions), ntimes), np.nan)
+
+            offset = 0
+            for f in range(len(self.extractfields)):
+                ncols = len(self.valndxs[self.extractfields[f]])
+                if ncols != ntimes:
+                    print(f"[Error] Found {ncols} '{self.extractfields[f]}' columns for {ntimes} times for patient {self.patid}")
+                n = min(ncols, ntimes)
+                self.data[f, :, :n] = values[:, offset:offset + n]
+                offset += ncols
+
+    # writes the extracted patient data to a CSV file and returns its path.
     # dirout: the output directory (must end with a '/' such as '/home/user/output/')
-    def writedata(self, dirout):
+    # [optional] field: the extracted field to write (Default: the primary field)
+    def writedata(self, dirout, field=None):
 
         csvout = ""
 
+        if field is None:
+            field = self.extractval
+        fdata = self.getFieldData(field)
+
         if self.normalized:
-            #csvout = dirout + str(self.patid) + "-" + self.extractval + "-normalized.csv"
+            #csvout = dirout + str(self.patid) + "-" + field + "-normalized.csv"
             csvout = dirout + str(self.patid) +".csv"
         else:
-            csvout = dirout + str(self.patid) + "-" + self.extractval + ".csv"
+            csvout = dirout + str(self.patid) + "-" + field + ".csv"
 
         linecount = 0
         with open(csvout, mode='w') as outcsv:
@@ -198,14 +252,20 @@ class patient:
             data_writer.writerow(header)
 
             # write the data
-            for region in self.data:
+            for i in range(len(self.regions)):
                 # the data row should be: Region, data, data, data, .. , data
-                towrite = [region] + self.data[region]
+                towrite = [self.regions[i]] + fdata[i].tolist()
                 data_writer.writerow(towrite)
 
+        return csvout
+
     def getID(self):
         return self.patid
 
+    # the (regions x times) array of one extracted field
+    def getFieldData(self, field):
+        return self.data[self.extractfields.index(field)]
+
     # Normalize the data for this patient according to the values in `normalizedValues'
     # Note: a normalization object for this patient can be retrieved from a normalizer
     #   object using this patient's ID
@@ -224,10 +284,8 @@ class patient:
                 if keystr in normalizedValues:
                     nval =  float(normalizedValues[keystr])
 
-                    # Normalize the data in every region by the normalization value
-                    for region in self.data:
-                        rdat = self.data[region][i]
-                        self.data[region][i] = str(float(rdat) / 1)#nval)
+                    # Normalize the data of every field in every region by the normalization value
+                    self.data[:, :, i] = self.data[:, :, i] / 1#nval
                 else:
                     print(f"Missing expected key {keystr} in normalized values object")
                     allfound = False
@@ -314,30 +372,71 @@ patientinputdirectory = "./raw-data/clearance_data_excel/"
 outputroot = "./reformatted-data/"
 outputdirectory = outputroot + "1-extracted-mean/"
 
+# --..--..--..--.. Extracted Fields ..--..--..--..--
+# data fields extracted (in one pass) from every raw file.  The first
+# field is the one used by the rest of the pipeline and is written to
+# `outputdirectory'; every other field is written to its own
+# directory extrafieldsroot + "<field>/"
+datafields = ['Median']
+extrafieldsroot = outputroot + "1-extracted-fields/"
+
 # --..--..--..--.. Normalization Options ..--..--..--..--
 normalize = False
 normalizationcsv = "./raw-data/ref-ROI-values.csv"
 
 #--------------------------------------------------------------------------------------------------------------
 
-# Execution starts here
-if __name__ == "__main__":
+# output directory of every extracted field
+def fieldOutputDirectories():
+    fielddirs = {}
+    for i in range(len(datafields)):
+        if i == 0:
+            fielddirs[datafields[i]] = outputdirectory
+        else:
+            fielddirs[datafields[i]] = extrafieldsroot + datafields[i] + "/"
+    return fielddirs
 
-    if not os.path.exists(patientinputdirectory):
-        print(f"The relative (to this script) input directory {patientinputdirectory} does not exist")
-        sys.exit()
 
-    # clear any existing files and remake the target output directory
-    # you will need to re-run the full pipeline
-    if os.path.exists(outputroot):
-        shutil.rmtree(outputroot)
-    os.mkdir(outputroot)
-    os.mkdir(outputdirectory)
+# Read and normalize a single patient.  `task' is the tuple
+# (patient id, raw csv path, normalization values) where the
+# normalization values are None if none are available.
+def readPatient(task):
+    id, filepath, normvals = task
+
+    print(f"Processing file {filepath}")
+    p = patient(id, filepath, datafield=datafields)
+
+    if normvals is not None:
+        p.normalizePatientData(normvals)
+    else:
+        print(f"No normalization data is available for patient {id}")
+
+    return p
+
+
+# Read, normalize and write a single patient (see readPatient).
+# Returns the written files.
+def extractPatient(task):
+    p = readPatient(task)
+
+    outputs = []
+    fielddirs = fieldOutputDirectories()
+    for field in datafields:
+        outputs.append(p.writedata(fielddirs[field], field=field))
+
+    return outputs
+
+
+# List the raw patient files.  Returns the tasks (patient id,
+# raw csv path, normalization values) of readPatient in the
+# order in which the files are found.
+def findPatientTasks(normalizer):
+    normalizedIDs = normalizer.getPatientIDList()
 
     dirlevel = 0
-    patientList = []
+    tasks = []
 
-    # ----------- Read in and parse all subject files --------------------
+    # ----------- Find all subject files --------------------
     for rootdir, subjectdirs, files in os.walk(patientinputdirectory):
 
         totalsubj = len(files)
@@ -348,36 +447,60 @@ if __name__ == "__main__":
         if dirlevel == 1:
             for subj in files:
                 thissubj += 1
-                print(f"Processing file {subj}")
                 sidx = subj.find("-")
                 sid = subj[:sidx]
                 id = int(sid)
 
                 filepath = patientinputdirectory + subj
 
-                p = patient(id, filepath)
-                patientList.append(p)
+                normvals = None
+                if id in normalizedIDs:
+                    normvals = normalizer.getPatientNormalization(id)
 
-    if not os.path.exists(outputdirectory):
-        print(f"The relative (to this script) output directory {outputdirectory} does not exist")
-        sys.exit()
+                tasks.append((id, filepath, normvals))
 
+    return tasks
 
-    # --------------- Normalize patient data -------------- #
 
-    normalizer = normalization(normalizationcsv)
-    normalizedIDs = normalizer.getPatientIDList()
+# Execution starts here
+if __name__ == "__main__":
 
+    args = pipelinepool.parseStageArguments("Extract a data field from the raw clearance exports")
 
+    if not os.path.exists(patientinputdirectory):
+        print(f"The relative (to this script) input directory {patientinputdirectory} does not exist")
+        sys.exit()
 
+    if not os.path.exists(outputroot):
+        os.mkdir(outputroot)
 
+    # --------------- Normalization data -------------- #
 
-    # --------------- output all patients -------------------------------------
-    for p in patientList:
-        pid = p.getID()
-        if pid in normalizedIDs:
-            normvals = normalizer.getPatientNormalization(pid)
-            p.normalizePatientData(normvals)
-        else:
-            print(f"No normalization data is available for patient {pid}")
-        p.writedata(outputdirectory)
+    normalizer = normalization(normalizationcsv)
+    tasks = findPatientTasks(normalizer)
+
+    # ----------- Read, normalize and output all patients --------------------
+    if args.intermediate == 'cube':
+        # one cohort cube per extracted field
+        patientList = pipelinepool.mapPatients(readPatient, tasks, jobs=args.jobs)
+
+        fielddirs = fieldOutputDirectories()
+        for field in datafields:
+            records = [(p.getID(), p.regions, p.timevals, p.getFieldData(field)) for p in patientList]
+            cohortcube.buildCube(cohortcube.cubePath(fielddirs[field]), records)
+    else:
+        # only the patients whose raw file or normalization values
+        # changed since the last run are extracted again
+        m = pipelinemanifest.openStageManifest(pipelinemanifest.manifestPath(outputdirectory),
+                                               {'datafields': datafields},
+                                               fieldOutputDirectories().values(), force=args.force)
+
+        stale = pipelinemanifest.staleTasks(m, tasks, key=lambda t: os.path.basename(t[1]),
+                                            signature=lambda t: m.signature([t[1]], extra=t[2]))
+
+        results = pipelinepool.mapPatients(extractPatient, [t[0] for t in stale], jobs=args.jobs)
+        for (task, key, sig), outputs in zip(stale, results):
+            m.update(key, sig, outputs)
+
+        m.removeStale([os.path.basename(t[1]) for t in tasks])
+        m.write()
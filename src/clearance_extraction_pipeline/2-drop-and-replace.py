@@ -37,7 +37,10 @@
 import os
 import csv
 import sys
-import shutil
+
+import cohortcube
+import pipelinepool
+import pipelinemanifest
 
 
 def writeRenamedOnly(input, output, renamingList):
@@ -63,6 +66,16 @@ def writeRenamedOnly(input, output, renamingList):
                 line += 1
 
 
+# Cohort cube version of writeRenamedOnly: keep (and rename) the
+# regions that appear in the renaming list
+def writeRenamedCube(incube, outputpath, renamingList):
+    rows = [i for i in range(len(incube.regions)) if incube.regions[i] in renamingList]
+    newnames = [renamingList[incube.regions[i]] for i in rows]
+
+    cohortcube.writeCube(outputpath, incube.patients, newnames, incube.times, incube.values[:, rows, :],
+                         extras={'present': incube.getPresence()[:, rows]})
+
+
 # ------------------------------------------------------------------------------------------------------------
 #                                                Configuration
 # ------------------------------------------------------------------------------------------------------------
@@ -261,38 +274,64 @@ rename = {'Left-Thalamus-Proper': 'subcortical.Left-Thalamus-Proper.left',
           'ctx-rh-insula': 'cortical.insula.right'
           }
 
+# Drop and rename the fields of a single patient file.
+# `task' is the tuple (input csv, output csv)
+def renamePatient(task):
+    infile, outfile = task
+    print(f"Processing file {infile}")
+    writeRenamedOnly(infile, outfile, rename)
+    return outfile
+
+
 # Execution starts here
 if __name__ == "__main__":
 
-    if not os.path.exists(inputdirectory):
-        print(f"The relative (to this script) input directory {inputdirectory} does not exist")
-        sys.exit()
+    args = pipelinepool.parseStageArguments("Drop and rename anatomical fields in the extracted patient files")
+
+    if args.intermediate == 'cube':
+        incube = cohortcube.cubePath(inputdirectory)
+        if not os.path.exists(incube):
+            print(f"The relative (to this script) input cube {incube} does not exist")
+            sys.exit()
+
+        writeRenamedCube(cohortcube.cohortcube(incube), cohortcube.cubePath(outputdirectory), rename)
+    else:
+        if not os.path.exists(inputdirectory):
+            print(f"The relative (to this script) input directory {inputdirectory} does not exist")
+            sys.exit()
+
+        # the output directory is only cleared when the dropped or
+        # renamed fields changed (or with --force)
+        m = pipelinemanifest.openStageManifest(pipelinemanifest.manifestPath(outputdirectory),
+                                               {'droplist': droplist, 'rename': rename},
+                                               [outputdirectory], force=args.force)
+
+        dirlevel = 0
+        tasks = []
 
-    # clear any existing files and remake the target output directory
-    if os.path.exists(outputdirectory):
-        shutil.rmtree(outputdirectory)
-    os.mkdir(outputdirectory)
+        # ----------- Read in and parse all subject files --------------------
+        for rootdir, subjectdirs, files in os.walk(inputdirectory):
 
-    dirlevel = 0
+            totalsubj = len(files)
+            thissubj = 0
+            dirlevel += 1
 
-    # ----------- Read in and parse all subject files --------------------
-    for rootdir, subjectdirs, files in os.walk(inputdirectory):
+            # only process the top level subdirectories
+            if dirlevel == 1:
+                for subj in files:
+                    thissubj += 1
+                    infile = inputdirectory + subj
+                    outfile = outputdirectory + subj
+                    tasks.append((infile, outfile))
 
-        totalsubj = len(files)
-        thissubj = 0
-        dirlevel += 1
+        stale = pipelinemanifest.staleTasks(m, tasks, key=lambda t: os.path.basename(t[0]),
+                                            signature=lambda t: m.signature([t[0]]))
 
-        # only process the top level subdirectories
-        if dirlevel == 1:
-            for subj in files:
-                thissubj += 1
-                print(f"Processing file {subj}")
-                infile = inputdirectory + subj
-                outfile = outputdirectory + subj
-                writeRenamedOnly(infile, outfile, rename)
+        results = pipelinepool.mapPatients(renamePatient, [t[0] for t in stale], jobs=args.jobs)
+        for (task, key, sig), outfile in zip(stale, results):
+            m.update(key, sig, [outfile])
 
-    if not os.path.exists(outputdirectory):
-        print(f"The relative (to this script) output directory {outputdirectory} does not exist")
-        sys.exit()
+        m.removeStale([os.path.basename(t[0]) for t in tasks])
+        m.write()
 
 
@@ -32,7 +32,12 @@
 import os
 import csv
 import sys
-import shutil
+
+import numpy as np
+
+import cohortcube
+import pipelinepool
+import pipelinemanifest
 
 
 class patient:
@@ -58,7 +63,7 @@ class patient:
 
             # the first time slot is the timepoint between
             #   20 and 35 hours
-            if 20.0 <= timeh and timeh <= 35.0:
+            if firstwindowhours[0] <= timeh and timeh <= firstwindowhours[1]:
                 if self.btimes['first'] == True:
                     print(f"Found duplicate first time at {timed} ({timeh} hours)")
                 else:
@@ -66,7 +71,7 @@ class patient:
                     self.times['first'] = timed
                     self.btimes['first'] = True
 
-            if 35.0 < timeh and timeh <= 60.0:
+            if secondwindowhours[0] < timeh and timeh <= secondwindowhours[1]:
                 if self.btimes['second'] == True:
                     print(f"Found duplicate second time at {timed} ({timeh} hours)")
                 else:
@@ -75,7 +80,7 @@ class patient:
                     self.btimes['second'] = True
 
             # now we look for the ~1 month checkup
-            if 20.0 < timed and timed <= 50.0:
+            if thirdwindowdays[0] < timed and timed <= thirdwindowdays[1]:
                 if self.btimes['third'] == True:
                     print(f"Found duplicate third time at {timed}")
                 else:
@@ -94,6 +99,19 @@ class patient:
         return self.isValid
 
 
+    # Cohort cube version of importdata: select the three
+    # timepoints from the (unpadded) times of this patient.
+    # Returns the column indices of the first, second and
+    # third time or None if the patient is not valid.
+    def selectTimes(self, times):
+        header = ['StructName'] + [str(float(t)) for t in times]
+
+        if self.__checkTimes(header) == False:
+            return None
+
+        # the header indices are offset by the StructName column
+        return [self.itimes['first'] - 1, self.itimes['second'] - 1, self.itimes['third'] - 1]
+
     def importdata(self,input):
         imported = True
         line = 0
@@ -140,6 +158,37 @@ class patient:
 
 
 
+# Cull every patient of a cohort cube and write the valid
+# patients (with their three timepoints) to a new cube
+def writeCulledCube(incube, outputpath):
+    pids = []
+    times = []
+    values = []
+    present = []
+
+    for pid in incube.patients:
+        print(f"Processing patient {pid}")
+        i = incube.getPatientIndex(pid)
+        ntimes = int(np.sum(np.isfinite(incube.times[i])))
+
+        p = patient(pid)
+        cols = p.selectTimes(incube.times[i, :ntimes])
+
+        if cols is not None:
+            pids.append(pid)
+            times.append(incube.times[i, cols])
+            values.append(incube.values[i][:, cols])
+            present.append(incube.getPresence()[i])
+
+    nregions = len(incube.regions)
+    times = np.asarray(times).reshape(len(pids), 3)
+    values = np.asarray(values).reshape(len(pids), nregions, 3)
+
+    present = np.asarray(present, dtype=bool).reshape(len(pids), nregions)
+
+    cohortcube.writeCube(outputpath, pids, incube.regions, times, values, extras={'present': present})
+
+
 # --..--..--..--.. Input / Output ..--..--..--..--
 # relative directory where the original patient files reside
 inputdirectory = "./reformatted-data/2-dropped-fields/"
@@ -148,56 +197,89 @@ inputdirectory = "./reformatted-data/2-dropped-fields/"
 #   Note: You should create this directory if it does not already exist
 outputdirectory = "./reformatted-data/3-culled-data/"
 
+# --..--..--..--.. Time Windows ..--..--..--..--
+# first (~24 hour) time:  lower <= t <= upper (hours)
+# second (~48 hour) time: lower <  t <= upper (hours)
+# third (~30 day) time:   lower <  t <= upper (days)
+firstwindowhours = (20.0, 35.0)
+secondwindowhours = (35.0, 60.0)
+thirdwindowdays = (20.0, 50.0)
 
-# Execution starts here
-if __name__ == "__main__":
 
-    if not os.path.exists(inputdirectory):
-        print(f"The relative (to this script) input directory {inputdirectory} does not exist")
-        sys.exit()
+# Cull and write a single patient.  `task' is the tuple
+# (patient id, input csv).  Returns True if the patient had
+# all three timepoints and was written.
+def cullPatient(task):
+    pid, infile = task
+    print(f"Processing file {infile}")
+
+    p = patient(pid)
+    bValid = p.importdata(infile)
 
-    # clear any existing files and remake the target output directory
-    if os.path.exists(outputdirectory):
-        shutil.rmtree(outputdirectory)
-    os.mkdir(outputdirectory)
+    if bValid:
+        p.writepatient(outputdirectory)
+
+    return bValid
+
+
+# Execution starts here
+if __name__ == "__main__":
 
-    dirlevel = 0
-    patientdata = []
+    args = pipelinepool.parseStageArguments("Keep the ~24 hour, ~48 hour and ~30 day measurements of every patient")
 
-    # ----------- Read in and parse all subject files --------------------
-    for rootdir, subjectdirs, files in os.walk(inputdirectory):
+    if args.intermediate == 'cube':
+        incube = cohortcube.cubePath(inputdirectory)
+        if not os.path.exists(incube):
+            print(f"The relative (to this script) input cube {incube} does not exist")
+            sys.exit()
 
-        totalsubj = len(files)
-        thissubj = 0
-        dirlevel += 1
+        writeCulledCube(cohortcube.cohortcube(incube), cohortcube.cubePath(outputdirectory))
+    else:
+        if not os.path.exists(inputdirectory):
+            print(f"The relative (to this script) input directory {inputdirectory} does not exist")
+            sys.exit()
 
+        # the output directory is only cleared when the time
+        # windows changed (or with --force)
+        m = pipelinemanifest.openStageManifest(pipelinemanifest.manifestPath(outputdirectory),
+                                               {'first': firstwindowhours, 'second': secondwindowhours, 'third': thirdwindowdays},
+                                               [outputdirectory], force=args.force)
 
+        dirlevel = 0
+        tasks = []
 
-        # only process the top level subdirectories
-        if dirlevel == 1:
-            for subj in files:
-                thissubj += 1
-                print(f"Processing file {subj}")
-                infile = inputdirectory + subj
-                outfile = outputdirectory + subj
+        # ----------- Read in and parse all subject files --------------------
+        for rootdir, subjectdirs, files in os.walk(inputdirectory):
 
-                # we assume that the filenames are XXX.csv
-                #   where XXX is the patient ID (e.g. 7.csv
-                #   or 124.csv etc)
-                ipid = subj.find('.csv')
-                pid = int(subj[:ipid])
+            totalsubj = len(files)
+            thissubj = 0
+            dirlevel += 1
 
-                p = patient(pid)
-                bValid = p.importdata(infile)
 
-                if bValid:
-                    patientdata.append(p)
 
-    for pd in patientdata:
-        pd.writepatient(outputdirectory)
+            # only process the top level subdirectories
+            if dirlevel == 1:
+                for subj in files:
+                    thissubj += 1
+                    infile = inputdirectory + subj
 
+                    # we assume that the filenames are XXX.csv
+                    #   where XXX is the patient ID (e.g. 7.csv
+                    #   or 124.csv etc)
+                    ipid = subj.find('.csv')
+                    pid = int(subj[:ipid])
 
+                    tasks.append((pid, infile))
 
+        stale = pipelinemanifest.staleTasks(m, tasks, key=lambda t: os.path.basename(t[1]),
+                                            signature=lambda t: m.signature([t[1]]))
 
+        pipelinepool.mapPatients(cullPatient, [t[0] for t in stale], jobs=args.jobs)
 
+        # patients without the three timepoints are recorded without
+        # an output so that they are skipped as well
+        for (task, key, sig) in stale:
+            m.update(key, sig, [outputdirectory + str(task[0]) + ".csv"])
 
+        m.removeStale([os.path.basename(t[1]) for t in tasks])
+        m.write()
@@ -15,6 +15,10 @@
 #   model I(t) above using the first two (normalized)
 #   points and taking b=1.
 #
+#   Setting fitmode = 'all-timepoints' instead fits a, k and
+#   b to every available timepoint (from the peak onwards)
+#   of the un-culled data written by 2-drop-and-replace.py.
+#
 #   (This is the fourth script in the pipeline)
 #
 #  Authors:
@@ -32,7 +36,6 @@
 
 import os
 import csv
-import shutil
 import math
 
 import numpy as np
@@ -40,6 +43,11 @@ from pylab import *
 import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
 
+import clearancefit
+import cohortcube
+import pipelinepool
+import pipelinemanifest
+
 
 # returns the following sum of squares errors:
 #   sum of squares error
@@ -213,13 +221,13 @@ def fitted(xv, yv, plotres=False):
 #   2: What is the fit?
 #---------------------------------------------------------
 
-def writeClearance(input, output):
+# Read a culled patient file.  Returns the header times (as
+# strings) and a dictionary of region -> list of value strings
+def readCulledPatient(input):
     line = 0
 
     headertimes = []
     filedata = {}
-    clearancedata = {}
-    clearancemodel = {}
 
     with open(input) as incsv:
         csv_reader = csv.reader(incsv, delimiter=',')
@@ -233,41 +241,261 @@ def writeClearance(input, output):
                 filedata[row[0]] = row[1:]
             line += 1
 
-    if len(headertimes) < 2:
-        print(f"patient file {input} cannot be processed due to data paucity (at least 3 data points are needed)")
-    else:
+    return headertimes, filedata
+
+
+# Write the fitted clearance values of a single patient
+def writeClearanceCSV(output, clearancedata, clearancemodel):
+    with open(output, mode='w') as outcsv:
+        csv_writer = csv.writer(outcsv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+
+        # write the header
+        row = ['StructName'] + ['Clearance', 'Model Type']
+        csv_writer.writerow(row)
+
+        # write the fit parameters
+        for field in clearancedata:
+            row = [field] + [clearancedata[field], clearancemodel[field]]
+            csv_writer.writerow(row)
+
+
+# Compare the batched (closed form) fit against the reference
+# curve_fit path in fitted() for every cell.  curve_fit stops
+# at its own (relative) tolerance, so clearances are compared
+# with an absolute and a relative tolerance.  Returns the
+# number of cells whose model type or clearance disagree.
+def verifyAgainstCurveFit(xcells, ycells, clearance, modeltype, rtol=1.0e-6, atol=1.0e-7):
+    mismatches = 0
+    maxdiff = 0.0
+
+    for i in range(len(xcells)):
+        refclearance, refmodel = fitted(list(xcells[i]), list(ycells[i]), plotres=False)
+
+        diff = abs(refclearance - clearance[i])
+        maxdiff = max(maxdiff, diff)
+
+        if refmodel != clearancefit.modelnames[modeltype[i]] or diff > atol + rtol * abs(refclearance):
+            print(f"[VERIFY] cell {i}: curve_fit gives {refclearance} ({refmodel}), batched fit gives {clearance[i]} ({clearancefit.modelnames[modeltype[i]]})")
+            mismatches += 1
+
+    print(f"[VERIFY] {len(xcells)} cells checked, {mismatches} mismatches, maximum absolute difference {maxdiff}")
+    return mismatches
+
+
+# ---------------------------------------------------------
+# Fit the (cells x 3) times `xcells' and values `ycells' with
+# the batched clearance engine.  Cells for which the closed
+# form has no finite solution are re-fitted with the
+# reference curve_fit path.  Returns the clearance, the model
+# type index and the degeneracy of every cell.
+# ---------------------------------------------------------
+def fitCells(xcells, ycells, verify=False):
+    clearance, modeltype, relmse, degenerate, unresolved = clearancefit.fitClearanceBatch(xcells, ycells)
+
+    # fall back to the iterative fit where the closed form breaks down
+    for i in np.flatnonzero(unresolved):
+        refclearance, refmodel = fitted(list(xcells[i]), list(ycells[i]), plotres=False)
+        clearance[i] = refclearance
+        modeltype[i] = clearancefit.modelnames.index(refmodel)
+
+    if verify:
+        verifyAgainstCurveFit(xcells, ycells, clearance, modeltype)
+
+    return clearance, modeltype, degenerate
+
+
+# ---------------------------------------------------------
+# Fit every anatomical field of every patient file in
+# `inputs' with a single call to the batched clearance
+# engine and write the results to the matching entry of
+# `outputs' (see fitCells).
+# ---------------------------------------------------------
+def writeCohortClearance(inputs, outputs, verify=False):
+
+    patients = []
+    xcells = []
+    ycells = []
+
+    for input, output in zip(inputs, outputs):
+        headertimes, filedata = readCulledPatient(input)
+
+        if len(headertimes) < 2:
+            print(f"patient file {input} cannot be processed due to data paucity (at least 3 data points are needed)")
+            continue
+
         print(headertimes)
         xvals = [float(t) for t in headertimes]
 
-        # fit each anatomical field in the file
+        cells = {}
         for field in filedata:
             yvals = [float(d) for d in filedata[field]]
-            lyv = len(yvals)
 
-            if lyv != 3:
+            if len(yvals) != 3:
                 # this is an error and should never happen
                 print(f"V2 of the clearance pipeline requires exactly 3 data points.  Please double check patient data {input}")
+                cells[field] = -1
+            else:
+                cells[field] = len(ycells)
+                xcells.append(xvals)
+                ycells.append(yvals)
+
+        patients.append((input, output, cells))
+
+    if len(ycells) > 0:
+        xcells = np.asarray(xcells, dtype=np.float64)
+        ycells = np.asarray(ycells, dtype=np.float64)
+        clearance, modeltype, degenerate = fitCells(xcells, ycells, verify=verify)
+
+    for input, output, cells in patients:
+        clearancedata = {}
+        clearancemodel = {}
+        ndegenerate = [0, 0, 0]
+
+        for field in cells:
+            i = cells[field]
+            if i < 0:
                 clearancedata[field] = 0.00
                 clearancemodel[field] = 'Irregular Data'
             else:
-                # fit the data
-                clearance, modeltype = fitted(xvals, yvals, plotres=False)
+                clearancedata[field] = float(clearance[i])
+                clearancemodel[field] = clearancefit.modelnames[modeltype[i]]
+                ndegenerate[degenerate[i]] += 1
 
-                clearancedata[field] = clearance
-                clearancemodel[field] = modeltype
+        print(f"{input}: {ndegenerate[1]} degenerate type 1 and {ndegenerate[2]} degenerate type 2 regions")
+        writeClearanceCSV(output, clearancedata, clearancemodel)
 
 
-        with open(output, mode='w') as outcsv:
-            csv_writer = csv.writer(outcsv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+# ---------------------------------------------------------
+# `All timepoints' fitting mode.
+#
+# Fits I(t) = a*exp(-kt) + b to every available timepoint
+# (from the peak onwards) of every anatomical field of every
+# patient in `inputs' with the batched Levenberg-Marquardt
+# fitter.  The inputs are the (un-culled) files written by
+# 2-drop-and-replace.py, so the number of timepoints varies
+# between patients; the cohort is padded to a common length
+# and masked.  The output format matches the three point mode.
+#
+# [optional] ntimes: pad to at least this many timepoints.
+#   Passing the cohort maximum makes the result of fitting a
+#   subset of the cohort identical to fitting all of it.
+# ---------------------------------------------------------
+def writeCohortClearanceAllTimepoints(inputs, outputs, ntimes=0):
+
+    patients = []
+    tcells = []
+    ycells = []
+    maxtimes = ntimes
 
-            # write the header
-            row = ['StructName'] + ['Clearance', 'Model Type']
-            csv_writer.writerow(row)
+    for input, output in zip(inputs, outputs):
+        headertimes, filedata = readCulledPatient(input)
 
-            # write the fit parameters
-            for field in clearancedata:
-                row = [field] + [clearancedata[field], clearancemodel[field]]
-                csv_writer.writerow(row)
+        if len(headertimes) < 3:
+            print(f"patient file {input} cannot be processed due to data paucity (at least 3 data points are needed)")
+            continue
+
+        xvals = [float(t) for t in headertimes]
+        maxtimes = max(maxtimes, len(xvals))
+
+        cells = {}
+        for field in filedata:
+            yvals = [float(d) if d != '' else np.nan for d in filedata[field]]
+            cells[field] = len(ycells)
+            tcells.append(xvals)
+            ycells.append(yvals)
+
+        patients.append((input, output, cells))
+
+    if len(ycells) > 0:
+        tpad = np.zeros((len(ycells), maxtimes))
+        ypad = np.zeros((len(ycells), maxtimes))
+        mask = np.zeros((len(ycells), maxtimes), dtype=bool)
+        for i in range(len(ycells)):
+            n = min(len(tcells[i]), len(ycells[i]))
+            tpad[i, :n] = tcells[i][:n]
+            ypad[i, :n] = ycells[i][:n]
+            mask[i, :n] = True
+
+        clearance, modeltype, relmse, params = clearancefit.fitClearanceAllTimepoints(tpad, ypad, mask)
+
+    for input, output, cells in patients:
+        clearancedata = {}
+        clearancemodel = {}
+        nlinear = 0
+
+        for field in cells:
+            i = cells[field]
+            clearancedata[field] = float(clearance[i])
+            clearancemodel[field] = clearancefit.modelnames[modeltype[i]]
+            if modeltype[i] == clearancefit.MODEL_LINEAR:
+                nlinear += 1
+
+        print(f"{input}: {nlinear} regions without a decaying exponential fit")
+        writeClearanceCSV(output, clearancedata, clearancemodel)
+
+
+# ---------------------------------------------------------
+# Cohort cube version of the fitting modes: fit every
+# (patient, region) cell of the cube `incube' in one pass and
+# write a clearance cube to `outputpath'.  Regions that are
+# absent for a patient (or miss one of the three values in
+# the three point mode) are absent from the output; regions
+# whose values are all missing are kept in the all
+# timepoints mode, as in the CSV mode.
+# ---------------------------------------------------------
+def writeClearanceCube(incube, outputpath, verify=False):
+    values = incube.values
+    npatients, nregions, ntimes = values.shape
+
+    clearance = np.full((npatients, nregions), np.nan)
+    modeltype = np.full((npatients, nregions), -1, dtype=np.int8)
+
+    tcells = np.broadcast_to(incube.times[:, None, :], values.shape).reshape(-1, ntimes)
+    ycells = np.reshape(values, (-1, ntimes))
+
+    if fitmode == 'all-timepoints':
+        # every region present in the data is fitted, as in the
+        # CSV mode, even if all of its values are missing
+        mask = np.isfinite(ycells) & np.isfinite(tcells)
+        present = np.reshape(incube.getPresence(), -1)
+
+        cellclearance, cellmodel, relmse, params = clearancefit.fitClearanceAllTimepoints(tcells[present], ycells[present], mask[present])
+    else:
+        present = np.all(np.isfinite(ycells), axis=-1)
+        xcells = tcells[present]
+
+        cellclearance, cellmodel, degenerate = fitCells(xcells, ycells[present], verify=verify)
+
+    clearance.reshape(-1)[present] = cellclearance
+    modeltype.reshape(-1)[present] = cellmodel
+
+    cohortcube.writeCube(outputpath, incube.patients, incube.regions, np.zeros((npatients, 1)), clearance[..., None],
+                         kind='clearance', extras={'modeltype': modeltype}, modelnames=clearancefit.modelnames)
+
+
+# Fit and write a single patient file
+def writeClearance(input, output):
+    writeCohortClearance([input], [output], verify=verifyfits)
+
+
+# Count the timepoints in the header of a patient file
+def countTimepoints(input):
+    with open(input) as incsv:
+        header = next(csv.reader(incsv, delimiter=','), [])
+    return max(len(header) - 1, 0)
+
+
+# Fit and write a chunk of the cohort.  `task' is the tuple
+# (input files, output files, padded number of timepoints)
+def fitChunk(task):
+    infiles, outfiles, ntimes = task
+
+    if fitmode == 'all-timepoints':
+        writeCohortClearanceAllTimepoints(infiles, outfiles, ntimes=ntimes)
+    else:
+        writeCohortClearance(infiles, outfiles, verify=verifyfits)
+
+    return len(infiles)
 
 # ------------------------------------------------------------------------------------------------------------
 #                                                Configuration
@@ -277,45 +505,88 @@ def writeClearance(input, output):
 # relative directory where the original patient files reside
 inputdirectory = "./reformatted-data/3-culled-data/"
 
+# input directory for the `all timepoints' fitting mode (this
+# mode does not use the culled data of 3-cull-data.py)
+alltimepointsinputdirectory = "./reformatted-data/2-dropped-fields/"
+
 # relative directory where you want the reformatted patient files to go
 #   Note: You should create this directory if it does not already exist
 outputdirectory = "./reformatted-data/4-clearance-initial/"
 
+# --..--..--..--.. Fitting Options ..--..--..--..--
+# re-fit every cell with the reference (curve_fit) path and
+# report any difference to the batched closed form fit
+verifyfits = False
+
+# 'three-point': fit the ~24h, ~48h and ~30d values (default)
+# 'all-timepoints': fit a*exp(-kt)+b to every available timepoint
+fitmode = 'three-point'
 
 
 # Execution starts here
 if __name__ == "__main__":
-    # ---------------------------------------------------------------------
-    if not os.path.exists(inputdirectory):
-        print(f"The relative (to this script) input directory {inputdirectory} does not exist")
-        sys.exit()
-
-    # clear any existing files and remake the target output directory
-    if os.path.exists(outputdirectory):
-        shutil.rmtree(outputdirectory)
-    os.mkdir(outputdirectory)
 
-    #---------------------------------------------------------------------
+    args = pipelinepool.parseStageArguments("Fit the clearance of every anatomical region of every patient")
 
+    # ---------------------------------------------------------------------
+    if fitmode == 'all-timepoints':
+        inputdirectory = alltimepointsinputdirectory
 
-    dirlevel = 0
-
-    # ----------- Read in and parse all subject files --------------------
-    for rootdir, subjectdirs, files in os.walk(inputdirectory):
-
-        totalsubj = len(files)
-        thissubj = 0
-        dirlevel += 1
-
-        # only process the top level subdirectories
-        if dirlevel == 1:
-            for subj in files:
-                thissubj += 1
-                print(f"Processing file {subj}")
-                infile = inputdirectory + subj
-                outfile = outputdirectory + subj
-                writeClearance(infile, outfile)
+    if args.intermediate == 'cube':
+        incube = cohortcube.cubePath(inputdirectory)
+        if not os.path.exists(incube):
+            print(f"The relative (to this script) input cube {incube} does not exist")
+            sys.exit()
 
-    if not os.path.exists(outputdirectory):
-        print(f"The relative (to this script) output directory {outputdirectory} does not exist (please create it first)")
-        sys.exit()
+        writeClearanceCube(cohortcube.cohortcube(incube), cohortcube.cubePath(outputdirectory), verify=verifyfits)
+    else:
+        if not os.path.exists(inputdirectory):
+            print(f"The relative (to this script) input directory {inputdirectory} does not exist")
+            sys.exit()
+
+        dirlevel = 0
+        infiles = []
+        outfiles = []
+
+        # ----------- Read in and parse all subject files --------------------
+        for rootdir, subjectdirs, files in os.walk(inputdirectory):
+
+            totalsubj = len(files)
+            thissubj = 0
+            dirlevel += 1
+
+            # only process the top level subdirectories
+            if dirlevel == 1:
+                for subj in files:
+                    thissubj += 1
+                    print(f"Processing file {subj}")
+                    infiles.append(inputdirectory + subj)
+                    outfiles.append(outputdirectory + subj)
+
+        ntimes = 0
+        if fitmode == 'all-timepoints':
+            ntimes = max([countTimepoints(f) for f in infiles] + [0])
+
+        # the output directory is only cleared when the fitting mode
+        # (or the padded number of timepoints) changed, or with --force
+        m = pipelinemanifest.openStageManifest(pipelinemanifest.manifestPath(outputdirectory),
+                                               {'fitmode': fitmode, 'ntimes': ntimes},
+                                               [outputdirectory], force=args.force)
+
+        stale = pipelinemanifest.staleTasks(m, list(zip(infiles, outfiles)), key=lambda t: os.path.basename(t[0]),
+                                            signature=lambda t: m.signature([t[0]]))
+
+        # ----------- Fit the (stale part of the) cohort in one pass --------------------
+        # (one batched pass per worker when running with --jobs N)
+        pairs = [t[0] for t in stale]
+        tasks = []
+        for chunk in pipelinepool.chunkList(pairs, args.jobs):
+            tasks.append(([p[0] for p in chunk], [p[1] for p in chunk], ntimes))
+
+        pipelinepool.mapPatients(fitChunk, tasks, jobs=args.jobs)
+
+        for (pair, key, sig) in stale:
+            m.update(key, sig, [pair[1]])
+
+        m.removeStale([os.path.basename(f) for f in infiles])
+        m.write()
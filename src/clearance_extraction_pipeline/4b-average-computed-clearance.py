@@ -34,13 +34,18 @@
 import os
 import csv
 import math
-import shutil
-import xml.etree.ElementTree as ET
+
+import cohortcube
+import connectomegraph
+import pipelinepool
+import pipelinemanifest
 
 import numpy as np
 from pylab import *
 import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
+from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix
 
 class node:
 
@@ -171,45 +176,35 @@ class connectome:
         self.nodeRadialProximity = -1.0
         self.nodesByProximity = {}
 
+        # spatial index over the node coordinates and the
+        # proximity neighbors in CSR form (see groupNodesByProximity)
+        self.nodeIDs = []
+        self.nodeCoords = None
+        self.spatialIndex = None
+        self.proximityIndptr = None
+        self.proximityIndices = None
 
-    def __getNSKeyedStr(self, st):
-        ns = 'http://graphml.graphdrawing.org/xmlns'
-        ky = '{' + ns + '}' + st
-        return ky
+        # sparse (CSR) adjacency matrices in node order used to
+        # average the clearances of many patients at once (see
+        # averageInvalidClearances)
+        self.connectivityWeights = None
+        self.connectivityCounts = None
+        self.proximityAdjacency = None
 
-    def __addGraphmlNode(self, n):
-        # get the node ID attribute
-        iid = int(n.get('id'))
 
+    def __addNode(self, iid, x, y, z, region, fsname, hemisphere):
         # the node we will add to the collection
         newn = node(iid)
 
-        # extract the data keys
-        datky = self.__getNSKeyedStr('data')
-
-        for dat in n.findall(datky):
-            # get the code in the file
-            code = dat.get('key')
-            code = code.strip()
-
-            if code == "d0":
-                # x coordinate
-                newn.setxcoord(dat.text)
-            if code == "d1":
-                # y coordinate
-                newn.setycoord(dat.text)
-            if code == "d2":
-                # z coordinate
-                newn.setzcoord(dat.text)
-            if code == "d4":
-                # cortical / subcortical
-                newn.setRegion(dat.text)
-            if code == "d5":
-                # freesurfer parcellation id
-                newn.setFreesurferName(dat.text)
-            if code == "d7":
-                # hemisphere (left / right)
-                newn.setHemisphere(dat.text)
+        newn.setxcoord(x)
+        newn.setycoord(y)
+        newn.setzcoord(z)
+        # cortical / subcortical
+        newn.setRegion(region)
+        # freesurfer parcellation id
+        newn.setFreesurferName(fsname)
+        # hemisphere (left / right)
+        newn.setHemisphere(hemisphere)
 
         # make the coded node string for this node
         # ( this string can be matched to the freesurfer
@@ -226,29 +221,12 @@ class connectome:
             print(f"[Parsing Error] Node with id {iid} already exists in the connectome.")
 
 
-    def __addGraphmlEdge(self, e):
-        srcid = int(e.get('source'))
-        trgid = int(e.get('target'))
-
+    def __addEdge(self, srcid, trgid, fibercount, fiberlength):
         newe = edge(srcid, trgid)
 
-        # extract the data keys
-        datky = self.__getNSKeyedStr('data')
-
-        # ---
-        for dat in e.findall(datky):
-            # get the code in the file
-            code = dat.get('key')
-            code = code.strip()
-
-            if code == "d9":
-                # number of fibers (n)
-                newe.setfibercount(dat.text)
-
-            if code == "d12":
-                # average fiber length
-                newe.setfiberlength(dat.text)
-        # ---
+        # number of fibers (n) and average fiber length
+        newe.setfibercount(fibercount)
+        newe.setfiberlength(fiberlength)
 
         if srcid not in self.nodeneighbors:
             self.nodeneighbors[srcid] = [trgid]
@@ -285,35 +263,26 @@ class connectome:
         # add an entry to the tuple-based edge map
         self.edgemap[(srcid, trgid)] = newe
 
-    def __getNearestProximalNeighbor(self, nid):
-        rProx = 1.0e6
-        nNearest = None
-
-        if nid in self.nodesbyID:
-            n = self.nodesbyID[nid]
-
-            # get the key node's x,y,z coordinates
-            nx = n.getxcoord()
-            ny = n.getycoord()
-            nz = n.getzcoord()
-
-            for nextid in self.nodesbyID:
-                if nextid != nid:
-                    nodenxt = self.nodesbyID[nextid]
-                    nxx = nodenxt.getxcoord()
-                    nxy = nodenxt.getycoord()
-                    nxz = nodenxt.getzcoord()
-
-                    rn = math.pow(nx-nxx, 2) + math.pow(ny-nxy, 2) + math.pow(nz-nxz, 2)
-                    rn = math.sqrt(rn)
+    # ---------------------------------------------
+    # Build (once) the spatial index over the node
+    # coordinates.  Nodes are indexed by their position
+    # in self.nodeIDs, i.e. in the order of the
+    # connectome file.
+    # ---------------------------------------------
+    def __buildSpatialIndex(self):
+        if self.spatialIndex is None:
+            coords = [[nd.getxcoord(), nd.getycoord(), nd.getzcoord()] for nd in self.nodesbyID.values()]
+            self.nodeCoords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+            self.spatialIndex = cKDTree(self.nodeCoords)
 
-                    if rn < rProx:
-                        rProx = rn
-                        nNearest = nodenxt
-        else:
-            print(f"[ERROR] node id {nid} not found in node list")
+        return self.spatialIndex
 
-        return rProx, nNearest
+    # Euclidean distances between the nodes at positions
+    # `a' and `b' (evaluated as sqrt(dx^2 + dy^2 + dz^2),
+    # the way the neighbor lists have always been built)
+    def __nodeDistances(self, a, b):
+        d = self.nodeCoords[a] - self.nodeCoords[b]
+        return np.sqrt(d[..., 0]*d[..., 0] + d[..., 1]*d[..., 1] + d[..., 2]*d[..., 2])
 
     # --------------------------------------------
     # Call this function to replace the node with
@@ -430,19 +399,29 @@ class connectome:
 
     # ------------------------------------
     # Gets the average radial distance between
-    # all nodes in the connectome
+    # all nodes in the connectome and their nearest
+    # (spatial) neighbor
     # ------------------------------------
     def getAverageNodeRadialProximity(self):
+        tree = self.__buildSpatialIndex()
+        nnodes = len(self.nodeIDs)
+
+        # the nearest neighbor other than the node itself is among
+        # the three nearest points (coinciding nodes included)
+        k = min(3, nnodes)
+        dist, ndx = tree.query(self.nodeCoords, k=k)
+        ndx = ndx.reshape(nnodes, k)
+
         rAccum = 0.0
+        for i in range(nnodes):
+            others = ndx[i][(ndx[i] != i) & (ndx[i] < nnodes)]
+            rProx = np.min(self.__nodeDistances(i, others)) if len(others) > 0 else 1.0e6
 
-        for nV in self.nodesbyID:
-            rProx, nnode = self.__getNearestProximalNeighbor(nV)
             if rProx > 0.0:
-                rAccum += rProx
+                rAccum += float(rProx)
             else:
                 print(f"[ERROR] Node ID with no valid nearest neighbor encountered")
 
-        nnodes = len(self.nodesbyID)
         avgProx = float(rAccum / nnodes)
         return avgProx
 
@@ -452,30 +431,64 @@ class connectome:
     def parseConnectome(self, xmlfile):
         self.__reset()
 
-        tree = ET.parse(xmlfile)
-        root = tree.getroot()
-
-        # get the graph main object
-        gkey = self.__getNSKeyedStr('graph')
-        graph = root.find(gkey)
+        # the graph is read (or memory-mapped from its binary
+        # cache) as arrays, see connectomegraph.py
+        graph = connectomegraph.loadConnectome(xmlfile)
 
-        # the graph consists of node and
-        #   edge children.  We process the
+        # The graph consists of nodes and edges.  We process the
         # nodes first
-        nkey = self.__getNSKeyedStr('node')
-        allnodes = graph.findall(nkey)
+        for i in range(graph.getNodeCount()):
+            x, y, z = graph.coords[i].tolist()
+            self.__addNode(int(graph.nodeids[i]), x, y, z,
+                           graph.regions[i], graph.fsnames[i], graph.hemispheres[i])
 
-        for node in allnodes:
-            self.__addGraphmlNode(node)
-
-        # now get the edges from the xml tree
         # edge parsing depends on nodes existing
         # so it needs to go second
-        nkey = self.__getNSKeyedStr('edge')
-        alledges = graph.findall(nkey)
+        for src, trg, n, l in zip(graph.edgesource.tolist(), graph.edgetarget.tolist(),
+                                  graph.fibercount.tolist(), graph.fiberlength.tolist()):
+            self.__addEdge(src, trg, n, l)
+
+        self.nodeIDs = list(self.nodesbyID.keys())
+        self.__buildConnectivityMatrices()
+
+    # ---------------------------------------------
+    # Build the sparse weighted (n/l^lpow) and unweighted
+    # graph adjacency matrices.  Row i holds the entries of
+    # the graph neighbor list of the node at position i,
+    # in list order and with repeated neighbors kept, so
+    # that a sparse product accumulates exactly like the
+    # per-node averages.
+    # ---------------------------------------------
+    def __buildConnectivityMatrices(self, lpow=2):
+        position = {self.nodeIDs[i]: i for i in range(len(self.nodeIDs))}
+
+        indptr = [0]
+        indices = []
+        fibers = []
+        lengths = []
+
+        for nid in self.nodeIDs:
+            for ngbrid in self.nodeneighbors.get(nid, []):
+                # the edge could be (nid, ngbrid) or (ngbrid, nid)
+                if (nid, ngbrid) in self.edgemap:
+                    edg = self.edgemap[(nid, ngbrid)]
+                else:
+                    edg = self.edgemap[(ngbrid, nid)]
+
+                indices.append(position[ngbrid])
+                fibers.append(edg.n)
+                lengths.append(edg.l)
+            indptr.append(len(indices))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weights = np.asarray(fibers, dtype=np.float64) / np.power(np.asarray(lengths, dtype=np.float64), lpow)
+
+        shape = (len(self.nodeIDs), len(self.nodeIDs))
+        indices = np.asarray(indices, dtype=np.int64)
+        indptr = np.asarray(indptr, dtype=np.int64)
 
-        for edge in alledges:
-            self.__addGraphmlEdge(edge)
+        self.connectivityWeights = csr_matrix((weights, indices, indptr), shape=shape)
+        self.connectivityCounts = csr_matrix((np.ones(len(indices)), indices, indptr), shape=shape)
 
     # -------------------------------------
     # build a proximity neighbor list by specifying
@@ -505,27 +518,35 @@ class connectome:
         self.nodeRadialProximity = r
         self.nodesByProximity = {}
 
-        for na in self.nodesbyID:
-            nda = self.nodesbyID[na]
+        tree = self.__buildSpatialIndex()
 
-            self.nodesByProximity[na] = []
+        # candidate neighbors from a radius query (with a slightly
+        # larger radius), then the exact distance test rval <= r.
+        # Neighbors are kept in node order.
+        candidates = tree.query_ball_point(self.nodeCoords, r * (1.0 + 1.0e-9))
 
-            nax = nda.getxcoord()
-            nay = nda.getycoord()
-            naz = nda.getzcoord()
+        counts = np.zeros(len(self.nodeIDs), dtype=np.int64)
+        indices = []
+        for i in range(len(self.nodeIDs)):
+            cand = np.sort(np.asarray(candidates[i], dtype=np.int64))
+            cand = cand[cand != i]
+            ngbrs = cand[self.__nodeDistances(i, cand) <= r]
 
-            for nb in self.nodesbyID:
-                ndb = self.nodesbyID[nb]
+            counts[i] = len(ngbrs)
+            indices.append(ngbrs)
 
-                if na != nb:
-                    nbx = ndb.getxcoord()
-                    nby = ndb.getycoord()
-                    nbz = ndb.getzcoord()
+        # compressed sparse row neighbor structure: the proximal
+        # neighbors of the node at position i are
+        # proximityIndices[proximityIndptr[i]:proximityIndptr[i+1]]
+        self.proximityIndptr = np.concatenate([[0], np.cumsum(counts)])
+        self.proximityIndices = np.concatenate(indices + [np.zeros(0, dtype=np.int64)])
 
-                    rval = math.sqrt( math.pow(nax-nbx, 2) + math.pow(nay - nby, 2) + math.pow(naz - nbz, 2) )
+        for i in range(len(self.nodeIDs)):
+            ngbrs = self.proximityIndices[self.proximityIndptr[i]:self.proximityIndptr[i + 1]]
+            self.nodesByProximity[self.nodeIDs[i]] = [self.nodeIDs[j] for j in ngbrs]
 
-                    if rval <= self.nodeRadialProximity:
-                        self.nodesByProximity[na].append(nb)
+        self.proximityAdjacency = csr_matrix((np.ones(len(self.proximityIndices)), self.proximityIndices, self.proximityIndptr),
+                                             shape=(len(self.nodeIDs), len(self.nodeIDs)))
 
         proxCount = len(self.nodesByProximity)
         proxSum = 0
@@ -613,6 +634,65 @@ class connectome:
                     print(f"[ERROR] Could not set average proximity clearance for node {nd.getNodeString()}")
 
 
+    # -------------------------------------------------
+    # Average the invalid clearances of many patients in
+    # one sparse product.  `clearance' and `valid' are
+    # (nodes x patients) arrays in node order (as returned
+    # by getClearanceArrays).  Every invalid clearance is
+    # replaced by the average over its valid neighbors with
+    # a nonzero clearance, where the neighbors are
+    #   method = 'proximity': the proximal neighbors
+    #   method = 'connectivity': the graph neighbors,
+    #       weighted by n/l^2 if bWeighted is True
+    # Clearances without such neighbors are left unchanged.
+    #
+    # Returns the averaged clearances and the mask of the
+    # entries that were averaged.
+    #---------------------------------------------------
+    def averageInvalidClearances(self, clearance, valid, method='proximity', bWeighted=True):
+        clearance = np.asarray(clearance, dtype=np.float64)
+        valid = np.asarray(valid, dtype=bool)
+
+        if method == 'proximity':
+            adjacency = self.proximityAdjacency
+        elif bWeighted:
+            adjacency = self.connectivityWeights
+        else:
+            adjacency = self.connectivityCounts
+
+        # We only want to average over nodes are / were originally
+        # nodes with valid clearance values.
+        usable = valid & (clearance > 0.0)
+
+        sums = adjacency @ np.where(usable, clearance, 0.0)
+        weights = adjacency @ usable.astype(np.float64)
+
+        averaged = ~valid & (weights > 0.0)
+
+        result = clearance.copy()
+        result[averaged] = sums[averaged] / weights[averaged]
+
+        return result, averaged
+
+
+    #--------------------------------------------
+    # Get the node string ids, the clearance values and
+    # the clearance validity of all nodes (in node order)
+    #--------------------------------------------
+    def getClearanceArrays(self):
+        names = []
+        clearance = []
+        valid = []
+
+        for n in self.nodesbyID:
+            nd = self.nodesbyID[n]
+            names.append(nd.getNodeString())
+            clearance.append(nd.getClearance())
+            valid.append(nd.getIsClearanceValid())
+
+        return names, clearance, valid
+
+
     #--------------------------------------------
     # Get a count of the number of invalid clearance
     # nodes currently in the connectome (call after
@@ -633,26 +713,8 @@ class connectome:
     # to a desired output CSV file
     #------------------------------------------------
     def writeClearanceToCSV(self, outputcsv):
-
-        with open(outputcsv, mode='w') as outcsv:
-            csv_writer = csv.writer(outcsv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-
-            # write the header
-            row = ['StructName'] + ['Clearance', 'Model Type']
-            csv_writer.writerow(row)
-
-            for n in self.nodesbyID:
-                node = self.nodesbyID[n]
-                structname = node.getNodeString()
-                clearance  = node.getClearance()
-                model = "Exponential"
-
-                bValid = node.getIsClearanceValid()
-                if bValid == False:
-                    model = "Averaged"
-
-                row = [structname, str(clearance), model]
-                csv_writer.writerow(row)
+        names, clearance, valid = self.getClearanceArrays()
+        writeClearanceArraysToCSV(outputcsv, names, clearance, valid)
 
 
 
@@ -670,6 +732,10 @@ outputdirectoryroot = "./reformatted-data/4-clearance-initial/averaged/"
 
 # Path to the scale-33 connectome graph
 scale33Connectome = "./master-std33.graphml"
+
+# Two nodes are proximal if their distance is less than or equal
+# to groupval times the average nearest neighbor distance
+groupval = 2.2
 # -------------------------------------------------------------------------------------------------------------
 
 
@@ -702,21 +768,169 @@ def loadClearanceCSV(connectome, inputcsv):
                 clearance = float(row[1])
                 ModelType = row[2].strip()
 
-                if ModelType == "Exponential":
-                    if connectome.setNodeClearance(strid, clearance, bClearanceValid=True) == False:
-                        print(f"[ERROR] Could not set the clearance status for {strid}")
-                else:
-                    #if we could not fit an exponential model, this clearance value is invalid and
-                    #needs to be averaged out somehow
-                    if connectome.setNodeClearance(strid, clearance, bClearanceValid=False) == False:
-                        print(f"[ERROR] Could not set the clearance status for {strid}")
+                setPatientClearance(connectome, strid, clearance, ModelType)
             line += 1
 
 
+# Set the clearance of a single region according to the model
+# type that was fitted to it by 4-compute-clearance.py
+def setPatientClearance(connectome, strid, clearance, ModelType):
+    if ModelType == "Exponential":
+        if connectome.setNodeClearance(strid, clearance, bClearanceValid=True) == False:
+            print(f"[ERROR] Could not set the clearance status for {strid}")
+    else:
+        #if we could not fit an exponential model, this clearance value is invalid and
+        #needs to be averaged out somehow
+        if connectome.setNodeClearance(strid, clearance, bClearanceValid=False) == False:
+            print(f"[ERROR] Could not set the clearance status for {strid}")
+
+
+# Load the clearance values of patient `pid' from a clearance
+# cohort cube into a connectome object
+def loadClearanceCube(connectome, cube, pid):
+
+    # reset any currently stored clearance values to zero
+    connectome.resetNodalClearanceValues()
+
+    i = cube.getPatientIndex(pid)
+    modeltype = cube.getArray('modeltype')[i]
+
+    for r in np.flatnonzero(modeltype >= 0):
+        setPatientClearance(connectome, cube.regions[r].strip(), float(cube.values[i, r, 0]), cube.modelnames[modeltype[r]])
+
+
+
+# Load the clearance values of a single patient, given as the
+# region names, clearances and model type names written by
+# 4-compute-clearance.py, into a connectome object
+def loadClearanceValues(connectome, regions, clearance, modeltypes):
+
+    # reset any currently stored clearance values to zero
+    connectome.resetNodalClearanceValues()
+
+    for r in range(len(regions)):
+        setPatientClearance(connectome, regions[r].strip(), float(clearance[r]), modeltypes[r])
+
+
+# connectome shared by all patients processed in this process
+objConnectome = None
+
+
+# ---------------------------------------------------------
+# Parse the connectome and build the proximity groups.  This
+# is called once in every process (including pool workers)
+# and does nothing if the connectome is already loaded.
+#
+# Returns the average nearest neighbor distance and the
+# proximity grouping statistics of groupNodesByProximity.
+# ---------------------------------------------------------
+def initConnectome(connectomefile, groupval):
+    global objConnectome, connectomestats
+
+    if objConnectome is None:
+        objConnectome = connectome()
+        objConnectome.parseConnectome(connectomefile)
+
+        # The graph neighbors are built automatically by the connectome.
+        # We now establish the radial proximity neighbor list
+        avgProx = objConnectome.getAverageNodeRadialProximity()
+
+        # Now we build a proximal neighbor list by defining a radius
+        # around each node equal to some percentage of the average
+        # nearest neighbor radius.  We consider two nodes to be proximal
+        # if their distance is less than or equal to twice the average
+        # of the distance between each node and its nearest spatial neighbor
+        connectomestats = (avgProx,) + objConnectome.groupNodesByProximity(r=groupval*avgProx)
+
+    return connectomestats
+
+
+# ---------------------------------------------------------
+# Load the clearances of several patients into (nodes x
+# patients) clearance and validity arrays (in node order).
+# `load' loads a single entry of `patients' into the shared
+# connectome, e.g. loadClearanceCSV.
+# ---------------------------------------------------------
+def loadCohortClearance(patients, load):
+    nnodes = len(objConnectome.nodeIDs)
+    clearance = np.zeros((nnodes, len(patients)))
+    valid = np.zeros((nnodes, len(patients)), dtype=bool)
+
+    for k in range(len(patients)):
+        load(objConnectome, patients[k])
+
+        names, clearance[:, k], valid[:, k] = objConnectome.getClearanceArrays()
+
+    return clearance, valid
+
+
+# ---------------------------------------------------------
+# Repair the (nodes x patients) clearances of a cohort: the
+# invalid (i.e. linear model) clearances are averaged over
+# the valid proximal neighbors and, separately, over the
+# valid graph neighbors.  `labels' names the patients in
+# the log.  Returns the proximity and connectivity averaged
+# clearances.
+# ---------------------------------------------------------
+def repairCohortClearance(clearance, valid, labels):
+    proximity, byProximity = objConnectome.averageInvalidClearances(clearance, valid, method='proximity')
+
+    # nodes that cannot be averaged by connectivity keep their
+    # proximity average
+    connectivity, byConnectivity = objConnectome.averageInvalidClearances(proximity, valid, method='connectivity')
+
+    for k in range(len(labels)):
+        print(f"Patient file {labels[k]} contains {np.sum(~valid[:, k])} invalid clearance regions (i.e. linear model fitted).")
+
+        for i in np.flatnonzero(~valid[:, k] & ~byProximity[:, k]):
+            print(f"[ERROR] Could not set average proximity clearance for node {objConnectome.nodesbyID[objConnectome.nodeIDs[i]].getNodeString()}")
+        for i in np.flatnonzero(~valid[:, k] & ~byConnectivity[:, k]):
+            print(f"[ERROR] Could not set average connectivity clearance for node {objConnectome.nodesbyID[objConnectome.nodeIDs[i]].getNodeString()}")
+
+    return proximity, connectivity
+
+
+# Write the averaged clearances of a single patient in the
+# format of connectome.writeClearanceToCSV
+def writeClearanceArraysToCSV(outputcsv, names, clearance, valid):
+
+    with open(outputcsv, mode='w') as outcsv:
+        csv_writer = csv.writer(outcsv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+
+        # write the header
+        row = ['StructName'] + ['Clearance', 'Model Type']
+        csv_writer.writerow(row)
+
+        for i in range(len(names)):
+            model = "Exponential"
+            if valid[i] == False:
+                model = "Averaged"
+
+            row = [names[i], str(float(clearance[i])), model]
+            csv_writer.writerow(row)
+
+
+# Write averaged clearances (patients x nodes) to a clearance cube
+def writeAveragedCube(outputpath, pids, names, clearance, valid):
+    clearance = np.asarray(clearance, dtype=np.float64).reshape(len(pids), len(names))
+    modeltype = np.where(np.asarray(valid, dtype=bool).reshape(len(pids), len(names)), 0, 1).astype(np.int8)
+
+    cohortcube.writeCube(outputpath, pids, names, np.zeros((len(pids), 1)), clearance[..., None],
+                         kind='clearance', extras={'modeltype': modeltype}, modelnames=['Exponential', 'Averaged'])
+
 
 # Execution starts here
 if __name__ == "__main__":
 
+    def addoptions(parser):
+        parser.add_argument('--export-csv', action='store_true',
+                            help='(cube mode) also write the averaged clearances as per-patient CSV files')
+
+    args = pipelinepool.parseStageArguments("Replace linear model clearances by averages over neighboring regions", addoptions)
+
+    if args.intermediate == 'cube':
+        inputdirectory = cohortcube.cubePath(inputdirectory)
+
     if not os.path.exists(inputdirectory):
         print(f"The relative (to this script) input directory {inputdirectory} does not exist")
         sys.exit()
@@ -724,28 +938,10 @@ if __name__ == "__main__":
     outdirProximity = outputdirectoryroot + "proximity-averaged"
     outdirConnectivity = outputdirectoryroot + "connectivity-averaged"
 
-    # clear any existing files and remake the target output directory
-    if os.path.exists(outputdirectoryroot):
-        shutil.rmtree(outputdirectoryroot)
-    os.mkdir(outputdirectoryroot)
-
-    os.mkdir(outdirProximity)
-    os.mkdir(outdirConnectivity)
+    if not os.path.exists(outputdirectoryroot):
+        os.makedirs(outputdirectoryroot)
 
-    objConnectome = connectome()
-    objConnectome.parseConnectome(scale33Connectome)
-
-    # The graph neighbors are built automatically by the connectome.
-    # We now establish the radial proximity neighbor list
-    avgProx = objConnectome.getAverageNodeRadialProximity()
-
-    # Now we build a proximal neighbor list by defining a radius
-    # around each node equal to some percentage of the average
-    # nearest neighbor radius.  We consider two nodes to be proximal
-    # if their distance is less than or equal to twice the average
-    # of the distance between each node and its nearest spatial neighbor
-    groupval = 2.2
-    allGrouped, minProximal, maxProximal, avgProximal = objConnectome.groupNodesByProximity(r=groupval*avgProx)
+    avgProx, allGrouped, minProximal, maxProximal, avgProximal = initConnectome(scale33Connectome, groupval)
 
     print("")
     print(f"*** Proximity set to {groupval} times average nearest neighbor distance")
@@ -760,48 +956,62 @@ if __name__ == "__main__":
 
 
 
-    dirlevel = 0
+    if args.intermediate == 'cube':
+        incube = cohortcube.cohortcube(inputdirectory)
+
+        # ----------- Repair the whole cohort at once --------------------
+        clearance, valid = loadCohortClearance(incube.patients, lambda c, pid: loadClearanceCube(c, incube, pid))
+        proximity, connectivity = repairCohortClearance(clearance, valid, incube.patients)
 
-    # ----------- create normalized files --------------------
-    for rootdir, subjectdirs, files in os.walk(inputdirectory):
+        names, nodeclearance, nodevalid = objConnectome.getClearanceArrays()
+        writeAveragedCube(cohortcube.cubePath(outdirProximity), incube.patients, names, proximity.T, valid.T)
+        writeAveragedCube(cohortcube.cubePath(outdirConnectivity), incube.patients, names, connectivity.T, valid.T)
 
-        totalsubj = len(files)
-        thissubj = 0
-        dirlevel += 1
+        # final step: CSV export of the averaged clearances
+        if args.export_csv:
+            cohortcube.exportCSV(cohortcube.cohortcube(cohortcube.cubePath(outdirProximity)), outdirProximity)
+            cohortcube.exportCSV(cohortcube.cohortcube(cohortcube.cubePath(outdirConnectivity)), outdirConnectivity)
+    else:
+        dirlevel = 0
+        tasks = []
 
-        # only process the top level subdirectories
-        if dirlevel == 1:
-            for subj in files:
-                thissubj += 1
-                infile = inputdirectory + subj
-                #outfile = outputdirectory + subj
-                print(f"Processing file {subj}")
+        # ----------- find all patient files --------------------
+        for rootdir, subjectdirs, files in os.walk(inputdirectory):
 
-                loadClearanceCSV(objConnectome, infile)
+            totalsubj = len(files)
+            thissubj = 0
+            dirlevel += 1
 
-                iInvalid = objConnectome.getInvalidClearanceCount()
+            # only process the top level subdirectories
+            if dirlevel == 1:
+                for subj in files:
+                    thissubj += 1
+                    infile = inputdirectory + subj
+                    tasks.append((subj, infile))
 
-                # if iInvalid == 0:
-                #     print(f"All regions in patient file {subj} are valid (Exponential) model clearances")
-                #     continue
-                # else:
-                #     print(f"Patient file {subj} contains {iInvalid} invalid clearance regions (i.e. linear model fitted).")
-                #     print(f"Repairing subject file {subj} by averaging valid (Exponential) neighbors using two different methods")
+        # the output directories are only cleared when the proximity
+        # threshold or the connectome changed (or with --force).  The
+        # manifest is kept inside the output directory, as the files
+        # next to it are the inputs of this stage.
+        m = pipelinemanifest.openStageManifest(outputdirectoryroot + "manifest.json",
+                                               {'groupval': groupval, 'connectome': pipelinemanifest.fileHash(scale33Connectome)},
+                                               [outdirProximity, outdirConnectivity], force=args.force)
 
-                print(f"Patient file {subj} contains {iInvalid} invalid clearance regions (i.e. linear model fitted).")
-                print(f"Repairing subject file {subj} by averaging valid (Exponential) neighbors using two different methods")
+        stale = pipelinemanifest.staleTasks(m, tasks, key=lambda t: t[0],
+                                            signature=lambda t: m.signature([t[1]]))
+        subjs = [t[0][0] for t in stale]
 
-                # Now we average invalid values (these correspond to the linear model)
-                # by proximity and output the result
-                objConnectome.averageInvalidClearanceByProximity()
+        # ----------- Repair the (stale part of the) cohort at once --------------------
+        clearance, valid = loadCohortClearance([t[0][1] for t in stale], loadClearanceCSV)
+        proximity, connectivity = repairCohortClearance(clearance, valid, subjs)
 
-                # Write the averaged normalization
-                proximityOutput = outdirProximity + f"/{subj}"
-                objConnectome.writeClearanceToCSV(proximityOutput)
+        names, nodeclearance, nodevalid = objConnectome.getClearanceArrays()
+        for k in range(len(subjs)):
+            writeClearanceArraysToCSV(outdirProximity + f"/{subjs[k]}", names, proximity[:, k], valid[:, k])
+            writeClearanceArraysToCSV(outdirConnectivity + f"/{subjs[k]}", names, connectivity[:, k], valid[:, k])
 
-                # Now average invalid values (these correspond to the linear model)
-                # by graph connectivity and output the result
-                objConnectome.averageInvalidClearanceByConnectivity()
+        for (task, key, sig) in stale:
+            m.update(key, sig, [outdirProximity + f"/{key}", outdirConnectivity + f"/{key}"])
 
-                connectivityOutput = outdirConnectivity + f"/{subj}"
-                objConnectome.writeClearanceToCSV(connectivityOutput)
+        m.removeStale([t[0] for t in tasks])
+        m.write()
@@ -0,0 +1,332 @@
+# --------------------------------------------------------
+#
+#  ***Oxford Mathematical Brain Modeling Group***
+#
+#   Batched clearance fitting engine used by
+#   4-compute-clearance.py
+#
+#   The fitting rules are identical to those of the
+#   (per-region) function fitted() in 4-compute-clearance.py
+#
+#   1. Every cell (patient, region) carries three values
+#       measured at ~24 hours, ~48 hours and ~30 days
+#   2. Values are normalized by the 30 day baseline
+#   3. If the maximum is not at the first point (degenerate
+#       type 1) or the baseline exceeds the 48 hour value
+#       (degenerate type 2) a linear model is fitted to all
+#       three points and the clearance is the negative slope
+#   4. Otherwise I(t) = A*exp(-k(t-t0)) + 1 with A = I(t0)-1
+#       is fitted through the first two points.  With A and
+#       the asymptote fixed, k is determined exactly by
+#
+#           k = -log( (I(t1)-1) / (I(t0)-1) ) / (t1 - t0)
+#
+#   so no iterative least squares is needed.  Every cell of
+#   the cohort is fitted in a single NumPy pass.
+#
+#  Authors:
+#  ================================================
+#       Georgia S. Brennan      brennan@maths.ox.ac.uk
+#                   ----
+#       Travis B. Thompson      thompsont@maths.ox.ac.uk
+#                   ----
+#       Marie E. Rognes         meg@simula.no
+#                   ----
+#       Vegard Vinje            vegard@simula.no
+#                   ----
+#       Alain Goriely           goriely@maths.ox.ac.uk
+# ---------------------------------------------------------
+
+import numpy as np
+
+
+# integer model codes returned by the batched engine and
+# the names written to the clearance files
+MODEL_EXPONENTIAL = 0
+MODEL_LINEAR = 1
+modelnames = ['Exponential', 'Linear']
+
+# degenerate type codes (0 means not degenerate)
+DEGENERATE_NONE = 0
+DEGENERATE_MAXIMUM = 1
+DEGENERATE_BASELINE = 2
+
+
+# relative mean square error ((actual-fitted)/actual)^2 along
+# the last axis.  Entries excluded by `mask' (if given) do not
+# contribute to the mean.
+def relativeMSE(actual, fitted, mask=None):
+    reldiffer = np.square((actual - fitted) / actual)
+
+    if mask is None:
+        return np.mean(reldiffer, axis=-1)
+
+    reldiffer = np.where(mask, reldiffer, 0.0)
+    count = np.sum(mask, axis=-1)
+    return np.sum(reldiffer, axis=-1) / np.maximum(count, 1)
+
+
+# least squares line y = a*x + b along the last axis of (x, y).
+# Returns the slope, the intercept and the relative mean
+# square error of the prediction.
+def fitLinearBatch(x, y, mask=None):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    if mask is None:
+        mask = np.ones(np.broadcast_shapes(x.shape, y.shape), dtype=bool)
+
+    w = mask.astype(np.float64)
+    count = np.maximum(np.sum(w, axis=-1), 1.0)
+
+    xm = np.sum(w * x, axis=-1) / count
+    ym = np.sum(w * y, axis=-1) / count
+
+    dx = np.where(mask, x - xm[..., None], 0.0)
+    dy = np.where(mask, y - ym[..., None], 0.0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.sum(dx * dy, axis=-1) / np.sum(dx * dx, axis=-1)
+    intercept = ym - slope * xm
+
+    ypred = slope[..., None] * x + intercept[..., None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relmse = relativeMSE(y, ypred, mask)
+
+    return slope, intercept, relmse
+
+
+# Classify every cell according to the rules of fitted().
+# `yv' has shape (..., 3) and holds the raw (un-normalized)
+# values.  Returns an integer array of DEGENERATE_* codes.
+def classifyCells(yv):
+    yv = np.asarray(yv, dtype=np.float64)
+
+    ymax = np.max(yv, axis=-1)
+
+    degenerate = np.full(yv.shape[:-1], DEGENERATE_NONE, dtype=np.int8)
+    degenerate[yv[..., 2] > yv[..., 1]] = DEGENERATE_BASELINE
+    # type 1 takes precedence over type 2 (it is tested first)
+    degenerate[ymax != yv[..., 0]] = DEGENERATE_MAXIMUM
+
+    return degenerate
+
+
+# ---------------------------------------------------------
+# Fit the clearance of every cell in one pass.
+#
+#   xv: times (in days) with shape (..., 3), broadcastable
+#       against yv.  For a (patients x ROIs x 3) array of
+#       values pass the patient times as (patients x 1 x 3)
+#   yv: measured values with shape (..., 3)
+#
+# Returns (clearance, modeltype, relmse, degenerate, unresolved)
+# where modeltype holds MODEL_* codes and degenerate holds
+# DEGENERATE_* codes.  Cells whose exponential fit has no
+# finite closed form solution (for instance I(t1) equal to
+# the baseline) are flagged in the `unresolved' mask so that
+# the caller can decide how to treat them.
+# ---------------------------------------------------------
+def fitClearanceBatch(xv, yv):
+    xv = np.asarray(xv, dtype=np.float64)
+    yv = np.asarray(yv, dtype=np.float64)
+    xv = np.broadcast_to(xv, np.broadcast_shapes(xv.shape, yv.shape))
+
+    degenerate = classifyCells(yv)
+    linear = degenerate != DEGENERATE_NONE
+
+    # normalize by the 30 day baseline
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ynorm = yv / yv[..., 2:3]
+
+    # -- linear model (degenerate cells) --
+    slope, intercept, linerr = fitLinearBatch(xv, ynorm)
+
+    # -- exponential model through the first two points --
+    B = 1.0
+    A = ynorm[..., 0] - B
+    dt = xv[..., 1] - xv[..., 0]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k = -np.log((ynorm[..., 1] - B) / A) / dt
+
+        ypred = A[..., None] * np.exp(-k[..., None] * (xv[..., :2] - xv[..., 0:1])) + B
+        experr = relativeMSE(ynorm[..., :2], ypred)
+
+    clearance = np.where(linear, -1.0 * slope, k)
+    relmse = np.where(linear, linerr, experr)
+    modeltype = np.where(linear, MODEL_LINEAR, MODEL_EXPONENTIAL).astype(np.int8)
+
+    unresolved = ~np.isfinite(clearance)
+
+    return clearance, modeltype, relmse, degenerate, unresolved
+
+
+# ---------------------------------------------------------
+# Multi-timepoint fitting
+#
+# Fit I(t) = a*exp(-k(t-t0)) + b to every available
+# timepoint of every cell at once using a damped
+# Gauss-Newton (Levenberg-Marquardt) iteration.  Data is
+# ragged across patients, so cells are padded to a common
+# number of timepoints and `mask' marks the valid entries.
+#
+#   t:    times (in days) with shape (cells, T)
+#   y:    measured values with shape (cells, T)
+#   mask: boolean array of valid entries, shape (cells, T)
+#
+# Each cell is scaled by its largest valid value and the
+# time origin t0 is the first valid time of the cell, so
+# that the three parameters are of order one.  Returns
+# (a, k, b, relmse, converged), with a and b in the units
+# of y.
+# ---------------------------------------------------------
+def fitExponentialLM(t, y, mask, maxiter=200, tol=1.0e-8, damping=1.0e-3):
+    t = np.asarray(t, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    mask = np.asarray(mask, dtype=bool) & np.isfinite(y) & np.isfinite(t)
+
+    ncells = y.shape[0]
+    w = mask.astype(np.float64)
+
+    # -- scale the problem --
+    scale = np.max(np.where(mask, np.abs(y), 0.0), axis=-1)
+    scale[scale == 0.0] = 1.0
+    ys = np.where(mask, y, 0.0) / scale[:, None]
+
+    t0 = np.min(np.where(mask, t, np.inf), axis=-1)
+    t0[~np.isfinite(t0)] = 0.0
+    s = np.where(mask, t - t0[:, None], 0.0)
+
+    # -- initial guess: b from the last valid value, a from the first --
+    first = np.argmax(mask, axis=-1)
+    last = mask.shape[1] - 1 - np.argmax(mask[:, ::-1], axis=-1)
+    rows = np.arange(ncells)
+
+    b = ys[rows, last].copy()
+    a = ys[rows, first] - b
+    span = s[rows, last]
+    span[span <= 0.0] = 1.0
+    k = np.full(ncells, 3.0) / span
+
+    theta = np.stack([a, k, b], axis=-1)
+
+    def residual(theta):
+        with np.errstate(over='ignore', invalid='ignore'):
+            e = np.exp(-theta[:, 1:2] * s)
+            r = (theta[:, 0:1] * e + theta[:, 2:3] - ys) * w
+        return r, e
+
+    r, e = residual(theta)
+    cost = np.sum(r * r, axis=-1)
+    mu = np.full(ncells, damping)
+    active = np.sum(mask, axis=-1) >= 3
+    converged = np.zeros(ncells, dtype=bool)
+
+    for it in range(maxiter):
+        if not np.any(active):
+            break
+
+        # Jacobian of the residual with respect to (a, k, b)
+        J = np.stack([e * w, -theta[:, 0:1] * s * e * w, w], axis=-1)
+        JTJ = np.einsum('nti,ntj->nij', J, J)
+        JTr = np.einsum('nti,nt->ni', J, r)
+
+        diag = np.einsum('nii->ni', JTJ)
+        lhs = JTJ + (mu[:, None] * np.maximum(diag, 1.0e-12))[:, :, None] * np.eye(3)
+
+        # cells that overflowed are dropped; inactive (finished or
+        # unfittable) cells are given an identity system so that
+        # the batched solve stays regular
+        active &= np.all(np.isfinite(lhs), axis=(1, 2)) & np.all(np.isfinite(JTr), axis=-1)
+        lhs[~active] = np.eye(3)
+        JTr[~active] = 0.0
+
+        delta = np.linalg.solve(lhs, -JTr[..., None])[..., 0]
+
+        trial = theta + delta
+        rtrial, etrial = residual(trial)
+        with np.errstate(over='ignore', invalid='ignore'):
+            costtrial = np.sum(rtrial * rtrial, axis=-1)
+
+        accept = active & np.isfinite(costtrial) & (costtrial < cost)
+
+        theta[accept] = trial[accept]
+        r[accept] = rtrial[accept]
+        e[accept] = etrial[accept]
+
+        # convergence: an accepted step with a small relative
+        # decrease of the cost (or a vanishing step), an exact
+        # fit, or a damping so large that no step decreases the
+        # cost any more (the cell sits at a stationary point)
+        stepsize = np.max(np.abs(delta), axis=-1)
+        with np.errstate(over='ignore', invalid='ignore'):
+            decrease = (cost - costtrial) / np.maximum(cost, 1.0e-300)
+        done = active & ((accept & ((decrease < tol) | (stepsize < tol))) | (cost < 1.0e-30) | (mu > 1.0e10))
+
+        cost = np.where(accept, costtrial, cost)
+        mu = np.where(accept, mu / 3.0, mu * 2.0)
+
+        converged |= done
+        active &= ~done
+
+    a = theta[:, 0] * scale
+    k = theta[:, 1]
+    b = theta[:, 2] * scale
+
+    with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+        ypred = a[:, None] * np.exp(-k[:, None] * s) + b[:, None]
+        relmse = relativeMSE(np.where(mask, y, 1.0), np.where(mask, ypred, 1.0), mask)
+
+    return a, k, b, relmse, converged
+
+
+# ---------------------------------------------------------
+# Clearance for the `all timepoints' fitting mode.
+#
+# When fromPeak is True only the peak (largest valid value)
+# and the timepoints after it take part in the fit; the
+# tracer enhancement phase before the peak is not
+# described by an exponential decay.
+#
+# A cell is classified as Exponential if the fit converged
+# to a decaying curve (a > 0, k > 0).  Every other cell
+# falls back to a linear model over the same points
+# (normalized by the last valid value; over every valid
+# point if fewer than two remain from the peak) and the
+# clearance is the negative slope, as in the three point
+# mode.
+#
+# Returns (clearance, modeltype, relmse, params) where
+# params is a (cells x 3) array of the fitted (a, k, b).
+# ---------------------------------------------------------
+def fitClearanceAllTimepoints(t, y, mask, fromPeak=True):
+    t = np.asarray(t, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    valid = np.asarray(mask, dtype=bool) & np.isfinite(y)
+    mask = valid
+
+    if fromPeak:
+        peak = np.argmax(np.where(valid, y, -np.inf), axis=-1)
+        mask = valid & (np.arange(y.shape[1])[None, :] >= peak[:, None])
+
+    a, k, b, experr, converged = fitExponentialLM(t, y, mask)
+
+    # linear fallback on data normalized by the last valid value.
+    # A line needs two points: if fewer than two remain from the
+    # peak onwards (the peak is the last valid value) the line is
+    # fitted to every valid point, as in the three point mode.
+    linmask = np.where((np.sum(mask, axis=-1) < 2)[:, None], valid, mask)
+    last = mask.shape[1] - 1 - np.argmax(mask[:, ::-1], axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ynorm = y / y[np.arange(y.shape[0]), last][:, None]
+    slope, intercept, linerr = fitLinearBatch(np.where(linmask, t, 0.0), np.where(linmask, ynorm, 0.0), linmask)
+
+    exponential = converged & (a > 0.0) & (k > 0.0) & np.isfinite(k)
+
+    clearance = np.where(exponential, k, -1.0 * slope)
+    relmse = np.where(exponential, experr, linerr)
+    modeltype = np.where(exponential, MODEL_EXPONENTIAL, MODEL_LINEAR).astype(np.int8)
+    params = np.stack([a, k, b], axis=-1)
+
+    return clearance, modeltype, relmse, params
@@ -0,0 +1,262 @@
+# --------------------------------------------------------
+#
+#  ***Oxford Mathematical Brain Modeling Group***
+#
+#   Binary (columnar) intermediate format for the clearance
+#   pipeline.
+#
+#   Instead of one small CSV file per patient, a stage can
+#   write a single memory-mappable cohort cube.  A cube is a
+#   directory (by convention named <stage directory>.cube/)
+#   containing
+#
+#     values.npy    float64 (patients x regions x timepoints)
+#     times.npy     float64 (patients x timepoints)
+#     patients.txt  one patient ID per line
+#     regions.txt   one region name per line
+#     meta.json     the kind of cube and its model names
+#     <name>.npy    optional extra (patients x regions) arrays
+#
+#   Patients do not share the same number of timepoints or
+#   (necessarily) the same regions: times and values are
+#   padded with NaN.  A region whose values are all NaN for a
+#   patient is absent for that patient.
+#
+#   Two kinds of cubes are used
+#     'timeseries': the output of stages 1 to 3
+#     'clearance':  the output of stages 4 and 4b.  There is
+#                   a single `timepoint' (the clearance) and
+#                   the extra array `modeltype' holds an index
+#                   into the model names of the cube (-1 for
+#                   absent regions)
+#
+#   Arrays are read with numpy memory maps, so reading a cube
+#   does not copy or parse any data.  exportCSV() writes a
+#   cube back to the per-patient CSV layout of the pipeline.
+#
+#   Usage (CSV export):
+#       python3 cohortcube.py <cube directory> <csv output directory>
+#
+#  Authors:
+#  ================================================
+#       Georgia S. Brennan      brennan@maths.ox.ac.uk
+#                   ----
+#       Travis B. Thompson      thompsont@maths.ox.ac.uk
+#                   ----
+#       Marie E. Rognes         meg@simula.no
+#                   ----
+#       Vegard Vinje            vegard@simula.no
+#                   ----
+#       Alain Goriely           goriely@maths.ox.ac.uk
+# ---------------------------------------------------------
+
+import os
+import csv
+import sys
+import json
+import shutil
+
+import numpy as np
+
+
+# the cube directory used in place of a stage directory
+# (e.g. ./reformatted-data/2-dropped-fields/ ->
+#       ./reformatted-data/2-dropped-fields.cube/)
+def cubePath(directory):
+    return directory.rstrip('/') + '.cube/'
+
+
+class cohortcube:
+
+    # open the cube stored in the directory `path'.  Arrays are
+    # memory-mapped read-only.
+    def __init__(self, path):
+        self.path = path
+
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+        self.kind = self.meta['kind']
+        self.modelnames = self.meta.get('modelnames', [])
+
+        self.patients = [int(p) for p in readLines(os.path.join(path, 'patients.txt'))]
+        self.regions = readLines(os.path.join(path, 'regions.txt'))
+
+        self.values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+        self.times = np.load(os.path.join(path, 'times.npy'), mmap_mode='r')
+
+        self.__patientndx = {self.patients[i]: i for i in range(len(self.patients))}
+        self.__arrays = {}
+
+    # an extra (patients x regions) array stored in the cube
+    def getArray(self, name):
+        if name not in self.__arrays:
+            self.__arrays[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+        return self.__arrays[name]
+
+    def getPatientIndex(self, pid):
+        return self.__patientndx[pid]
+
+    # the (patients x regions) mask of the regions present in
+    # the data of every patient, including regions whose values
+    # are all missing (NaN).  Cubes written without the
+    # `present' extra fall back to the regions with a value.
+    def getPresence(self):
+        if os.path.exists(os.path.join(self.path, 'present.npy')):
+            return self.getArray('present')
+        return ~np.all(np.isnan(self.values), axis=-1)
+
+    # the times (without padding), the indices of the regions
+    # present and the (regions present x times) values of a
+    # single patient
+    def getPatient(self, pid):
+        i = self.__patientndx[pid]
+
+        ntimes = int(np.sum(np.isfinite(self.times[i])))
+        times = self.times[i, :ntimes]
+        present = np.flatnonzero(self.getPresence()[i])
+
+        return times, present, self.values[i][present, :ntimes]
+
+
+def readLines(path):
+    with open(path) as f:
+        return [l.rstrip('\n') for l in f]
+
+
+def writeLines(path, lines):
+    with open(path, mode='w') as f:
+        for l in lines:
+            f.write(str(l) + '\n')
+
+
+# ---------------------------------------------------------
+# Write a cube to the directory `path' (any existing cube
+# at this path is replaced).
+#
+#   patients: list of patient IDs
+#   regions:  list of region names
+#   times:    (patients x timepoints) array
+#   values:   (patients x regions x timepoints) array
+#   [optional] kind: 'timeseries' or 'clearance'
+#   [optional] extras: dictionary name -> (patients x regions) array
+#   [optional] modelnames: names indexed by the `modeltype' extra
+# ---------------------------------------------------------
+def writeCube(path, patients, regions, times, values, kind='timeseries', extras=None, modelnames=None):
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    times = np.asarray(times, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+
+    np.save(os.path.join(path, 'values.npy'), values)
+    np.save(os.path.join(path, 'times.npy'), times)
+
+    writeLines(os.path.join(path, 'patients.txt'), patients)
+    writeLines(os.path.join(path, 'regions.txt'), regions)
+
+    if extras is not None:
+        for name in extras:
+            np.save(os.path.join(path, name + '.npy'), np.asarray(extras[name]))
+
+    meta = {'kind': kind}
+    if modelnames is not None:
+        meta['modelnames'] = list(modelnames)
+
+    with open(os.path.join(path, 'meta.json'), mode='w') as f:
+        json.dump(meta, f, indent=1)
+
+
+# ---------------------------------------------------------
+# Build and write a timeseries cube from per-patient data.
+#
+#   records: list of (patient id, region names, times,
+#            (regions x times) values) tuples
+#
+# The regions of the cube are the union of the patient
+# regions in order of first appearance.  The regions of
+# every patient are kept in the `present' extra (see
+# cohortcube.getPresence), so that a region whose values are
+# all missing is not confused with an absent region.
+# ---------------------------------------------------------
+def buildCube(path, records):
+    regionndx = {}
+    for pid, regions, times, values in records:
+        for r in regions:
+            if r not in regionndx:
+                regionndx[r] = len(regionndx)
+
+    ntimes = max([len(rec[2]) for rec in records] + [0])
+
+    ctimes = np.full((len(records), ntimes), np.nan)
+    cvalues = np.full((len(records), len(regionndx), ntimes), np.nan)
+    present = np.zeros((len(records), len(regionndx)), dtype=bool)
+
+    for i in range(len(records)):
+        pid, regions, times, values = records[i]
+        rows = [regionndx[r] for r in regions]
+
+        ctimes[i, :len(times)] = times
+        cvalues[i, rows, :len(times)] = values
+        present[i, rows] = True
+
+    writeCube(path, [rec[0] for rec in records], list(regionndx.keys()), ctimes, cvalues, extras={'present': present})
+
+
+# ---------------------------------------------------------
+# Write every patient of a cube to `outdir'/<patient id>.csv
+# in the CSV layout used by the pipeline stages
+#
+#   timeseries: StructName, time, time, ...
+#   clearance:  StructName, Clearance, Model Type
+# ---------------------------------------------------------
+def exportCSV(cube, outdir):
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    for pid in cube.patients:
+        csvout = os.path.join(outdir, str(pid) + '.csv')
+
+        with open(csvout, mode='w') as outcsv:
+            csv_writer = csv.writer(outcsv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+
+            if cube.kind == 'clearance':
+                i = cube.getPatientIndex(pid)
+                modeltype = cube.getArray('modeltype')[i]
+
+                csv_writer.writerow(['StructName'] + ['Clearance', 'Model Type'])
+                for r in np.flatnonzero(modeltype >= 0):
+                    csv_writer.writerow([cube.regions[r], float(cube.values[i, r, 0]), cube.modelnames[modeltype[r]]])
+            else:
+                times, present, values = cube.getPatient(pid)
+
+                csv_writer.writerow(['StructName'] + times.tolist())
+                for j in range(len(present)):
+                    csv_writer.writerow([cube.regions[present[j]]] + values[j].tolist())
+
+
+# ---------------------------------------------------------
+# (regions x patients) pandas DataFrame of a clearance cube
+# with a leading `roi' column, i.e. the layout assembled
+# from the per-patient clearance maps in the analysis
+# notebook
+# ---------------------------------------------------------
+def clearanceFrame(cube):
+    import pandas as pd
+
+    frame = pd.DataFrame({'roi': cube.regions})
+    for i in range(len(cube.patients)):
+        frame[str(cube.patients[i])] = cube.values[i, :, 0]
+
+    return frame
+
+
+# Execution starts here
+if __name__ == "__main__":
+
+    if len(sys.argv) != 3:
+        print("usage: python3 cohortcube.py <cube directory> <csv output directory>")
+        sys.exit()
+
+    exportCSV(cohortcube(sys.argv[1]), sys.argv[2])
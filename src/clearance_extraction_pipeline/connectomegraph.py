@@ -0,0 +1,253 @@
+# --------------------------------------------------------
+#
+#  ***Oxford Mathematical Brain Modeling Group***
+#
+#   Streaming GraphML reader for the connectome graphs
+#   (master-std33.graphml, master-std500.graphml, ...) with
+#   a binary cache.
+#
+#   The graph is read with a single iterparse pass straight
+#   into struct-of-arrays buffers:
+#
+#     nodeids        int64   (nodes)
+#     coords         float64 (nodes x 3)  dn_position_x/y/z
+#     regions        list of str          dn_region
+#     fsnames        list of str          dn_fsname
+#     hemispheres    list of str          dn_hemisphere
+#     edgesource     int64   (edges)      source node id
+#     edgetarget     int64   (edges)      target node id
+#     fibercount     float64 (edges)      number_of_fibers
+#     fiberlength    float64 (edges)      fiber_length_mean
+#     famean         float64 (edges)      FA_mean
+#
+#   Data fields are identified through the <key> declarations
+#   of the file (attr.name).  Missing edge values are 0 (FA:
+#   NaN), as in the original connectome parser.
+#
+#   The arrays are cached in the directory
+#       <graphml file>.cache/v<cache version>-<sha256 of the graphml file>/
+#   and later loads of an unchanged file memory-map the
+#   cache instead of parsing the XML.
+#
+#  Authors:
+#  ================================================
+#       Georgia S. Brennan      brennan@maths.ox.ac.uk
+#                   ----
+#       Travis B. Thompson      thompsont@maths.ox.ac.uk
+#                   ----
+#       Marie E. Rognes         meg@simula.no
+#                   ----
+#       Vegard Vinje            vegard@simula.no
+#                   ----
+#       Alain Goriely           goriely@maths.ox.ac.uk
+# ---------------------------------------------------------
+
+import os
+import shutil
+import tempfile
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from pipelinemanifest import fileHash
+
+
+# GraphML attribute names of the fields that are read, and the
+# key ids used by the connectome files when a file does not
+# declare its keys
+nodefields = {'dn_position_x': 'd0', 'dn_position_y': 'd1', 'dn_position_z': 'd2',
+              'dn_region': 'd4', 'dn_fsname': 'd5', 'dn_hemisphere': 'd7'}
+edgefields = {'number_of_fibers': 'd9', 'FA_mean': 'd10', 'fiber_length_mean': 'd12'}
+
+# bump when the layout of the cache changes
+cacheversion = 1
+
+numericarrays = ['nodeids', 'coords', 'edgesource', 'edgetarget', 'fibercount', 'fiberlength', 'famean']
+stringlists = ['regions', 'fsnames', 'hemispheres']
+
+
+class connectomeArrays:
+
+    def __init__(self, nodeids, coords, regions, fsnames, hemispheres,
+                 edgesource, edgetarget, fibercount, fiberlength, famean):
+        self.nodeids = nodeids
+        self.coords = coords
+        self.regions = regions
+        self.fsnames = fsnames
+        self.hemispheres = hemispheres
+
+        self.edgesource = edgesource
+        self.edgetarget = edgetarget
+        self.fibercount = fibercount
+        self.fiberlength = fiberlength
+        self.famean = famean
+
+    def getNodeCount(self):
+        return len(self.nodeids)
+
+    def getEdgeCount(self):
+        return len(self.edgesource)
+
+
+def localName(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+# ---------------------------------------------------------
+# Parse a GraphML connectome in a single streaming pass.
+# Elements are discarded as soon as they are read, so the
+# XML tree is never held in memory.
+# ---------------------------------------------------------
+def parseGraphML(path):
+    # key id -> field name, defaults for files without <key>s
+    nodekeys = {v: k for k, v in nodefields.items()}
+    edgekeys = {v: k for k, v in edgefields.items()}
+    declared = False
+
+    nodeids = []
+    coords = []
+    regions = []
+    fsnames = []
+    hemispheres = []
+
+    edgesource = []
+    edgetarget = []
+    fibercount = []
+    fiberlength = []
+    famean = []
+
+    graph = None
+
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        tag = localName(elem.tag)
+
+        if event == 'start':
+            if tag == 'graph':
+                graph = elem
+            continue
+
+        if tag == 'key':
+            if not declared:
+                nodekeys = {}
+                edgekeys = {}
+                declared = True
+
+            name = elem.get('attr.name')
+            if elem.get('for') == 'node' and name in nodefields:
+                nodekeys[elem.get('id')] = name
+            elif elem.get('for') == 'edge' and name in edgefields:
+                edgekeys[elem.get('id')] = name
+
+        elif tag == 'node':
+            values = {}
+            for dat in elem:
+                key = dat.get('key', '').strip()
+                if key in nodekeys:
+                    values[nodekeys[key]] = dat.text
+
+            nodeids.append(int(elem.get('id')))
+            coords.append([float(values.get('dn_position_x', 0.0)),
+                           float(values.get('dn_position_y', 0.0)),
+                           float(values.get('dn_position_z', 0.0))])
+            regions.append(values.get('dn_region', '') or '')
+            fsnames.append(values.get('dn_fsname', '') or '')
+            hemispheres.append(values.get('dn_hemisphere', '') or '')
+
+        elif tag == 'edge':
+            values = {}
+            for dat in elem:
+                key = dat.get('key', '').strip()
+                if key in edgekeys:
+                    values[edgekeys[key]] = dat.text
+
+            edgesource.append(int(elem.get('source')))
+            edgetarget.append(int(elem.get('target')))
+            fibercount.append(float(values.get('number_of_fibers', 0.0)))
+            fiberlength.append(float(values.get('fiber_length_mean', 0.0)))
+            famean.append(float(values.get('FA_mean', np.nan)))
+
+        else:
+            continue
+
+        # discard the element (and its children) once it is read
+        elem.clear()
+        if graph is not None and tag in ('node', 'edge'):
+            del graph[:]
+
+    return connectomeArrays(np.asarray(nodeids, dtype=np.int64),
+                            np.asarray(coords, dtype=np.float64).reshape(-1, 3),
+                            regions, fsnames, hemispheres,
+                            np.asarray(edgesource, dtype=np.int64),
+                            np.asarray(edgetarget, dtype=np.int64),
+                            np.asarray(fibercount, dtype=np.float64),
+                            np.asarray(fiberlength, dtype=np.float64),
+                            np.asarray(famean, dtype=np.float64))
+
+
+# the cache directory of a graphml file with content hash `digest'
+def cachePath(path, digest):
+    return os.path.join(path + '.cache', f"v{cacheversion}-{digest}")
+
+
+def readCache(cachedir):
+    arrays = {name: np.load(os.path.join(cachedir, name + '.npy'), mmap_mode='r') for name in numericarrays}
+
+    for name in stringlists:
+        with open(os.path.join(cachedir, name + '.txt')) as f:
+            arrays[name] = [l.rstrip('\n') for l in f]
+
+    return connectomeArrays(**arrays)
+
+
+# Write the cache atomically: the arrays are written to a
+# temporary directory that is then renamed
+def writeCache(cachedir, graph):
+    parent = os.path.dirname(cachedir)
+    os.makedirs(parent, exist_ok=True)
+
+    tmpdir = tempfile.mkdtemp(dir=parent)
+    try:
+        for name in numericarrays:
+            np.save(os.path.join(tmpdir, name + '.npy'), getattr(graph, name))
+
+        for name in stringlists:
+            with open(os.path.join(tmpdir, name + '.txt'), mode='w') as f:
+                for s in getattr(graph, name):
+                    f.write(s + '\n')
+
+        os.replace(tmpdir, cachedir)
+    except OSError:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        if not os.path.exists(cachedir):
+            raise
+
+    # caches of earlier versions of the file are no longer needed
+    for entry in os.listdir(parent):
+        stale = os.path.join(parent, entry)
+        if stale != cachedir and entry.startswith('v') and os.path.isdir(stale):
+            shutil.rmtree(stale, ignore_errors=True)
+
+
+# ---------------------------------------------------------
+# Load a GraphML connectome, from the binary cache if the
+# file has been read before.
+#
+# [optional] cache: False to always parse the XML (and not
+#   write a cache)
+# ---------------------------------------------------------
+def loadConnectome(path, cache=True):
+    if not cache:
+        return parseGraphML(path)
+
+    cachedir = cachePath(path, fileHash(path))
+    if os.path.exists(cachedir):
+        return readCache(cachedir)
+
+    graph = parseGraphML(path)
+
+    try:
+        writeCache(cachedir, graph)
+    except OSError as err:
+        print(f"[WARNING] Could not write the connectome cache {cachedir}: {err}")
+
+    return graph
@@ -0,0 +1,175 @@
+# --------------------------------------------------------
+#
+#  ***Oxford Mathematical Brain Modeling Group***
+#
+#   Stage manifests for incremental re-runs of the clearance
+#   pipeline.
+#
+#   A manifest records, for every output of a stage, a content
+#   hash (signature) of the input files it was computed from
+#   together with the files that were written.  The manifest
+#   also stores a hash of the stage configuration (e.g. the
+#   dropped and renamed fields, the time windows or the
+#   connectome).  When a stage is re-run
+#
+#     - a patient whose inputs and outputs are unchanged is
+#       skipped,
+#     - the outputs of patients whose input file was deleted
+#       are removed,
+#     - every patient is reprocessed (and the output directory
+#       is cleared) if the configuration changed, the manifest
+#       is missing or `--force' is given.
+#
+#   Manifests are only used with CSV intermediates; a cohort
+#   cube (--intermediate cube) is always rebuilt as a whole.
+#
+#  Authors:
+#  ================================================
+#       Georgia S. Brennan      brennan@maths.ox.ac.uk
+#                   ----
+#       Travis B. Thompson      thompsont@maths.ox.ac.uk
+#                   ----
+#       Marie E. Rognes         meg@simula.no
+#                   ----
+#       Vegard Vinje            vegard@simula.no
+#                   ----
+#       Alain Goriely           goriely@maths.ox.ac.uk
+# ---------------------------------------------------------
+
+import os
+import json
+import shutil
+import hashlib
+
+
+# the manifest file kept next to a stage directory
+# (e.g. ./reformatted-data/2-dropped-fields/ ->
+#       ./reformatted-data/2-dropped-fields.manifest.json)
+def manifestPath(directory):
+    return directory.rstrip('/') + '.manifest.json'
+
+
+# sha256 of the content of a file
+def fileHash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+# sha256 of a JSON serializable value (e.g. a configuration
+# dictionary)
+def valueHash(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+class manifest:
+
+    # open the manifest stored at `path' for a stage with the
+    # configuration `config' (a JSON serializable value).  If
+    # the stored configuration differs, or `force' is True, the
+    # manifest starts out empty.
+    def __init__(self, path, config, force=False):
+        self.path = path
+        self.config = valueHash(config)
+        self.entries = {}
+        self.isFresh = True
+
+        if not force and os.path.exists(path):
+            with open(path) as f:
+                stored = json.load(f)
+
+            if stored.get('config') == self.config:
+                self.entries = stored.get('entries', {})
+                self.isFresh = False
+
+    # The signature of a task: the content hashes of its input
+    # files and of any extra (JSON serializable) value the
+    # output depends on, such as normalization values
+    def signature(self, inputs, extra=None):
+        return valueHash({'inputs': [fileHash(p) for p in inputs], 'extra': extra})
+
+    # True if `key' was produced from inputs with signature
+    # `signature' and all of its outputs still exist
+    def isCurrent(self, key, signature):
+        if key not in self.entries:
+            return False
+
+        entry = self.entries[key]
+        return entry['signature'] == signature and all(os.path.exists(o) for o in entry['outputs'])
+
+    # record that `key' was produced from inputs with signature
+    # `signature'.  Only the files of `outputs' that exist are
+    # recorded (a stage may not write an output for a patient,
+    # e.g. a patient without the three culled timepoints).
+    def update(self, key, signature, outputs):
+        self.entries[key] = {'signature': signature, 'outputs': [o for o in outputs if os.path.exists(o)]}
+
+    # remove the outputs recorded for `key' (before it is
+    # recomputed) and its entry
+    def removeOutputs(self, key):
+        if key in self.entries:
+            for o in self.entries[key]['outputs']:
+                if os.path.exists(o):
+                    os.remove(o)
+            del self.entries[key]
+
+    # remove the outputs (and entries) of every key that is not
+    # in `keys'.  Returns the removed keys.
+    def removeStale(self, keys):
+        keys = set(keys)
+        stale = [k for k in self.entries if k not in keys]
+
+        for k in stale:
+            print(f"Removing the outputs of {k} (input no longer present)")
+            self.removeOutputs(k)
+
+        return stale
+
+    def write(self):
+        with open(self.path, mode='w') as f:
+            json.dump({'config': self.config, 'entries': self.entries}, f, indent=1, sort_keys=True)
+
+
+# ---------------------------------------------------------
+# Open the manifest of a stage writing to the directories
+# `outputdirs' and prepare the directories.  If every patient
+# has to be reprocessed the directories are cleared, as the
+# stages did before manifests were introduced; otherwise
+# they are created if missing.
+# ---------------------------------------------------------
+def openStageManifest(path, config, outputdirs, force=False):
+    m = manifest(path, config, force=force)
+
+    for d in outputdirs:
+        if m.isFresh and os.path.exists(d):
+            shutil.rmtree(d)
+        if not os.path.exists(d):
+            os.makedirs(d)
+
+    return m
+
+
+# ---------------------------------------------------------
+# Split `tasks' into those that have to be (re)computed and
+# those that are current.  `key' and `signature' map a task
+# to its manifest key and input signature.  The previous
+# outputs of the stale tasks are removed.  Returns the list
+# of (task, key, signature) to compute.
+# ---------------------------------------------------------
+def staleTasks(m, tasks, key, signature):
+    stale = []
+    nskipped = 0
+
+    for task in tasks:
+        k = key(task)
+        s = signature(task)
+        if m.isCurrent(k, s):
+            nskipped += 1
+        else:
+            m.removeOutputs(k)
+            stale.append((task, k, s))
+
+    print(f"{len(stale)} patients to process, {nskipped} unchanged patients skipped")
+    return stale
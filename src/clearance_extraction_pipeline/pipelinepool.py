@@ -0,0 +1,153 @@
+# --------------------------------------------------------
+#
+#  ***Oxford Mathematical Brain Modeling Group***
+#
+#   Shared helpers for running the per-patient work of a
+#   clearance pipeline stage on a pool of processes.
+#
+#   Every stage accepts a `--jobs N' command line option
+#   (and the `--intermediate' format option, see cohortcube.py,
+#   and the `--force' option, see pipelinemanifest.py).
+#   With N = 1 (the default) patients are processed one
+#   after another in the calling process, exactly as
+#   before.  With N > 1 the patients are fanned out to a
+#   pool of N worker processes.  Results are always
+#   collected in the order of the input list and every
+#   patient writes its own output file, so the output of
+#   a parallel run is byte-identical to a serial run.
+#
+#  Authors:
+#  ================================================
+#       Georgia S. Brennan      brennan@maths.ox.ac.uk
+#                   ----
+#       Travis B. Thompson      thompsont@maths.ox.ac.uk
+#                   ----
+#       Marie E. Rognes         meg@simula.no
+#                   ----
+#       Vegard Vinje            vegard@simula.no
+#                   ----
+#       Alain Goriely           goriely@maths.ox.ac.uk
+# ---------------------------------------------------------
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+# ---------------------------------------------------------
+# Build the command line parser shared by all stages and
+# parse the arguments.  Stage specific options can be added
+# by passing a function that receives the parser.
+# ---------------------------------------------------------
+def parseStageArguments(description, addoptions=None):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of worker processes used for the per-patient work (default: 1)')
+    parser.add_argument('--intermediate', choices=['csv', 'cube'], default='csv',
+                        help='format of the files passed between stages: one CSV file per patient (default) '
+                             'or a memory-mappable cohort cube (see cohortcube.py)')
+    parser.add_argument('--force', action='store_true',
+                        help='reprocess every patient, even those whose inputs and configuration are unchanged '
+                             '(see pipelinemanifest.py)')
+
+    if addoptions is not None:
+        addoptions(parser)
+
+    args = parser.parse_args()
+
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    return args
+
+
+# ---------------------------------------------------------
+# Apply `func' to every item of `items' and return the
+# results in the order of `items'.
+#
+# [optional] initializer, initargs: called once in every
+#   worker process (and once in the calling process for a
+#   serial run) before any item is processed.  Use this to
+#   set up expensive read-only state such as a connectome.
+# ---------------------------------------------------------
+def mapPatients(func, items, jobs=1, initializer=None, initargs=()):
+    items = list(items)
+
+    if jobs <= 1 or len(items) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        return [func(item) for item in items]
+
+    nworkers = min(jobs, len(items))
+    pool = ProcessPoolExecutor(max_workers=nworkers, initializer=initializer, initargs=initargs)
+    try:
+        results = list(pool.map(func, items))
+    except BaseException:
+        terminatePool(pool)
+        raise
+
+    pool.shutdown(wait=True)
+    return results
+
+
+# ---------------------------------------------------------
+# As mapPatients, but yield (index, result) pairs as soon as
+# every item is done (in order of completion for a parallel
+# run), so results can be written while the remaining items
+# are still being processed.  If the consumer stops early
+# (e.g. on KeyboardInterrupt, which may be sent to the
+# calling process only) the pending items are cancelled and
+# the worker processes are terminated.
+# ---------------------------------------------------------
+def streamPatients(func, items, jobs=1, initializer=None, initargs=()):
+    items = list(items)
+
+    if jobs <= 1 or len(items) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for i in range(len(items)):
+            yield i, func(items[i])
+        return
+
+    nworkers = min(jobs, len(items))
+    pool = ProcessPoolExecutor(max_workers=nworkers, initializer=initializer, initargs=initargs)
+    finished = False
+    try:
+        futures = {pool.submit(func, items[i]): i for i in range(len(items))}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+        finished = True
+    finally:
+        if finished:
+            pool.shutdown(wait=True)
+        else:
+            terminatePool(pool)
+
+
+# Stop a pool without waiting for its items: cancel the
+# pending items and terminate the worker processes, which
+# may be busy or blocked waiting for work
+def terminatePool(pool):
+    workers = list((pool._processes or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+
+    for process in workers:
+        if process.is_alive():
+            process.terminate()
+    for process in workers:
+        process.join()
+
+
+# Split a list into at most `nchunks' contiguous chunks of
+# (nearly) equal size, preserving the order of the items
+def chunkList(items, nchunks):
+    items = list(items)
+    nchunks = max(1, min(nchunks, len(items)))
+
+    chunks = []
+    start = 0
+    for c in range(nchunks):
+        size = len(items) // nchunks + (1 if c < len(items) % nchunks else 0)
+        chunks.append(items[start:start + size])
+        start += size
+
+    return chunks
@@ -15,9 +15,16 @@
 # Alain Goriely		(goriely@maths.ox.ac.uk)
 #----------------------------------------------------------
 
-python3 ./1-extract-field.py
-python3 ./2-drop-and-replace.py
-python3 ./3-cull-data.py
-python3 ./4-compute-clearance.py
-python3 ./4b-average-computed-clearance.py
+# number of worker processes used by every stage (e.g. ./runall.sh 32)
+JOBS=${1:-1}
 
+python3 ./1-extract-field.py --jobs $JOBS
+python3 ./2-drop-and-replace.py --jobs $JOBS
+python3 ./3-cull-data.py --jobs $JOBS
+python3 ./4-compute-clearance.py --jobs $JOBS
+python3 ./4b-average-computed-clearance.py --jobs $JOBS
+
+
+# The same pipeline can be run in a single process, without writing
+# the intermediate files of steps 1 to 4, with
+#   python3 ./runpipeline.py [--write-intermediate]
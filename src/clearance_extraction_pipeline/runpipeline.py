@@ -0,0 +1,248 @@
+# --------------------------------------------------------
+#
+#  ***Oxford Mathematical Brain Modeling Group***
+#
+#   Fused, in-memory runner for the clearance pipeline.
+#
+#   Runs extract -> drop/rename -> cull -> fit -> neighbor
+#   average (the scripts 1-extract-field.py to
+#   4b-average-computed-clearance.py) in a single process as
+#   a chain of generators over the patients.  Every patient
+#   is handed from one stage to the next in memory; only the
+#   final (averaged) clearance files are written, to the same
+#   directories as 4b-average-computed-clearance.py.
+#
+#   The configuration (directories, dropped and renamed
+#   fields, fitting mode, connectome, ...) is the one of the
+#   individual stage scripts.  With --write-intermediate the
+#   per-patient CSV files of stages 1 to 4 are also written
+#   (to the usual stage directories) for debugging; these are
+#   identical to the files written by runall.sh.
+#
+#   Usage:
+#       python3 runpipeline.py [--write-intermediate] [--batch-size N]
+#
+#  Authors:
+#  ================================================
+#       Georgia S. Brennan      brennan@maths.ox.ac.uk
+#                   ----
+#       Travis B. Thompson      thompsont@maths.ox.ac.uk
+#                   ----
+#       Marie E. Rognes         meg@simula.no
+#                   ----
+#       Vegard Vinje            vegard@simula.no
+#                   ----
+#       Alain Goriely           goriely@maths.ox.ac.uk
+# ---------------------------------------------------------
+
+import os
+import csv
+import sys
+import shutil
+import argparse
+import importlib
+
+import numpy as np
+
+import clearancefit
+
+# the stage scripts (their file names are not valid module names)
+extract = importlib.import_module('1-extract-field')
+dropreplace = importlib.import_module('2-drop-and-replace')
+cull = importlib.import_module('3-cull-data')
+fit = importlib.import_module('4-compute-clearance')
+average = importlib.import_module('4b-average-computed-clearance')
+
+
+# Write a (regions x times) patient record in the CSV layout
+# of stages 2 and 3
+def writeTimeseriesCSV(csvout, regions, times, values):
+    with open(csvout, mode='w') as outcsv:
+        csv_writer = csv.writer(outcsv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+
+        csv_writer.writerow(['StructName'] + list(times))
+        for i in range(len(regions)):
+            csv_writer.writerow([regions[i]] + values[i].tolist())
+
+
+# ---------------------------------------------------------
+# The stages.  Every stage consumes and yields patient
+# records (patient id, region names, times, values); the fit
+# stage yields (patient id, region names, clearance, model
+# type names) records.  When `write' is True a stage also
+# writes its output files.
+# ---------------------------------------------------------
+
+# 1: read and normalize the raw patient files
+def extractStage(tasks, write=False):
+    fielddirs = extract.fieldOutputDirectories()
+
+    for task in tasks:
+        p = extract.readPatient(task)
+
+        if write:
+            for field in extract.datafields:
+                p.writedata(fielddirs[field], field=field)
+
+        yield p.getID(), p.regions, p.timevals, p.getFieldData(p.extractval)
+
+
+# 2: drop and rename the anatomical fields
+def dropStage(records, write=False):
+    for pid, regions, times, values in records:
+        rows = [i for i in range(len(regions)) if regions[i] in dropreplace.rename]
+        newnames = [dropreplace.rename[regions[i]] for i in rows]
+
+        if write:
+            writeTimeseriesCSV(dropreplace.outputdirectory + str(pid) + ".csv", newnames, times, values[rows])
+
+        yield pid, newnames, times, values[rows]
+
+
+# 3: keep the ~24 hour, ~48 hour and ~30 day measurements of
+#    the patients that have all three
+def cullStage(records, write=False):
+    for pid, regions, times, values in records:
+        print(f"Processing patient {pid}")
+
+        cols = cull.patient(pid).selectTimes(times)
+        if cols is None:
+            continue
+
+        ctimes = [times[c] for c in cols]
+        cvalues = values[:, cols]
+
+        if write:
+            writeTimeseriesCSV(cull.outputdirectory + str(pid) + ".csv", regions, ctimes, cvalues)
+
+        yield pid, regions, ctimes, cvalues
+
+
+# 4: fit the clearance of every region.  Patients are
+#    collected in batches of `batchsize' and every batch is
+#    fitted in a single batched pass.
+def fitStage(records, batchsize, write=False):
+    batch = []
+
+    def fitBatch(batch):
+        if fit.fitmode == 'all-timepoints':
+            ntimes = max(len(rec[2]) for rec in batch)
+            tcells = np.concatenate([np.broadcast_to(np.pad(np.asarray(rec[2], dtype=np.float64), (0, ntimes - len(rec[2]))),
+                                                     (len(rec[1]), ntimes)) for rec in batch])
+            ycells = np.concatenate([np.pad(rec[3], ((0, 0), (0, ntimes - len(rec[2])))) for rec in batch])
+            mask = np.concatenate([np.broadcast_to(np.arange(ntimes) < len(rec[2]), (len(rec[1]), ntimes)) for rec in batch])
+
+            clearance, modeltype, relmse, params = clearancefit.fitClearanceAllTimepoints(tcells, ycells, mask)
+        else:
+            xcells = np.concatenate([np.broadcast_to(np.asarray(rec[2], dtype=np.float64), (len(rec[1]), 3)) for rec in batch])
+            ycells = np.concatenate([rec[3] for rec in batch])
+
+            clearance, modeltype, degenerate = fit.fitCells(xcells, ycells, verify=fit.verifyfits)
+
+        start = 0
+        for pid, regions, times, values in batch:
+            stop = start + len(regions)
+            modelnames = [clearancefit.modelnames[m] for m in modeltype[start:stop]]
+            pclearance = [float(c) for c in clearance[start:stop]]
+
+            if write:
+                fit.writeClearanceCSV(fit.outputdirectory + str(pid) + ".csv",
+                                      dict(zip(regions, pclearance)), dict(zip(regions, modelnames)))
+
+            yield pid, regions, pclearance, modelnames
+            start = stop
+
+    for record in records:
+        batch.append(record)
+        if len(batch) == batchsize:
+            yield from fitBatch(batch)
+            batch = []
+
+    if len(batch) > 0:
+        yield from fitBatch(batch)
+
+
+# 4b: replace the linear model clearances by averages over
+#     neighboring regions and write the final files.  Every
+#     batch of `batchsize' patients is repaired at once.
+def averageStage(records, batchsize, outdirProximity, outdirConnectivity):
+    batch = []
+
+    def averageBatch(batch):
+        subjs = [str(rec[0]) + ".csv" for rec in batch]
+
+        clearance, valid = average.loadCohortClearance(batch, lambda c, rec: average.loadClearanceValues(c, rec[1], rec[2], rec[3]))
+        proximity, connectivity = average.repairCohortClearance(clearance, valid, subjs)
+
+        names, nodeclearance, nodevalid = average.objConnectome.getClearanceArrays()
+        for k in range(len(batch)):
+            average.writeClearanceArraysToCSV(outdirProximity + f"/{subjs[k]}", names, proximity[:, k], valid[:, k])
+            average.writeClearanceArraysToCSV(outdirConnectivity + f"/{subjs[k]}", names, connectivity[:, k], valid[:, k])
+
+            yield batch[k][0]
+
+    for record in records:
+        batch.append(record)
+        if len(batch) == batchsize:
+            yield from averageBatch(batch)
+            batch = []
+
+    if len(batch) > 0:
+        yield from averageBatch(batch)
+
+
+# Execution starts here
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Run the whole clearance pipeline in a single process")
+    parser.add_argument('--write-intermediate', action='store_true',
+                        help='also write the per-patient files of stages 1 to 4 (for debugging)')
+    parser.add_argument('--batch-size', type=int, default=64,
+                        help='number of patients fitted (and averaged) in one batched pass (default: 64)')
+    args = parser.parse_args()
+
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+
+    if not os.path.exists(extract.patientinputdirectory):
+        print(f"The relative (to this script) input directory {extract.patientinputdirectory} does not exist")
+        sys.exit()
+
+    # clear any existing files and remake the output directories
+    # (as 1-extract-field.py does)
+    if os.path.exists(extract.outputroot):
+        shutil.rmtree(extract.outputroot)
+    os.mkdir(extract.outputroot)
+
+    if args.write_intermediate:
+        for fielddir in extract.fieldOutputDirectories().values():
+            os.makedirs(fielddir)
+        os.makedirs(dropreplace.outputdirectory)
+        os.makedirs(cull.outputdirectory)
+        os.makedirs(fit.outputdirectory)
+
+    outdirProximity = average.outputdirectoryroot + "proximity-averaged"
+    outdirConnectivity = average.outputdirectoryroot + "connectivity-averaged"
+    os.makedirs(outdirProximity)
+    os.makedirs(outdirConnectivity)
+
+    avgProx, allGrouped, minProximal, maxProximal, avgProximal = average.initConnectome(average.scale33Connectome, average.groupval)
+
+    if allGrouped == False:
+        print(f"[ERROR] The nodal proximity threshold is too low to facilitate clearance averaging by region")
+        sys.exit()
+
+    tasks = extract.findPatientTasks(extract.normalization(extract.normalizationcsv))
+
+    # ----------- Chain the stages --------------------
+    records = extractStage(tasks, write=args.write_intermediate)
+    records = dropStage(records, write=args.write_intermediate)
+    if fit.fitmode != 'all-timepoints':
+        records = cullStage(records, write=args.write_intermediate)
+    records = fitStage(records, args.batch_size, write=args.write_intermediate)
+
+    npatients = 0
+    for pid in averageStage(records, args.batch_size, outdirProximity, outdirConnectivity):
+        npatients += 1
+
+    print(f"{npatients} patients processed")
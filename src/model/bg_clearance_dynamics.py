@@ -19,8 +19,7 @@
 #	GNU GPL V3: https://www.gnu.org/licenses/gpl-3.0.html
 #	-----------------------------------------------
 import matplotlib.pyplot as plt
-from pryon import *
-import pandas as pd
+from bgsolver import solverBG, resultsReader, joinRegionTables
 #=============================================================================
 # PrYon Example Script: Solve a Brennan-Goriely (BG) model problem on a
 #			Brain Connectome Graph with PrYon
@@ -60,24 +59,17 @@ d = dict.fromkeys(labels)
 lambda_0 = d
 
 
-# load the data
-col_names = ['name','BNdata']
+# load the data: the clearance, voxel count and number of nodes of
+# every region, joined by region name
 
 # loop through all patients - here is example for patient 228 only
-data1 = pd.read_csv('228.csv', names=col_names, header=None)
-voxels = pd.read_csv('voxels_allpatients_ascending.csv', names=col_names, header=None)
-numregions = pd.read_csv('nodes_rois_ascending.csv',names=col_names, header=None)
-
-datamatrix = data1.to_numpy()
-weightmatrix = voxels.to_numpy()
-roinodesmatrix = numregions.to_numpy()
+regions, (clearance, voxelcounts, roinodes) = joinRegionTables(['228.csv', 'voxels_allpatients_ascending.csv', 'nodes_rois_ascending.csv'])
 
 # assign lambda_0 values to dict
-for i in range(int(len(datamatrix))):
-	lambda_0[datamatrix[i,0]] = datamatrix[i,1]
+lambda_0.update(zip(regions, clearance))
 
 
-############################ GENERATE STAT FILES ########################################
+############################ GENERATE RESULTS ###########################################
 
 # -- Add output for the global (full connectome) misfolded protein
 #	concentration solver results
@@ -85,7 +77,7 @@ bg.addGlobalResult('Misfolded-Protein-Concentration')
 bg.addGlobalResult('Clearance')
 bg.addGlobalResult('Damage-Percentage')
 
-# -- regional stat files --
+# -- regional results --
 # here is code for misflded protein concentration - can also do 'Clearance' and 'Damage-Percentage' regionally by changing the option
 # ADNI BRAAK REGIONS
 
@@ -128,7 +120,7 @@ bg.addRegionalResult(['cortical.fusiform.right','cortical.temporalpole.right','c
 bg.addRegionalResult(['subcortical.Right-Thalamus-Proper.right','subcortical.Right-Caudate.right','subcortical.Right-Putamen.right','subcortical.Right-Pallidum.right','subcortical.Right-Accumbens-area.right','subcortical.Right-Amygdala.right'],'Misfolded-Protein-Concentration', optionalIdTag='basal')
 
 
-# Generate stat files for each patient for all 83 ROIs:
+# Generate results for each patient for all 83 ROIs:
 
 bg.addRegionalResult(['subcortical.Brain-Stem.left'],'Misfolded-Protein-Concentration', optionalIdTag='subcortical.Brain-Stem.left')
 bg.addRegionalResult(['subcortical.Left-Accumbens-area.left'],'Misfolded-Protein-Concentration', optionalIdTag='subcortical.Left-Accumbens-area.left')
@@ -256,10 +248,9 @@ for x in fields:
 
 ################## ASSIGN REGIONAL INITIAL CLEARANCE AND DIFFUSION CO-EFF ##############################
 
-for i in range(int(len(datamatrix))):
-	bg.setInitialValue('Clearance',datamatrix[i,0],datamatrix[i,1], False)
+bg.setRegionalInitialValues('Clearance', regions, clearance, False)
 
-	bg.setParameter('Diffusion-Coefficient', weightmatrix[i,0], 1e-2*(1.0/float(weightmatrix[i,1]))*(1.0/float(roinodesmatrix[i,1])))
+bg.setRegionalParameters('Diffusion-Coefficient', regions, 1e-2*(1.0/voxelcounts)*(1.0/roinodes))
 
 
 
@@ -288,19 +279,19 @@ bg.solve()
 plt.figure(1)
 
 rglob = resultsReader()
-rglob.loadResults('Brennan-Goriely-Model-Solver-Global-Damage-Percentage.stat')
+rglob.loadResults(bg.getResultsFile(), 'Global-Damage-Percentage')
 globTimes = rglob.readTime()
 globVals  = rglob.readMeanValue()
 plt.plot(globTimes,globVals, label ='Damage')
 
 rglob2 = resultsReader()
-rglob2.loadResults('Brennan-Goriely-Model-Solver-Global-Clearance.stat')
+rglob2.loadResults(bg.getResultsFile(), 'Global-Clearance')
 globTimes2 = rglob2.readTime()
 globVals2  = rglob2.readMeanValue()
 plt.plot(globTimes2,globVals2, label = 'Clearance')
 
 rglob3 = resultsReader()
-rglob3.loadResults('Brennan-Goriely-Model-Solver-Global-Misfolded-Protein-Concentration.stat')
+rglob3.loadResults(bg.getResultsFile(), 'Global-Misfolded-Protein-Concentration')
 globTimes3 = rglob3.readTime()
 globVals3  = rglob3.readMeanValue()
 
@@ -0,0 +1,157 @@
+# --------------------------------------------------------
+#
+#  ***Oxford Mathematical Brain Modeling Group***
+#
+#   Benchmark of the right hand side and Jacobian kernels of
+#   the Brennan-Goriely (BG) model solver: the NumPy
+#   implementation of bgsolver.py against the compiled numba
+#   kernels of bgkernels.py, for a single system and for an
+#   ensemble, on every connectome of `connectomes' that is
+#   present.
+#
+#   For every connectome, ensemble size and backend the table
+#   reports the mean time of a right hand side evaluation, of
+#   a Jacobian evaluation and of a full solve with the
+#   parameters and seeds of bg_clearance_dynamics.py (see
+#   bgstudy.py), and the speedup of the numba kernels.  The
+#   diffusion coefficient is uniform by default since the
+#   region tables of the regional coefficient only cover the
+#   regions of the study connectomes (--diffusion regional
+#   uses them).
+#
+#   Usage:
+#       python3 bgbenchmark.py [--graphml file ...] [--ensemble N] [--repeats N] [--tend T]
+#                              [--diffusion uniform|regional]
+#
+#  Authors:
+#  ================================================
+#       Georgia S. Brennan      brennan@maths.ox.ac.uk
+#                   ----
+#       Travis B. Thompson      thompsont@maths.ox.ac.uk
+#                   ----
+#       Marie E. Rognes         meg@simula.no
+#                   ----
+#       Vegard Vinje            vegard@simula.no
+#                   ----
+#       Alain Goriely           goriely@maths.ox.ac.uk
+# ---------------------------------------------------------
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+import bgkernels
+import bgstudy
+from bgsolver import solverBG
+
+
+# ---------- Configuration ----------
+connectomes = {'scale-33': os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'clearance_extraction_pipeline', 'master-std33.graphml'),
+               'scale-500': 'master-std500.graphml'}
+
+diffusion = 'uniform'
+tolerance = 1e-8
+
+
+# the mean time in seconds of `repeats' calls of `func'
+def timeCalls(func, repeats):
+    func()
+    start = time.perf_counter()
+    for r in range(repeats):
+        func()
+    return (time.perf_counter() - start) / repeats
+
+
+# ---------------------------------------------------------
+# Time the kernels of the backend `backend' on the solver
+# `bg' for `nsystems' stacked systems.  Returns the times of
+# a right hand side and of a Jacobian evaluation and of a
+# solve (of a cohort of `nsystems' random clearance maps if
+# nsystems > 1).
+# ---------------------------------------------------------
+def benchmark(bg, backend, nsystems, repeats):
+    bg.setKernelBackend(backend)
+
+    rng = np.random.default_rng(0)
+    clearance = rng.uniform(0.5, 1.0, (nsystems, bg.nnodes))
+
+    # compile the kernels and prepare the operators of the
+    # stacked system; time them at a representative state
+    if nsystems > 1:
+        bg.solveEnsemble(clearance, fields=[])
+    else:
+        bg.solve()
+    y = np.concatenate([rng.uniform(0.0, 0.5, nsystems * bg.nnodes), clearance.ravel(),
+                        rng.uniform(0.0, 1.0, nsystems * bg.nnodes)])
+
+    trhs = timeCalls(lambda: bg.rhs(0.0, y), repeats)
+    tjac = timeCalls(lambda: bg.jacobian(0.0, y), max(1, repeats // 10))
+
+    start = time.perf_counter()
+    if nsystems > 1:
+        bg.solveEnsemble(clearance, fields=[])
+    else:
+        bg.solve()
+    tsolve = time.perf_counter() - start
+
+    return trhs, tjac, tsolve
+
+
+# Execution starts here
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the NumPy and numba kernels of the BG model solver")
+    parser.add_argument('--graphml', nargs='*', default=None,
+                        help='connectomes to benchmark (default: the scale-33 and scale-500 connectomes)')
+    parser.add_argument('--ensemble', type=int, default=16,
+                        help='number of stacked systems of the ensemble benchmark (default: 16)')
+    parser.add_argument('--repeats', type=int, default=200,
+                        help='number of timed right hand side evaluations (default: 200)')
+    parser.add_argument('--tend', type=float, default=300.0,
+                        help='end time of the timed solves (default: 300)')
+    parser.add_argument('--diffusion', choices=bgstudy.diffusionchoices, default=diffusion,
+                        help=f'diffusion coefficient of the model (see bgstudy.py; default: {diffusion})')
+    args = parser.parse_args()
+
+    regional = None
+    if args.diffusion == 'regional':
+        try:
+            regional = bgstudy.regionalDiffusion()
+        except FileNotFoundError as err:
+            print(f"[ERROR] {err}; use --diffusion uniform for a uniform coefficient")
+            sys.exit()
+
+    if not bgkernels.havenumba:
+        print("[WARNING] numba is not installed: only the NumPy kernels are benchmarked")
+
+    graphs = connectomes if args.graphml is None else {os.path.basename(g): g for g in args.graphml}
+    backends = ['numpy', 'numba'] if bgkernels.havenumba else ['numpy']
+
+    print(f"{'connectome':>16} {'nodes':>6} {'systems':>7} {'backend':>7} {'rhs [us]':>10} {'jacobian [us]':>14} {'solve [s]':>10} {'rhs speedup':>12}")
+    for name, graphml in graphs.items():
+        if not os.path.exists(graphml):
+            print(f"[WARNING] The connectome {graphml} does not exist; {name} is skipped")
+            continue
+
+        bg = solverBG(graphml)
+        bg.setup(0.0, args.tend, args.tend / 10, tolerance)
+        bgstudy.setStudyParameters(bg, args.diffusion, regional)
+        if all(label in bg.regionNodes for label in bgstudy.seeds):
+            bgstudy.setStudyInitialValues(bg)
+        else:
+            print(f"[WARNING] {name} has no seed regions {list(bgstudy.seeds)}; the first node is seeded")
+            seeded = np.zeros(bg.nnodes)
+            seeded[0] = max(bgstudy.seeds.values())
+            bg.setInitialArray('Misfolded-Protein-Concentration', seeded)
+
+        for nsystems in [1, args.ensemble]:
+            reference = None
+            for backend in backends:
+                trhs, tjac, tsolve = benchmark(bg, backend, nsystems, args.repeats)
+                if reference is None:
+                    reference = trhs
+                print(f"{name:>16} {bg.nnodes:>6} {nsystems:>7} {backend:>7} {1e6 * trhs:>10.1f} {1e6 * tjac:>14.1f} "
+                      f"{tsolve:>10.3f} {reference / trhs:>11.1f}x")
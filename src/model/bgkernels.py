@@ -0,0 +1,107 @@
+# --------------------------------------------------------
+#
+#  ***Oxford Mathematical Brain Modeling Group***
+#
+#   Compiled kernels for the right hand side and the Jacobian
+#   of the Brennan-Goriely (BG) model solver (bgsolver.py).
+#
+#   Each kernel is a single loop over the nodes in place of
+#   the sequence of element-wise NumPy operations (and their
+#   temporary arrays) of solverBG.rhs and solverBG.jacobian;
+#   the sparse products -diag(rho) L p and tau D q are left to
+#   SciPy, whose compiled CSR products the loops do not beat:
+#
+#     rhsKernel        the right hand side
+#     jacobianKernel   the values of the Jacobian entries,
+#                      summed directly into the fixed CSC
+#                      pattern computed by the solver
+#
+#   The kernels are compiled with numba, which is optional:
+#   if it is not installed `havenumba' is False and the solver
+#   uses its NumPy implementation.
+#
+#  Authors:
+#  ================================================
+#       Georgia S. Brennan      brennan@maths.ox.ac.uk
+#                   ----
+#       Travis B. Thompson      thompsont@maths.ox.ac.uk
+#                   ----
+#       Marie E. Rognes         meg@simula.no
+#                   ----
+#       Vegard Vinje            vegard@simula.no
+#                   ----
+#       Alain Goriely           goriely@maths.ox.ac.uk
+# ---------------------------------------------------------
+
+try:
+    import numba
+    havenumba = True
+except ImportError:
+    havenumba = False
+
+
+# ---------------------------------------------------------
+# The right hand side of the (stacked) model into `out', with
+# the products Ap = -diag(rho) L p and Tq = tau D q; n is the
+# number of (system, node) pairs.
+# ---------------------------------------------------------
+def rhsKernel(y, n, Ap, Tq, G, mu, alpha, B, laminf, out):
+    for i in range(n):
+        p = y[i]
+        lam = y[n + i]
+        q = y[2*n + i]
+
+        s = B[i] * p + Tq[i]
+        out[i] = Ap[i] + G[i] * (mu[i] - lam) * p - alpha[i] * p * p
+        out[n + i] = -s * (lam - laminf[i])
+        out[2*n + i] = s * (1.0 - q)
+
+    return out
+
+
+# ---------------------------------------------------------
+# The values of the Jacobian in the CSC pattern of the solver
+# into `data' (zeroed here), with the product Tq = tau D q.
+# `position' maps the entries, in the order of
+# solverBG.jacobian, to the pattern: the entries of
+# A = -diag(rho) L, the diagonals of the p, lambda and q rows
+# and the entries (Trows, Tval) of T = tau D in the lambda
+# and q rows.
+# ---------------------------------------------------------
+def jacobianKernel(y, n, Aval, Tq, Trows, Tval, G, mu, alpha, B, laminf, position, data):
+    data[:] = 0.0
+
+    nA = len(Aval)
+    nT = len(Tval)
+
+    k = 0
+    for j in range(nA):
+        data[position[k + j]] += Aval[j]
+    k += nA
+
+    for i in range(n):
+        p = y[i]
+        lam = y[n + i]
+        q = y[2*n + i]
+
+        s = B[i] * p + Tq[i]
+        dlam = lam - laminf[i]
+
+        data[position[k + i]] += G[i] * (mu[i] - lam) - 2.0 * alpha[i] * p
+        data[position[k + n + i]] += -G[i] * p
+        data[position[k + 2*n + i]] += -B[i] * dlam
+        data[position[k + 3*n + i]] += -s
+        data[position[k + 4*n + nT + i]] += B[i] * (1.0 - q)
+        data[position[k + 5*n + 2*nT + i]] += -s
+
+    for j in range(nT):
+        r = Trows[j]
+        data[position[k + 4*n + j]] += -(y[n + r] - laminf[r]) * Tval[j]
+        data[position[k + 5*n + nT + j]] += (1.0 - y[2*n + r]) * Tval[j]
+
+    return data
+
+
+if havenumba:
+    rhsKernel = numba.njit(cache=True)(rhsKernel)
+    jacobianKernel = numba.njit(cache=True)(jacobianKernel)
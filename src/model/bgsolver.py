@@ -0,0 +1,2224 @@
+# --------------------------------------------------------
+#
+#  ***Oxford Mathematical Brain Modeling Group***
+#
+#   Native solver for the Brennan-Goriely (BG) network model
+#   of misfolded protein (tau) propagation with clearance and
+#   damage on a brain connectome.
+#
+#   For every node i of the connectome graph
+#
+#     dp_i/dt = -rho_i (L p)_i + G_i (mu_i - lambda_i) p_i - alpha_i p_i^2
+#     dl_i/dt = -(B_i p_i + tau_i (D q)_i) (lambda_i - lambda_inf_i)
+#     dq_i/dt =  (B_i p_i + tau_i (D q)_i) (1 - q_i)
+#
+#   where p is the misfolded protein concentration, lambda the
+#   clearance and q the damage.  L is the graph Laplacian with
+#   edge weights n/l^2 (number of fibers over the squared mean
+#   fiber length) and (D q)_i is the weighted mean damage of
+#   the graph neighbors of node i (non-local, deafferentation
+#   driven damage).
+#
+#   The parameters (per node):
+#     rho        Diffusion-Coefficient
+#     G          Linear-Growth-Coefficient
+#     mu         Critical-Clearance
+#     alpha      Saturation-Growth-Coefficient
+#     B          Toxic-Degradation-Rate
+#     tau        Nonlocal-Degradation-Rate
+#     lambda_inf Asymptotic-Minimal-Clearance
+#
+#   The interface follows the PrYon solverBG class used by
+#   bg_clearance_dynamics.py (setup, setUniformParameter,
+#   setParameter, setInitialValue, addGlobalResult,
+#   addRegionalResult, solve, ...).  Every parameter and
+#   initial value can also be given as an array with one value
+#   per node.  The right hand side is vectorized, the Jacobian
+#   is assembled analytically as a sparse matrix and the
+#   system is integrated with the stiff (implicit) BDF method
+#   of scipy.  If numba is installed the right hand side and
+#   the Jacobian are evaluated by the compiled kernels of
+#   bgkernels.py (see setKernelBackend).
+#
+#   The long-time (steady) states are computed directly with
+#   Newton's method where the protein persists (decided from
+#   the linearization about the protein free state, or by a
+#   short integration), and followed through a parameter range
+#   by pseudo-arclength continuation (steadyState,
+#   continuation).
+#   The derivatives of the solution with respect to the
+#   parameters and initial values are computed by forward
+#   sensitivity analysis (solveSensitivities) or, for a scalar
+#   output, by a checkpointed adjoint (solveAdjoint).
+#
+#  Authors:
+#  ================================================
+#       Georgia S. Brennan      brennan@maths.ox.ac.uk
+#                   ----
+#       Travis B. Thompson      thompsont@maths.ox.ac.uk
+#                   ----
+#       Marie E. Rognes         meg@simula.no
+#                   ----
+#       Vegard Vinje            vegard@simula.no
+#                   ----
+#       Alain Goriely           goriely@maths.ox.ac.uk
+# ---------------------------------------------------------
+
+import os
+import csv
+import sys
+import glob
+import bisect
+import hashlib
+
+import numpy as np
+from scipy.sparse import csr_matrix, csc_matrix, diags, identity, kron, bmat
+from scipy.sparse.linalg import expm_multiply, spsolve, eigsh
+from scipy.sparse.csgraph import connected_components
+from scipy.linalg import eigh, eigvals
+from scipy.integrate import BDF
+from scipy.optimize import brentq
+
+# the connectome reader is shared with the clearance pipeline
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'clearance_extraction_pipeline'))
+import connectomegraph
+
+import resultstore
+import bgkernels
+
+
+solvername = 'Brennan-Goriely-Model-Solver'
+
+fieldnames = ['Misfolded-Protein-Concentration', 'Clearance', 'Damage-Percentage']
+
+# parameter names and their default (uniform) values
+defaultparameters = {'Asymptotic-Minimal-Clearance': 0.0,
+                     'Critical-Clearance': 1.0,
+                     'Diffusion-Coefficient': 1.0e-2,
+                     'Linear-Growth-Coefficient': 1.0,
+                     'Nonlocal-Degradation-Rate': 0.0,
+                     'Saturation-Growth-Coefficient': 1.0,
+                     'Toxic-Degradation-Rate': 1.0}
+
+# the parameters that the equilibrium protein concentration
+# depends on (see solverBG.continuation)
+equilibriumparameters = ['Asymptotic-Minimal-Clearance', 'Critical-Clearance', 'Diffusion-Coefficient',
+                         'Linear-Growth-Coefficient', 'Saturation-Growth-Coefficient']
+
+# largest equilibrium system whose leading eigenvalue is
+# computed with a dense eigensolver
+denseeigenlimit = 500
+
+# longest integration deciding whether the protein persists or
+# dies out (see solverBG.steadyState)
+settlehorizon = 1.0e6
+
+# region names of the clearance pipeline files that differ from
+# the connectome labels (the pipeline names the brain stem
+# differently, see 4b-average-computed-clearance.py)
+labelaliases = {'subcortical.brainstem.right': 'subcortical.Brain-Stem.left'}
+
+
+# ---------------------------------------------------------
+# Build the graph Laplacian L = diag(W 1) - W and the row
+# normalized adjacency D = diag(W 1)^-1 W (nodes without
+# neighbors have an empty row) of a connectome, where
+# W_ij = sum of n/l^lpow over the edges between i and j.
+# Self loops are ignored.
+# ---------------------------------------------------------
+def buildGraphOperators(graph, lpow=2):
+    nnodes = graph.getNodeCount()
+    position = {int(graph.nodeids[i]): i for i in range(nnodes)}
+
+    src = np.asarray([position[int(n)] for n in graph.edgesource], dtype=np.int64)
+    trg = np.asarray([position[int(n)] for n in graph.edgetarget], dtype=np.int64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = np.asarray(graph.fibercount, dtype=np.float64) / np.power(np.asarray(graph.fiberlength, dtype=np.float64), lpow)
+
+    keep = (src != trg) & np.isfinite(weights)
+    src, trg, weights = src[keep], trg[keep], weights[keep]
+
+    # undirected graph: both directions, repeated edges are summed
+    W = csr_matrix((np.concatenate([weights, weights]), (np.concatenate([src, trg]), np.concatenate([trg, src]))),
+                   shape=(nnodes, nnodes))
+
+    degree = np.asarray(W.sum(axis=1)).ravel()
+    L = (diags(degree) - W).tocsr()
+
+    invdegree = np.divide(1.0, degree, out=np.zeros_like(degree), where=degree > 0.0)
+    D = (diags(invdegree) @ W).tocsr()
+
+    return L, D
+
+
+# ---------------------------------------------------------
+# The exponential integrator functions of z <= 0
+#     exp(z),  phi1(z) = (exp(z) - 1)/z,  phi2(z) = (exp(z) - 1 - z)/z^2
+# (Taylor series near z = 0)
+# ---------------------------------------------------------
+def phiFunctions(z):
+    z = np.asarray(z, dtype=np.float64)
+    small = np.abs(z) < 1e-3
+    zs = np.where(small, 1.0, z)
+
+    phi1 = np.where(small, 1.0 + z/2.0 + z*z/6.0, np.expm1(zs) / zs)
+    phi2 = np.where(small, 0.5 + z/6.0 + z*z/24.0, (np.expm1(zs) - zs) / (zs*zs))
+
+    return np.exp(z), phi1, phi2
+
+
+# ---------------------------------------------------------
+# Read a (region name, value) CSV file without header, e.g.
+# the per patient clearances 228.csv or the region voxel
+# counts voxels_allpatients_ascending.csv.  Returns the region
+# names and an array of the values.
+# ---------------------------------------------------------
+def readRegionTable(path):
+    with open(path) as incsv:
+        rows = [row for row in csv.reader(incsv, delimiter=',') if len(row) > 0]
+    return [row[0] for row in rows], np.asarray([float(row[1]) for row in rows], dtype=np.float64)
+
+
+# ---------------------------------------------------------
+# Join the region tables `paths' (see readRegionTable) by
+# region name.  Returns the region names of the first table
+# and a (tables x regions) array of the values of every table
+# in the order of these names.
+# ---------------------------------------------------------
+def joinRegionTables(paths):
+    labels, values = readRegionTable(paths[0])
+    columns = [values]
+
+    for path in paths[1:]:
+        names, values = readRegionTable(path)
+        position = {names[i]: i for i in range(len(names))}
+
+        missing = [label for label in labels if label not in position]
+        if len(missing) > 0:
+            raise KeyError(f"The regions {missing} of {paths[0]} are not in {path}")
+        columns.append(values[[position[label] for label in labels]])
+
+    return labels, np.stack(columns)
+
+
+# ---------------------------------------------------------
+# The (results x 3 x columns) mean, minimum and maximum of
+# the results compiled by solverBG.compileResults for the
+# ((fields x nodes) x columns) array of states `Y'
+# ---------------------------------------------------------
+def reduceStates(Y, membership, indices, starts):
+    values = Y[indices]
+    return np.stack([membership @ Y,
+                     np.minimum.reduceat(values, starts, axis=0),
+                     np.maximum.reduceat(values, starts, axis=0)], axis=1)
+
+
+# the region label of every node: <region>.<freesurfer name>.<hemisphere>
+# (e.g. cortical.entorhinal.right)
+def nodeLabels(graph):
+    return [graph.regions[i] + "." + graph.fsnames[i] + "." + graph.hemispheres[i] for i in range(graph.getNodeCount())]
+
+
+class solverBG:
+
+    # ---------------------------------------------------------
+    # Construct a solver on the connectome in the GraphML file
+    # `graphmlfile'.
+    # [optional] lpow: edge weights are n/l^lpow (Default: 2)
+    # ---------------------------------------------------------
+    def __init__(self, graphmlfile, lpow=2):
+        self.graph = connectomegraph.loadConnectome(graphmlfile)
+        self.nnodes = self.graph.getNodeCount()
+
+        self.laplacian, self.neighborMean = buildGraphOperators(self.graph, lpow=lpow)
+
+        self.labels = nodeLabels(self.graph)
+        self.regionNodes = {}
+        for i in range(self.nnodes):
+            self.regionNodes.setdefault(self.labels[i], []).append(i)
+        self.regionNodes = {r: np.asarray(n, dtype=np.int64) for r, n in self.regionNodes.items()}
+
+        # (nodes, region positions) of the region lists of
+        # regionIndex
+        self.regionIndexCache = {}
+
+        self.parameters = {name: np.full(self.nnodes, value) for name, value in defaultparameters.items()}
+        self.initial = {field: np.zeros(self.nnodes) for field in fieldnames}
+
+        # (kind, field, node indices, tag) of every requested result
+        self.results = []
+
+        self.verbose = False
+        self.outputdirectory = './'
+        self.visualization = None
+
+        # threshold events (see setEvents) and the arrival times
+        # of the last solve
+        self.events = None
+        self.arrivalTimes = None
+
+        self.tstart = 0.0
+        self.tend = 1.0
+        self.dtout = 1.0
+        self.tol = 1.0e-6
+
+        # time integration (see setIntegrator)
+        self.integrator = 'bdf'
+        self.etdStep = None
+        self.laplacianEigen = None
+        self.spectralCache = {}
+
+        # compiled right hand side and Jacobian kernels (see
+        # setKernelBackend)
+        self.kernels = bgkernels.havenumba
+
+        # checkpoints (see setCheckpointing), the current step
+        # size of the integrator and the first step of a resumed
+        # integration
+        self.checkpointing = None
+        self.lastCheckpoint = None
+        self.stepSize = None
+        self.firstStep = None
+
+        # the accepted steps (time, state, right hand side) of
+        # the last integration (see setDenseOutput)
+        self.denseOutput = False
+        self.denseSteps = None
+        self.denseSolution = None
+
+    # ------------------------------------------
+    # Solver information
+    # ------------------------------------------
+    def discoverParameters(self):
+        return list(self.parameters.keys())
+
+    def discoverRegionLabels(self):
+        return list(self.regionNodes.keys())
+
+    def discoverSolutionFields(self):
+        return list(fieldnames)
+
+    def setVerbose(self, bVerbose):
+        self.verbose = bVerbose
+
+    def __log(self, msg):
+        if self.verbose:
+            print(f"[{solvername}] {msg}")
+
+    # ------------------------------------------
+    # Integrate from `tstart' to `tend' and write the results
+    # every `dtout' time units.  `tol' is the relative and
+    # absolute tolerance of the integrator.
+    # ------------------------------------------
+    def setup(self, tstart, tend, dtout, tol):
+        self.tstart = float(tstart)
+        self.tend = float(tend)
+        self.dtout = float(dtout)
+        self.tol = float(tol)
+
+    # ---------------------------------------------------------
+    # Select the time integrator:
+    #
+    #   'bdf'        adaptive implicit BDF method with the
+    #                analytic sparse Jacobian (Default)
+    #   'etd'        second order exponential time differencing
+    #                (ETDRK2) with fixed steps of length `dt'.
+    #                The linear diffusion -diag(rho) L p is
+    #                integrated exactly through the eigen-
+    #                decomposition of the graph Laplacian
+    #                (computed once per connectome, and once per
+    #                distinct non-uniform Diffusion-Coefficient);
+    #                the growth, clearance and damage terms are
+    #                treated explicitly.
+    #   'etd-krylov' as 'etd' with the action of the matrix
+    #                exponential (scipy expm_multiply) in place of
+    #                the eigendecomposition, for large graphs
+    #
+    # The step `dt' of the ETD schemes is limited by the
+    # (non-stiff) reaction terms only.  Default: the output
+    # interval.  Output times are always hit exactly.
+    # ---------------------------------------------------------
+    def setIntegrator(self, method, dt=None):
+        if method not in ['bdf', 'etd', 'etd-krylov']:
+            raise ValueError(f"Unknown integrator {method} (use bdf, etd or etd-krylov)")
+        if dt is not None and dt <= 0.0:
+            raise ValueError("The ETD time step must be positive")
+
+        self.integrator = method
+        self.etdStep = None if dt is None else float(dt)
+
+    # ---------------------------------------------------------
+    # Write a checkpoint of the integration to `directory'
+    # every `interval' time units (at the first output time at
+    # least `interval' after the last checkpoint).  A checkpoint
+    # (checkpoint-<configuration>-<output index>.npz) holds the
+    # state, the time, the step size of the integrator, the
+    # results up to that time and a hash of the configuration
+    # (connectome, parameters, initial state, output times,
+    # tolerance and integrator).  Only the `keep' latest
+    # checkpoints of a configuration are kept.
+    #
+    # A killed solve is resumed from its latest checkpoint with
+    # solve(resume=True) (solveEnsemble(..., resume=True)), and
+    # new runs are forked from any checkpoint with solveFork.
+    # ---------------------------------------------------------
+    def setCheckpointing(self, directory, interval, keep=2):
+        if interval <= 0.0:
+            raise ValueError("The checkpoint interval must be positive")
+        self.checkpointing = (directory, float(interval), max(1, int(keep)))
+
+    # ---------------------------------------------------------
+    # Keep a continuous extension of every solve: the state
+    # and its time derivative at every accepted step, from
+    # which the solution is evaluated at any times afterwards
+    # (see getDenseOutput and hermiteSolution)
+    # ---------------------------------------------------------
+    def setDenseOutput(self, enabled=True):
+        self.denseOutput = bool(enabled)
+
+    # the hermiteSolution of the last solve (None without
+    # setDenseOutput)
+    def getDenseOutput(self):
+        return self.denseSolution
+
+    # ---------------------------------------------------------
+    # Evaluate the right hand side and the Jacobian with
+    #
+    #   'numba'  the compiled kernels of bgkernels.py (fused
+    #            loops over the nodes)
+    #   'numpy'  vectorized NumPy operations
+    #   'auto'   numba if it is installed (Default)
+    # ---------------------------------------------------------
+    def setKernelBackend(self, backend):
+        if backend not in ['auto', 'numba', 'numpy']:
+            raise ValueError(f"Unknown kernel backend {backend} (use auto, numba or numpy)")
+
+        if backend == 'numba' and not bgkernels.havenumba:
+            print(f"[WARNING] [{solvername}] numba is not installed; using the NumPy kernels")
+
+        self.kernels = bgkernels.havenumba and backend != 'numpy'
+
+    # directory for the results file (Default: './')
+    def setOutputDirectory(self, outdir):
+        self.outputdirectory = outdir
+
+    def getRegionNodes(self, label):
+        label = labelaliases.get(label, label)
+        if label not in self.regionNodes:
+            raise KeyError(f"Unknown region label {label}")
+        return self.regionNodes[label]
+
+    # ---------------------------------------------------------
+    # The nodes of the regions `labels' (a list of region
+    # labels) and, for every one of these nodes, the position
+    # of its region in `labels': values[position] assigns the
+    # per region `values' to these nodes.  The index of every
+    # list of regions is computed once.
+    # ---------------------------------------------------------
+    def regionIndex(self, labels):
+        key = tuple(labels)
+        if key not in self.regionIndexCache:
+            nodes = [self.getRegionNodes(label) for label in labels]
+            self.regionIndexCache[key] = (np.concatenate(nodes).astype(np.int64),
+                                          np.repeat(np.arange(len(labels)), [len(n) for n in nodes]))
+        return self.regionIndexCache[key]
+
+    # the (..., nodes) array `default' with the nodes of the
+    # regions `labels' set to the (..., regions) values
+    # `values', e.g. the clearances of a cohort for
+    # solveEnsemble
+    def regionalArray(self, labels, values, default=0.0):
+        nodes, position = self.regionIndex(labels)
+        values = np.asarray(values, dtype=np.float64)
+        if values.shape[-1] != len(labels):
+            raise ValueError(f"Expected {len(labels)} values per region list, received an array of shape {values.shape}")
+
+        out = np.array(np.broadcast_to(default, values.shape[:-1] + (self.nnodes,)), dtype=np.float64)
+        out[..., nodes] = values[..., position]
+        return out
+
+    # ------------------------------------------
+    # Parameters
+    # ------------------------------------------
+    def __checkParameter(self, name):
+        if name not in self.parameters:
+            raise KeyError(f"Unknown parameter {name} (parameters are {self.discoverParameters()})")
+
+    def setUniformParameter(self, name, value):
+        self.__checkParameter(name)
+        self.parameters[name][:] = value
+
+    # set the parameter `name' in every node of the region `label'
+    def setParameter(self, name, label, value):
+        self.__checkParameter(name)
+        self.parameters[name][self.getRegionNodes(label)] = value
+
+    # set the parameter `name' in the nodes of every region of
+    # the list `labels' from an array with one value per region
+    def setRegionalParameters(self, name, labels, values):
+        self.__checkParameter(name)
+        self.parameters[name][:] = self.regionalArray(labels, values, self.parameters[name])
+
+    # set the parameter `name' from an array with one value per node
+    def setParameterArray(self, name, values):
+        self.__checkParameter(name)
+        values = np.asarray(values, dtype=np.float64)
+        if values.shape != (self.nnodes,):
+            raise ValueError(f"Expected {self.nnodes} values for parameter {name}, received an array of shape {values.shape}")
+        self.parameters[name][:] = values
+
+    def getParameterArray(self, name):
+        self.__checkParameter(name)
+        return self.parameters[name]
+
+    # ------------------------------------------
+    # Initial values.  With `distribute' True the value is
+    # divided equally over the nodes so that the total over
+    # the nodes equals `value'.
+    # ------------------------------------------
+    def __checkField(self, field):
+        if field not in self.initial:
+            raise KeyError(f"Unknown solution field {field} (fields are {fieldnames})")
+
+    def setUniformInitialValue(self, field, value, distribute=False):
+        self.__checkField(field)
+        self.initial[field][:] = value / self.nnodes if distribute else value
+
+    def setInitialValue(self, field, label, value, distribute=False):
+        self.__checkField(field)
+        nodes = self.getRegionNodes(label)
+        self.initial[field][nodes] = value / len(nodes) if distribute else value
+
+    # set the initial values of `field' in the nodes of every
+    # region of the list `labels' from an array with one value
+    # per region
+    def setRegionalInitialValues(self, field, labels, values, distribute=False):
+        self.__checkField(field)
+        values = np.asarray(values, dtype=np.float64)
+        if distribute:
+            nodes, position = self.regionIndex(labels)
+            values = values / np.bincount(position, minlength=len(labels))
+        self.initial[field][:] = self.regionalArray(labels, values, self.initial[field])
+
+    def setInitialArray(self, field, values):
+        self.__checkField(field)
+        values = np.asarray(values, dtype=np.float64)
+        if values.shape != (self.nnodes,):
+            raise ValueError(f"Expected {self.nnodes} initial values for {field}, received an array of shape {values.shape}")
+        self.initial[field][:] = values
+
+    def getInitialArray(self, field):
+        self.__checkField(field)
+        return self.initial[field]
+
+    # ------------------------------------------
+    # Results: the mean, minimum and maximum of a field over
+    # all nodes (global) or over the nodes of a list of
+    # regions.  All results are reduced together at every
+    # output step (see compileResults) and written as the
+    # columns of a single results file.
+    # ------------------------------------------
+    def addGlobalResult(self, field, optionalIdTag=None):
+        self.__checkField(field)
+        self.results.append(('Global', field, np.arange(self.nnodes), optionalIdTag))
+
+    def addRegionalResult(self, labels, field, optionalIdTag=None):
+        self.__checkField(field)
+        if isinstance(labels, str):
+            labels = [labels]
+        nodes = np.concatenate([self.getRegionNodes(l) for l in labels])
+        if optionalIdTag is None:
+            optionalIdTag = 'region' + str(sum(1 for r in self.results if r[0] == 'Regional'))
+        self.results.append(('Regional', field, nodes, optionalIdTag))
+
+    # the name of a result in the results file, e.g.
+    # Global-Clearance or Regional-braak1-Misfolded-Protein-Concentration
+    def resultName(self, kind, field, tag=None):
+        if tag is None:
+            return f"{kind}-{field}"
+        return f"{kind}-{tag}-{field}"
+
+    def discoverResults(self):
+        return [self.resultName(kind, field, tag) for kind, field, nodes, tag in self.results]
+
+    def getResultsFile(self):
+        return os.path.join(self.outputdirectory, f"{solvername}-Results.csv")
+
+    # ---------------------------------------------------------
+    # Compile the requested results into one sparse (results x
+    # (fields x nodes)) membership matrix, whose rows average
+    # the nodes of a result, and the concatenated (field
+    # offset) node indices of the results, from which the
+    # minima and maxima are reduced.
+    # ---------------------------------------------------------
+    def compileResults(self):
+        rows = [np.zeros(0, dtype=np.int64)]
+        cols = [np.zeros(0, dtype=np.int64)]
+        weights = [np.zeros(0)]
+        starts = []
+
+        nvalues = 0
+        for g in range(len(self.results)):
+            kind, field, nodes, tag = self.results[g]
+
+            rows.append(np.full(len(nodes), g))
+            cols.append(fieldnames.index(field) * self.nnodes + nodes)
+            weights.append(np.full(len(nodes), 1.0 / len(nodes)))
+
+            starts.append(nvalues)
+            nvalues += len(nodes)
+
+        self.membership = csr_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+                                     shape=(len(self.results), len(fieldnames) * self.nnodes))
+        self.membershipIndices = np.concatenate(cols).astype(np.int64)
+        self.membershipStarts = np.asarray(starts, dtype=np.int64)
+
+    # ---------------------------------------------------------
+    # The (results x 3 x systems) mean, minimum and maximum of
+    # the compiled results for the stacked state `y' of
+    # `nsystems' systems
+    # ---------------------------------------------------------
+    def reduceResults(self, y, nsystems=1):
+        if len(self.results) == 0:
+            return np.zeros((0, 3, nsystems))
+
+        Y = y.reshape(len(fieldnames), nsystems, self.nnodes).transpose(0, 2, 1).reshape(-1, nsystems)
+        return reduceStates(Y, self.membership, self.membershipIndices, self.membershipStarts)
+
+    # write legacy VTK files (one per output time) of the
+    # solution on the connectome to `outdir'
+    def enableVisualization(self, prefix, outdir):
+        self.visualization = (prefix, outdir)
+
+    # ---------------------------------------------------------
+    # Threshold events: the times at which the `statistic'
+    # ('Mean', 'Min' or 'Max') of each of the results
+    # `results' (names of discoverResults, e.g.
+    # Regional-braak1-Misfolded-Protein-Concentration) first
+    # reaches each of the values `thresholds'.  Crossings are
+    # located by root finding on the interpolant of the
+    # integrator step in which they occur.
+    #
+    # [optional] direction: 1 for upward crossings (Default),
+    #   -1 for downward crossings (e.g. of the clearance)
+    #
+    # The arrival times of the last solve are returned by
+    # getArrivalTimes(); see also solveEvents.
+    # ---------------------------------------------------------
+    def setEvents(self, results, thresholds, statistic='Mean', direction=1):
+        names = self.discoverResults()
+        for r in results:
+            if r not in names:
+                raise KeyError(f"Unknown result {r} (add it with addGlobalResult or addRegionalResult first)")
+        if statistic not in ['Mean', 'Min', 'Max']:
+            raise ValueError(f"Unknown statistic {statistic} (use Mean, Min or Max)")
+
+        self.events = {'results': list(results),
+                       'rows': np.asarray([names.index(r) for r in results], dtype=np.int64),
+                       'statistic': ['Mean', 'Min', 'Max'].index(statistic),
+                       'thresholds': np.asarray(thresholds, dtype=np.float64).ravel(),
+                       'direction': 1.0 if direction >= 0 else -1.0}
+
+    def clearEvents(self):
+        self.events = None
+        self.arrivalTimes = None
+
+    # the (systems x results x thresholds) arrival times of the
+    # events in the last solve (NaN: not reached)
+    def getArrivalTimes(self):
+        return self.arrivalTimes
+
+    # the (results x thresholds x systems) event functions at
+    # the stacked state `y'; an event fires where its function
+    # becomes non-negative
+    def __eventValues(self, y, nsystems):
+        ev = self.events
+        values = self.reduceResults(y, nsystems)[ev['rows'], ev['statistic'], :]
+        return ev['direction'] * (values[:, None, :] - ev['thresholds'][None, :, None])
+
+    # ------------------------------------------
+    # The model.  The state of `nsystems' copies of the network
+    # (e.g. one per patient) is stacked as
+    #     [p (systems x nodes), lambda (systems x nodes), q (systems x nodes)]
+    # and integrated as a single block diagonal system.  The
+    # parameters are vectors over (systems x nodes).
+    # ------------------------------------------
+    def __splitState(self, y):
+        n = len(y) // len(fieldnames)
+        return y[:n], y[n:2*n], y[2*n:]
+
+    # Per (system, node) parameter vectors: the per-node
+    # parameters of the solver, overridden by the arrays of
+    # `overrides' (shape (nodes,) or (systems x nodes))
+    def __systemParameters(self, nsystems, overrides=None):
+        if overrides is None:
+            overrides = {}
+
+        for name in overrides:
+            self.__checkParameter(name)
+
+        prm = {}
+        for name in self.parameters:
+            values = np.asarray(overrides.get(name, self.parameters[name]), dtype=np.float64)
+            if values.shape not in [(self.nnodes,), (nsystems, self.nnodes)]:
+                raise ValueError(f"Expected {self.nnodes} or {nsystems} x {self.nnodes} values for parameter {name}, received an array of shape {values.shape}")
+            prm[name] = np.broadcast_to(values, (nsystems, self.nnodes)).ravel()
+
+        return prm
+
+    # ---------------------------------------------------------
+    # The constant parts of the right hand side and the
+    # Jacobian.  The Laplacian and the neighbor mean operator
+    # are repeated on the diagonal for every system, and the
+    # (CSC) sparsity pattern of the Jacobian is computed once:
+    # a Jacobian evaluation only computes the values of the
+    # entries, which are summed into the fixed pattern.
+    # ---------------------------------------------------------
+    def __prepareOperators(self, prm, nsystems):
+        L = self.laplacian
+        D = self.neighborMean
+        if nsystems > 1:
+            L = kron(identity(nsystems), L, format='csr')
+            D = kron(identity(nsystems), D, format='csr')
+
+        self.prm = prm
+        minusRhoL = (diags(-prm['Diffusion-Coefficient']) @ L).tocoo()
+        tauD = (diags(prm['Nonlocal-Degradation-Rate']) @ D).tocoo()
+
+        n = nsystems * self.nnodes
+        i = np.arange(n)
+        rL, cL = minusRhoL.row, minusRhoL.col
+        rD, cD = tauD.row, tauD.col
+
+        # the (row, column) of every Jacobian entry, in the order
+        # of the values computed in jacobian()
+        rows = np.concatenate([rL, i, i, n + i, n + i, n + rD, 2*n + i, 2*n + rD, 2*n + i]).astype(np.int64)
+        cols = np.concatenate([cL, i, n + i, i, n + i, 2*n + cD, i, 2*n + cD, 2*n + i]).astype(np.int64)
+
+        size = 3 * n
+        entries, self.jacobianPosition = np.unique(cols * size + rows, return_inverse=True)
+        self.jacobianIndices = entries % size
+        self.jacobianIndptr = np.searchsorted(entries // size, np.arange(size + 1))
+        self.jacobianShape = (size, size)
+
+        self.minusRhoLValues = minusRhoL.data
+        self.tauDValues = tauD.data
+        self.tauDRows = rD
+
+        self.minusRhoL = minusRhoL.tocsr()
+        self.tauD = tauD.tocsr()
+
+    def rhs(self, t, y):
+        prm = self.prm
+        if self.kernels:
+            n = len(y) // 3
+            return bgkernels.rhsKernel(y, n, self.minusRhoL @ y[:n], self.tauD @ y[2*n:],
+                                       prm['Linear-Growth-Coefficient'], prm['Critical-Clearance'],
+                                       prm['Saturation-Growth-Coefficient'], prm['Toxic-Degradation-Rate'],
+                                       prm['Asymptotic-Minimal-Clearance'], np.empty(len(y)))
+
+        p, lam, q = self.__splitState(y)
+
+        # toxic and non-local degradation
+        s = prm['Toxic-Degradation-Rate'] * p + self.tauD @ q
+
+        dp = self.minusRhoL @ p + prm['Linear-Growth-Coefficient'] * (prm['Critical-Clearance'] - lam) * p \
+             - prm['Saturation-Growth-Coefficient'] * p * p
+        dlam = -s * (lam - prm['Asymptotic-Minimal-Clearance'])
+        dq = s * (1.0 - q)
+
+        return np.concatenate([dp, dlam, dq])
+
+    #   d(p, lambda, q)'/d(p, lambda, q) =
+    #     [ -diag(rho) L + diag(G(mu-lambda) - 2 alpha p)   diag(-G p)   0                              ]
+    #     [ diag(-B (lambda-lambda_inf))                    diag(-s)     -diag(lambda-lambda_inf) tau D ]
+    #     [ diag(B (1-q))                                   0            diag(1-q) tau D - diag(s)      ]
+    def jacobian(self, t, y):
+        prm = self.prm
+        if self.kernels:
+            n = len(y) // 3
+            data = bgkernels.jacobianKernel(y, n, self.minusRhoLValues, self.tauD @ y[2*n:], self.tauDRows,
+                                            self.tauDValues, prm['Linear-Growth-Coefficient'],
+                                            prm['Critical-Clearance'], prm['Saturation-Growth-Coefficient'],
+                                            prm['Toxic-Degradation-Rate'], prm['Asymptotic-Minimal-Clearance'],
+                                            self.jacobianPosition, np.empty(len(self.jacobianIndices)))
+            return csc_matrix((data, self.jacobianIndices, self.jacobianIndptr), shape=self.jacobianShape)
+
+        p, lam, q = self.__splitState(y)
+
+        B = prm['Toxic-Degradation-Rate']
+        G = prm['Linear-Growth-Coefficient']
+
+        s = B * p + self.tauD @ q
+        dlam = lam - prm['Asymptotic-Minimal-Clearance']
+
+        values = np.concatenate([self.minusRhoLValues,
+                                 G * (prm['Critical-Clearance'] - lam) - 2.0 * prm['Saturation-Growth-Coefficient'] * p,
+                                 -G * p,
+                                 -B * dlam,
+                                 -s,
+                                 -dlam[self.tauDRows] * self.tauDValues,
+                                 B * (1.0 - q),
+                                 (1.0 - q)[self.tauDRows] * self.tauDValues,
+                                 -s])
+
+        data = np.bincount(self.jacobianPosition, weights=values, minlength=len(self.jacobianIndices))
+        return csc_matrix((data, self.jacobianIndices, self.jacobianIndptr), shape=self.jacobianShape)
+
+    def initialState(self):
+        return np.concatenate([self.initial[f] for f in fieldnames])
+
+    def outputTimes(self):
+        nout = int(round((self.tend - self.tstart) / self.dtout))
+        times = self.tstart + self.dtout * np.arange(nout + 1)
+        times[-1] = min(times[-1], self.tend)
+        return times
+
+    # ---------------------------------------------------------
+    # Integrate from `y0' over the output times `times' with
+    # the operators of __prepareOperators.  `record(k, y)' is
+    # called with the solution y at every output time times[k].
+    #
+    # If events are set their arrival times are located for
+    # the `nsystems' stacked systems; with `stopWhenFired' the
+    # integration ends as soon as every event has fired.
+    # ---------------------------------------------------------
+    def __integrate(self, y0, times, record, nsystems=1, stopWhenFired=False):
+        record(0, y0)
+        self.__startEvents(y0, times[0], nsystems)
+
+        self.denseSteps = [] if self.denseOutput else None
+        self.__denseStep(times[0], y0)
+
+        if self.integrator == 'bdf':
+            self.__integrateBDF(y0, times, record, nsystems, stopWhenFired)
+        else:
+            self.__integrateETD(y0, times, record, nsystems, stopWhenFired)
+
+        if self.events is not None:
+            self.arrivalTimes = self.eventArrival.transpose(2, 0, 1)
+
+        if self.denseOutput:
+            t, y, f = zip(*self.denseSteps)
+            self.denseSolution = hermiteSolution(np.asarray(t), np.asarray(y), np.asarray(f), nsystems, self.nnodes,
+                                                 self.discoverResults(), self.membership, self.membershipIndices,
+                                                 self.membershipStarts)
+            self.denseSteps = None
+
+    # keep the state `y' of an accepted step at time `t'
+    def __denseStep(self, t, y):
+        if self.denseSteps is not None:
+            self.denseSteps.append((float(t), np.array(y), self.rhs(t, y)))
+
+    def __integrateBDF(self, y0, times, record, nsystems, stopWhenFired):
+        firstStep = None if self.firstStep is None else min(self.firstStep, times[-1] - times[0])
+        self.firstStep = None
+
+        integrator = BDF(self.rhs, times[0], y0, times[-1], rtol=self.tol, atol=self.tol, jac=self.jacobian,
+                         first_step=firstStep)
+
+        k = 1
+        nsteps = 0
+        while k < len(times):
+            message = integrator.step()
+            nsteps += 1
+            if integrator.status == 'failed':
+                raise RuntimeError(f"[{solvername}] Integration failed at t = {integrator.t}: {message}")
+            self.stepSize = integrator.h_abs
+            self.__denseStep(integrator.t, integrator.y)
+
+            interpolant = None
+
+            # the solution at every output time passed in this step
+            if times[k] <= integrator.t:
+                interpolant = integrator.dense_output()
+                while k < len(times) and times[k] <= integrator.t:
+                    record(k, interpolant(times[k]))
+                    k += 1
+
+            getInterpolant = lambda: interpolant if interpolant is not None else integrator.dense_output()
+            if self.__stepEvents(integrator.y, integrator.t_old, integrator.t, getInterpolant, nsystems) and stopWhenFired:
+                self.__log(f"All events fired at t = {integrator.t}")
+                break
+
+        self.__log(f"{nsteps} steps, {integrator.nfev} right hand side and {integrator.njev} Jacobian evaluations")
+
+    # ---------------------------------------------------------
+    # Exponential time differencing (ETDRK2, Cox and Matthews
+    # 2002) for u' = A u + N(u), where A = -diag(rho) L acts on
+    # the protein concentration and N holds all other terms:
+    #
+    #   a     = exp(hA) u + h phi1(hA) N(u)
+    #   u_new = a + h phi2(hA) (N(a) - N(u))
+    #
+    # The steps are fixed (setIntegrator); between output times
+    # the interval is divided into equal steps no longer than
+    # the step length.  Events are located on the linear
+    # interpolant of every step.
+    # ---------------------------------------------------------
+    def __integrateETD(self, y0, times, record, nsystems, stopWhenFired):
+        n = nsystems * self.nnodes
+        h = self.etdStep if self.etdStep is not None else self.dtout
+
+        if self.integrator == 'etd':
+            self.__prepareSpectral(nsystems)
+            advance = self.__spectralStep
+        else:
+            advance = self.__krylovStep
+
+        y = np.array(y0, dtype=np.float64)
+        t = times[0]
+        nsteps = 0
+        self.firstStep = None
+        self.stepSize = h
+        for k in range(1, len(times)):
+            nsub = max(1, int(np.ceil((times[k] - times[k-1]) / h - 1e-9)))
+            dt = (times[k] - times[k-1]) / nsub
+
+            for j in range(nsub):
+                told = t
+                yold = y
+                t = times[k-1] + (j + 1) * dt
+                y = advance(yold, dt, n)
+                nsteps += 1
+
+                if not np.all(np.isfinite(y)):
+                    raise RuntimeError(f"[{solvername}] ETD integration failed at t = {t}: non-finite solution (reduce the time step)")
+                self.__denseStep(t, y)
+
+                getInterpolant = lambda y0=yold, y1=y, t0=told, t1=t: (lambda s: y0 + (s - t0) / (t1 - t0) * (y1 - y0))
+                if self.__stepEvents(y, told, t, getInterpolant, nsystems) and stopWhenFired:
+                    self.__log(f"All events fired at t = {t}")
+                    self.__log(f"{nsteps} {self.integrator} steps")
+                    return
+
+            record(k, y)
+
+        self.__log(f"{nsteps} {self.integrator} steps")
+
+    # the explicit part N(y) = rhs(y) - [A p, 0, 0]
+    def __nonlinear(self, y, n):
+        f = self.rhs(0.0, y)
+        f[:n] -= self.minusRhoL @ y[:n]
+        return f
+
+    # ---------------------------------------------------------
+    # Spectral form of A = -diag(rho) L for every system.  On
+    # every connected component of the graph
+    #     A = diag(r) V diag(-lam) V^T diag(1/r),  r = sqrt(rho)
+    # with V diag(lam) V^T the eigendecomposition of the
+    # symmetric matrix diag(r) L diag(r); A vanishes on
+    # isolated nodes.  For a uniform coefficient these are the
+    # eigendecompositions of L, which are computed once per
+    # connectome.  Systems with the same coefficients share
+    # one decomposition.  (Decomposing the components
+    # separately keeps the round-off of the dense transforms
+    # off unconnected nodes, where the unstable growth of
+    # the model would amplify it.)
+    # ---------------------------------------------------------
+    def __prepareSpectral(self, nsystems):
+        rho = self.prm['Diffusion-Coefficient'].reshape(nsystems, self.nnodes)
+        if np.any(rho <= 0.0):
+            raise ValueError("The 'etd' integrator requires a positive Diffusion-Coefficient; use 'etd-krylov'")
+
+        if self.laplacianEigen is None:
+            ncomponents, component = connected_components(self.laplacian, directed=False)
+            self.laplacianEigen = []
+            for c in range(ncomponents):
+                nodes = np.nonzero(component == c)[0]
+                if len(nodes) > 1:
+                    lam, V = eigh(self.laplacian[nodes][:, nodes].toarray())
+                    self.laplacianEigen.append((nodes, lam, V))
+
+        groups = {}
+        for k in range(nsystems):
+            groups.setdefault(rho[k].tobytes(), []).append(k)
+
+        self.spectralGroups = []
+        for key, members in groups.items():
+            r = rho[members[0]]
+
+            if key not in self.spectralCache:
+                blocks = []
+                for nodes, lam, V in self.laplacianEigen:
+                    rc = r[nodes]
+                    if np.all(rc == rc[0]):
+                        blocks.append((nodes, -rc[0] * lam, V, V.T))
+                    else:
+                        sr = np.sqrt(rc)
+                        lamc, Vc = eigh(sr[:, None] * self.laplacian[nodes][:, nodes].toarray() * sr[None, :])
+                        blocks.append((nodes, -lamc, sr[:, None] * Vc, Vc.T / sr[None, :]))
+                self.spectralCache[key] = blocks
+
+            self.spectralGroups.append((np.asarray(members), self.spectralCache[key]))
+
+    def __spectralStep(self, u, h, n):
+        P = n // self.nnodes
+
+        # f(hA) x for the (systems x nodes) protein block x of
+        # every system, with f = exp, phi1 or phi2 (which = 0,
+        # 1 or 2)
+        def apply(x, which):
+            out = x * phiFunctions(0.0)[which]
+            for members, blocks in self.spectralGroups:
+                for nodes, mu, left, right in blocks:
+                    block = np.ix_(members, nodes)
+                    out[block] = ((x[block] @ right.T) * phiFunctions(h * mu)[which]) @ left.T
+            return out
+
+        Nu = self.__nonlinear(u, n)
+
+        a = u + h * Nu
+        a[:n] = (apply(u[:n].reshape(P, -1), 0) + h * apply(Nu[:n].reshape(P, -1), 1)).ravel()
+
+        dN = self.__nonlinear(a, n) - Nu
+
+        unew = a + 0.5 * h * dN
+        unew[:n] = a[:n] + h * apply(dN[:n].reshape(P, -1), 2).ravel()
+        return unew
+
+    # ETDRK2 with the matrix exponential actions of augmented
+    # matrices (exp([[hA, W], [0, J]]) [u; e], see Al-Mohy and
+    # Higham 2011) in place of the eigendecomposition
+    def __krylovStep(self, u, h, n):
+        hA = (h * self.minusRhoL).tocsc()
+
+        def expAction(x, w):
+            # exp(hA) x + sum_k phi_k(hA) w[k-1]
+            p = len(w)
+            W = csr_matrix(np.column_stack(w[::-1]))
+            J = diags(np.ones(p - 1), 1, shape=(p, p)) if p > 1 else csr_matrix((1, 1))
+            M = bmat([[hA, W], [None, J]], format='csc')
+            v = np.concatenate([x, np.zeros(p - 1), [1.0]])
+            return expm_multiply(M, v)[:n]
+
+        Nu = self.__nonlinear(u, n)
+
+        a = u + h * Nu
+        a[:n] = expAction(u[:n], [h * Nu[:n]])
+
+        dN = self.__nonlinear(a, n) - Nu
+
+        unew = a + 0.5 * h * dN
+        unew[:n] = expAction(u[:n], [h * Nu[:n], h * dN[:n]])
+        return unew
+
+    # ---------------------------------------------------------
+    # Event bookkeeping of an integration: the fired events and
+    # their arrival times (results x thresholds x systems)
+    # ---------------------------------------------------------
+    def __startEvents(self, y0, t0, nsystems):
+        if self.events is None:
+            return
+
+        self.eventFired = self.__eventValues(y0, nsystems) >= 0.0
+        self.eventArrival = np.where(self.eventFired, t0, np.nan)
+
+    # Check the events at the end `y' of the step [t0, t1] and
+    # locate the new crossings on the interpolant of the step
+    # returned by `getInterpolant()'.  Returns True when every
+    # event has fired.
+    def __stepEvents(self, y, t0, t1, getInterpolant, nsystems):
+        if self.events is None:
+            return False
+
+        crossed = ~self.eventFired & (self.__eventValues(y, nsystems) >= 0.0)
+
+        if crossed.any():
+            interpolant = getInterpolant()
+
+            for e in np.argwhere(crossed):
+                self.eventArrival[tuple(e)] = self.__locateEvent(interpolant, tuple(e), nsystems, t0, t1)
+            self.eventFired |= crossed
+
+        return bool(self.eventFired.all())
+
+    # the time in [t0, t1] at which the event function `e'
+    # of the interpolated solution becomes zero
+    def __locateEvent(self, interpolant, e, nsystems, t0, t1):
+        g = lambda t: self.__eventValues(interpolant(t), nsystems)[e]
+        if g(t0) >= 0.0:
+            return t0
+        return brentq(g, t0, t1, xtol=1e-10 * max(1.0, abs(t1)))
+
+    # ---------------------------------------------------------
+    # Create a result store (see resultstore.py) in the
+    # directory `path' for the runs `runs' (IDs, Default: a
+    # single run '0') with the output times, the node labels
+    # and the requested results of the solver.  Pass it to
+    # solve or solveEnsemble to write the solution into it.
+    # ---------------------------------------------------------
+    def createResultStore(self, path, runs=None):
+        if runs is None:
+            runs = ['0']
+
+        groups = {self.resultName(kind, field, tag): (field, nodes) for kind, field, nodes, tag in self.results}
+        return resultstore.createStore(path, [str(r) for r in runs], self.outputTimes(), fieldnames, self.labels,
+                                       groups, meta={'solver': solvername})
+
+    def __checkStore(self, store, times):
+        if store.data.shape[1:] != (len(times), len(fieldnames), self.nnodes) or not np.allclose(store.times, times):
+            raise ValueError(f"The result store {store.path} was created for other output times or another connectome")
+
+    # ---------------------------------------------------------
+    # Checkpoints
+    # ---------------------------------------------------------
+
+    # the hash of everything that determines the solution from
+    # the state `y0' at the output index `kstart'
+    def __configurationHash(self, y0, kstart):
+        h = hashlib.sha1()
+        for a in [self.laplacian.indptr, self.laplacian.indices, self.laplacian.data, self.neighborMean.data, y0] + \
+                 [self.prm[name] for name in sorted(self.prm)]:
+            h.update(np.ascontiguousarray(a).tobytes())
+        h.update(repr((self.tstart, self.tend, self.dtout, self.tol, self.integrator, self.etdStep, kstart)).encode())
+        return h.hexdigest()[:16]
+
+    def __checkpointFiles(self, config='*'):
+        return sorted(glob.glob(os.path.join(self.checkpointing[0], f"checkpoint-{config}-*.npz")))
+
+    # write a checkpoint at the output index `k' if one is due
+    # (not at the last output time, where the solve is done)
+    def __checkpoint(self, config, times, k, y, nsystems, results):
+        if self.checkpointing is None or k == len(times) - 1:
+            return
+
+        directory, interval, keep = self.checkpointing
+        if times[k] - self.lastCheckpoint < interval - 1e-9 * max(1.0, abs(interval)):
+            return
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        path = os.path.join(directory, f"checkpoint-{config}-{k:06d}.npz")
+        with open(path + '.tmp', mode='wb') as f:
+            np.savez(f, state=y, time=times[k], index=k, stepsize=np.nan if self.stepSize is None else self.stepSize,
+                     nsystems=nsystems, config=config, results=results)
+        os.replace(path + '.tmp', path)
+        self.lastCheckpoint = times[k]
+
+        for old in self.__checkpointFiles(config)[:-keep]:
+            os.remove(old)
+
+    # the (time, path) of every checkpoint in the checkpoint
+    # directory, e.g. to fork runs from (see solveFork)
+    def discoverCheckpoints(self):
+        if self.checkpointing is None:
+            return []
+        return sorted([(float(self.loadCheckpoint(path)['time']), path) for path in self.__checkpointFiles()])
+
+    def loadCheckpoint(self, path):
+        with np.load(path) as data:
+            return {key: data[key] for key in data.files}
+
+    # the state, output index and results of the latest
+    # checkpoint of the configuration `config' (None if there
+    # is none), and the step size to resume with
+    def __resume(self, config):
+        if self.checkpointing is None or len(self.__checkpointFiles(config)) == 0:
+            return None
+
+        cp = self.loadCheckpoint(self.__checkpointFiles(config)[-1])
+        self.firstStep = None if np.isnan(cp['stepsize']) else float(cp['stepsize'])
+        self.__log(f"Resuming from the checkpoint at t = {float(cp['time'])}")
+        return cp['state'], int(cp['index']), cp['results']
+
+    # ---------------------------------------------------------
+    # Integrate the model.  Returns the output times and the
+    # (times x fields x nodes) solution at these times, and
+    # writes the requested results.
+    #
+    # [optional] store: a result store (see createResultStore)
+    #   into which the solution is written at every output time
+    # [optional] run: the ID of the run in the store (Default:
+    #   the first run)
+    # [optional] resume: continue from the latest checkpoint of
+    #   the same configuration (see setCheckpointing), if there
+    #   is one.  The returned solution starts at the time of the
+    #   checkpoint; the results file is complete.
+    # ---------------------------------------------------------
+    def solve(self, store=None, run=None, resume=False):
+        self.__prepareOperators(self.__systemParameters(1), 1)
+        self.compileResults()
+
+        return self.__solveFrom(self.initialState(), 0, None, store, run, resume)
+
+    # integrate a single system from the state `y0' at the
+    # output index `kstart' (with the results `prefix' up to
+    # that time)
+    def __solveFrom(self, y0, kstart, prefix, store, run, resume):
+        times = self.outputTimes()
+        config = self.__configurationHash(y0, kstart)
+
+        if resume:
+            checkpoint = self.__resume(config)
+            if checkpoint is not None:
+                y0, kstart, prefix = checkpoint
+
+        states = np.empty((len(times) - kstart, len(fieldnames), self.nnodes))
+        results = np.full((len(times), len(self.results), 3), np.nan)
+        if prefix is not None:
+            results[:kstart+1] = prefix
+
+        if store is not None:
+            self.__checkStore(store, times)
+            row = 0 if run is None else store.getRunIndex(run)
+
+        def record(k, y):
+            states[k] = y.reshape(len(fieldnames), self.nnodes)
+            results[kstart + k] = self.reduceResults(y)[:, :, 0]
+            if store is not None:
+                store.append(row, kstart + k, states[k])
+            self.__checkpoint(config, times, kstart + k, y, 1, results[:kstart+k+1])
+
+        self.__log(f"Integrating {self.nnodes} nodes from t = {times[kstart]} to t = {self.tend}")
+        self.lastCheckpoint = times[kstart]
+        self.__integrate(y0, times[kstart:], record)
+
+        if store is not None:
+            store.flush()
+
+        first = kstart if prefix is None else 0
+        self.writeResults(times[first:], results[first:])
+        if self.visualization is not None:
+            self.writeVisualization(times[kstart:], states, first=kstart)
+
+        return times[kstart:], states
+
+    # ---------------------------------------------------------
+    # Start a new run from the checkpoint `checkpoint' (a path,
+    # see discoverCheckpoints) of a solve or an ensemble solve,
+    # without integrating the shared history again: e.g. a
+    # clearance intervention at the time of the checkpoint.
+    # The current parameters of the solver are used; the output
+    # times must be those of the checkpointed run.
+    #
+    # [optional] intervention: a function of the (fields x
+    #   nodes) state at the checkpoint ((fields x patients x
+    #   nodes) for an ensemble) returning the state to continue
+    #   from
+    # [optional] parameters, fields, reduce: as for
+    #   solveEnsemble (ensemble checkpoints only)
+    # [optional] store, run: as for solve and solveEnsemble
+    # [optional] resume: continue the fork from its own latest
+    #   checkpoint
+    #
+    # Returns the output times from the checkpoint on and the
+    # solution at these times, as solve or solveEnsemble.  For
+    # a single run the results file holds the whole history.
+    # ---------------------------------------------------------
+    def solveFork(self, checkpoint, intervention=None, parameters=None, fields=None, reduce=False,
+                  store=None, run=None, resume=False):
+        cp = self.loadCheckpoint(checkpoint)
+
+        times = self.outputTimes()
+        kstart = int(cp['index'])
+        if kstart >= len(times) or abs(times[kstart] - float(cp['time'])) > 1e-9 * max(1.0, abs(times[kstart])):
+            raise ValueError(f"The checkpoint {checkpoint} was written with other output times (see setup)")
+
+        nsystems = int(cp['nsystems'])
+        y0 = np.array(cp['state'])
+        if intervention is not None:
+            shape = (len(fieldnames), self.nnodes) if nsystems == 1 else (len(fieldnames), nsystems, self.nnodes)
+            y0 = np.asarray(intervention(y0.reshape(shape)), dtype=np.float64).ravel()
+
+        self.__log(f"Forking from the checkpoint at t = {times[kstart]}")
+        if nsystems == 1:
+            self.__prepareOperators(self.__systemParameters(1, parameters), 1)
+            self.compileResults()
+            return self.__solveFrom(y0, kstart, cp['results'], store, run, resume)
+
+        return self.__solveEnsembleFrom(y0, kstart, parameters, fields, reduce, store, resume)
+
+    # ---------------------------------------------------------
+    # Integrate the model for a cohort of patients at once.
+    #
+    # `clearance' is the (patients x nodes) matrix of initial
+    # clearances; the initial protein concentration and damage
+    # are the initial values set on the solver (the same for
+    # every patient).  All patients are integrated together as
+    # one block diagonal system sharing the Laplacian and the
+    # sparsity pattern of the Jacobian.
+    #
+    # [optional] parameters: {parameter name: array} of per
+    #   patient parameters, each of shape (nodes,) or
+    #   (patients x nodes).  Parameters that are not given are
+    #   the per-node parameters set on the solver.
+    # [optional] fields: the solution fields to return
+    #   (Default: all fields)
+    # [optional] reduce: True to return only the requested
+    #   results (addGlobalResult, addRegionalResult) instead
+    #   of the solution
+    #
+    # Returns the output times and an array of shape
+    # (fields x patients x nodes x times): states[i] is the
+    # (patients x nodes x times) solution of fields[i].  With
+    # `reduce' the array has shape (results x 3 x patients x
+    # times) and holds the mean, minimum and maximum of every
+    # result (see discoverResults).  No results file is
+    # written.
+    #
+    # [optional] store: a result store with one run per patient
+    #   (see createResultStore) into which the solution of
+    #   every patient is written at every output time
+    # [optional] resume: continue from the latest checkpoint of
+    #   the same configuration (see setCheckpointing); the
+    #   returned solution starts at the time of the checkpoint
+    # ---------------------------------------------------------
+    def solveEnsemble(self, clearance, parameters=None, fields=None, reduce=False, store=None, resume=False):
+        return self.__solveEnsembleFrom(self.__ensembleState(clearance), 0, parameters, fields, reduce, store, resume)
+
+    # integrate the stacked systems from the state `y0' at the
+    # output index `kstart'
+    def __solveEnsembleFrom(self, y0, kstart, parameters, fields, reduce, store, resume):
+        if fields is None:
+            fields = fieldnames
+        for field in fields:
+            self.__checkField(field)
+        findex = [fieldnames.index(f) for f in fields]
+
+        npatients = len(y0) // (len(fieldnames) * self.nnodes)
+        self.__prepareOperators(self.__systemParameters(npatients, parameters), npatients)
+        self.compileResults()
+
+        times = self.outputTimes()
+        config = self.__configurationHash(y0, kstart)
+
+        if resume:
+            checkpoint = self.__resume(config)
+            if checkpoint is not None:
+                y0, kstart = checkpoint[:2]
+
+        if store is not None:
+            self.__checkStore(store, times)
+            if len(store.runs) != npatients:
+                raise ValueError(f"The result store {store.path} has {len(store.runs)} runs for {npatients} patients")
+
+        if reduce:
+            states = np.empty((len(self.results), 3, npatients, len(times) - kstart))
+
+            def keep(k, y):
+                states[:, :, :, k] = self.reduceResults(y, npatients)
+        else:
+            states = np.empty((len(fields), npatients, self.nnodes, len(times) - kstart))
+
+            def keep(k, y):
+                states[:, :, :, k] = y.reshape(len(fieldnames), npatients, self.nnodes)[findex]
+
+        def record(k, y):
+            keep(k, y)
+            if store is not None:
+                store.append(slice(None), kstart + k, y.reshape(len(fieldnames), npatients, self.nnodes).transpose(1, 0, 2))
+            self.__checkpoint(config, times, kstart + k, y, npatients, np.zeros(0))
+
+        self.__log(f"Integrating {npatients} patients x {self.nnodes} nodes from t = {times[kstart]} to t = {self.tend}")
+        self.lastCheckpoint = times[kstart]
+        self.__integrate(y0, times[kstart:], record, nsystems=npatients)
+
+        if store is not None:
+            store.flush()
+
+        return times[kstart:], states
+
+    # the stacked initial state of a cohort with the (patients x
+    # nodes) initial clearances `clearance'
+    def __ensembleState(self, clearance):
+        clearance = np.asarray(clearance, dtype=np.float64)
+        if clearance.ndim != 2 or clearance.shape[1] != self.nnodes:
+            raise ValueError(f"Expected a (patients x {self.nnodes}) clearance matrix, received an array of shape {clearance.shape}")
+
+        npatients = clearance.shape[0]
+        return np.concatenate([np.tile(self.initial['Misfolded-Protein-Concentration'], npatients),
+                               clearance.ravel(),
+                               np.tile(self.initial['Damage-Percentage'], npatients)])
+
+    # ---------------------------------------------------------
+    # Integrate only for the threshold events (see setEvents):
+    # no solution is stored and no results file is written.
+    #
+    # [optional] clearance: (patients x nodes) initial
+    #   clearances of a cohort (see solveEnsemble).  Default:
+    #   a single system with the initial values set on the
+    #   solver.
+    # [optional] parameters: per patient parameters (see
+    #   solveEnsemble)
+    # [optional] stopWhenFired: end the integration as soon as
+    #   every event has fired (Default: integrate to tend)
+    #
+    # Returns the (patients x results x thresholds) arrival
+    # times; NaN where a threshold is not reached by tend.
+    # ---------------------------------------------------------
+    def solveEvents(self, clearance=None, parameters=None, stopWhenFired=False):
+        if self.events is None:
+            raise RuntimeError(f"[{solvername}] No events are set (see setEvents)")
+
+        y0 = self.initialState() if clearance is None else self.__ensembleState(clearance)
+        nsystems = len(y0) // (len(fieldnames) * self.nnodes)
+
+        self.__prepareOperators(self.__systemParameters(nsystems, parameters), nsystems)
+        self.compileResults()
+
+        self.__log(f"Locating {self.events['thresholds'].size * len(self.events['results'])} events for {nsystems} system(s)")
+        self.__integrate(y0, np.asarray([self.tstart, self.tend]), lambda k, y: None,
+                         nsystems=nsystems, stopWhenFired=stopWhenFired)
+
+        return self.arrivalTimes
+
+    # ---------------------------------------------------------
+    # Sensitivities.  Every parameter of node i appears only in
+    # the equations of node i, so df/d(parameter) is a (fields
+    # x nodes) array per parameter: entry (f, i) is the
+    # derivative of the right hand side of field f at node i
+    # with respect to the parameter of node i.
+    # ---------------------------------------------------------
+    def __parameterDerivatives(self, y):
+        prm = self.prm
+        p, lam, q = self.__splitState(y)
+
+        Lp = self.laplacian @ p
+        Dq = self.neighborMean @ q
+        s = prm['Toxic-Degradation-Rate'] * p + prm['Nonlocal-Degradation-Rate'] * Dq
+        dlam = lam - prm['Asymptotic-Minimal-Clearance']
+        zero = np.zeros(self.nnodes)
+
+        return {'Asymptotic-Minimal-Clearance': np.stack([zero, s, zero]),
+                'Critical-Clearance': np.stack([prm['Linear-Growth-Coefficient'] * p, zero, zero]),
+                'Diffusion-Coefficient': np.stack([-Lp, zero, zero]),
+                'Linear-Growth-Coefficient': np.stack([(prm['Critical-Clearance'] - lam) * p, zero, zero]),
+                'Nonlocal-Degradation-Rate': np.stack([zero, -Dq * dlam, Dq * (1.0 - q)]),
+                'Saturation-Growth-Coefficient': np.stack([-p * p, zero, zero]),
+                'Toxic-Degradation-Rate': np.stack([zero, -p * dlam, p * (1.0 - q)])}
+
+    # the steps of a BDF integration of z' = fun(t, z) from t0
+    # to t1 (backwards if t1 < t0)
+    def __stepsBDF(self, fun, jac, z0, t0, t1):
+        integrator = BDF(fun, t0, z0, t1, rtol=self.tol, atol=self.tol, jac=jac)
+        while integrator.status == 'running':
+            message = integrator.step()
+            if integrator.status == 'failed':
+                raise RuntimeError(f"[{solvername}] Integration failed at t = {integrator.t}: {message}")
+            yield integrator
+
+    # ---------------------------------------------------------
+    # Integrate the model together with its forward
+    # sensitivities S = dy/dtheta, which solve
+    #
+    #     S' = J(y) S + df/dtheta,   S(tstart) = dy(tstart)/dtheta
+    #
+    # `sensitivities' is a list of
+    #   name            a parameter, uniform over all nodes
+    #   (name, label)   a parameter in the nodes of a region
+    #   (field, label)  the initial value of a field in the
+    #                   nodes of a region (e.g. ('Clearance',
+    #                   'cortical.entorhinal.right'))
+    # (label None: all nodes).  Each sensitivity adds one copy
+    # of the system, so this is meant for a few parameters;
+    # the gradient of one output with respect to all of them is
+    # computed by solveAdjoint.
+    #
+    # Returns the output times, the (times x fields x nodes)
+    # solution and the (sensitivities x times x fields x nodes)
+    # sensitivities.
+    # ---------------------------------------------------------
+    def solveSensitivities(self, sensitivities):
+        self.__prepareOperators(self.__systemParameters(1), 1)
+        n = len(fieldnames) * self.nnodes
+
+        directions = []
+        S0 = []
+        for entry in sensitivities:
+            name, label = (entry, None) if isinstance(entry, str) else entry
+            nodes = np.arange(self.nnodes) if label is None else self.getRegionNodes(label)
+
+            d = np.zeros(self.nnodes)
+            d[nodes] = 1.0
+            s0 = np.zeros(n)
+            if name in self.parameters:
+                directions.append((name, d))
+            elif name in fieldnames:
+                directions.append((None, d))
+                s0[fieldnames.index(name) * self.nnodes + nodes] = 1.0
+            else:
+                raise KeyError(f"Unknown parameter or solution field {name}")
+            S0.append(s0)
+
+        k = len(directions)
+
+        def fun(t, z):
+            y = z[:n]
+            J = self.jacobian(t, y)
+            derivatives = self.__parameterDerivatives(y)
+
+            dz = [self.rhs(t, y)]
+            for j in range(k):
+                name, d = directions[j]
+                dS = J @ z[(j+1)*n:(j+2)*n]
+                if name is not None:
+                    dS += (derivatives[name] * d).ravel()
+                dz.append(dS)
+            return np.concatenate(dz)
+
+        # the block diagonal approximation of the Jacobian of the
+        # extended system (the sensitivity equations are linear
+        # in S; their dependence on y is dropped)
+        def jac(t, z):
+            return kron(identity(k + 1), self.jacobian(t, z[:n]), format='csc')
+
+        times = self.outputTimes()
+        states = np.empty((len(times), k + 1, len(fieldnames), self.nnodes))
+        z0 = np.concatenate([self.initialState()] + S0)
+        states[0] = z0.reshape(k + 1, len(fieldnames), self.nnodes)
+
+        self.__log(f"Integrating {self.nnodes} nodes with {k} sensitivities from t = {self.tstart} to t = {self.tend}")
+        j = 1
+        for integrator in self.__stepsBDF(fun, jac, z0, times[0], times[-1]):
+            if j < len(times) and times[j] <= integrator.t:
+                interpolant = integrator.dense_output()
+                while j < len(times) and times[j] <= integrator.t:
+                    states[j] = interpolant(times[j]).reshape(k + 1, len(fieldnames), self.nnodes)
+                    j += 1
+
+        return times, states[:, 0], states[:, 1:].transpose(1, 0, 2, 3)
+
+    # ---------------------------------------------------------
+    # The gradient of a scalar output with respect to the
+    # initial values of every field and every parameter in
+    # every node, with one backward (adjoint) solve.  The output
+    # is the mean of the result `result' (see discoverResults,
+    # e.g. Regional-braak5-Damage-Percentage) at tend, or its
+    # integral over [tstart, tend] with `integrated' (e.g. the
+    # accumulated toxic load of Global-Misfolded-Protein-
+    # Concentration).  With the weights w of the result the
+    # adjoint a solves, backwards from tend,
+    #
+    #     a' = -J(y)^T a - v,    a(tend) = w (v = 0), or
+    #                            a(tend) = 0 (v = w, integrated)
+    #
+    # and the gradients are a(tstart) (initial values) and the
+    # integrals of a^T df/dtheta over [tstart, tend]
+    # (parameters), which are integrated with the adjoint.
+    #
+    # The forward solution is stored only at `ncheckpoints' + 1
+    # equally spaced checkpoints; the interval between two
+    # checkpoints is integrated again, with dense output, just
+    # before the adjoint passes through it.
+    #
+    # Returns the output, {field: (nodes,) gradient with respect
+    # to the initial values} and {parameter: (nodes,) gradient}.
+    # ---------------------------------------------------------
+    def solveAdjoint(self, result, integrated=False, ncheckpoints=10):
+        names = self.discoverResults()
+        if result not in names:
+            raise KeyError(f"Unknown result {result} (add it with addGlobalResult or addRegionalResult first)")
+
+        self.__prepareOperators(self.__systemParameters(1), 1)
+        self.compileResults()
+
+        n = len(fieldnames) * self.nnodes
+        nparameters = len(self.parameters)
+        weights = self.membership.getrow(names.index(result)).toarray().ravel()
+        v = weights if integrated else np.zeros(n)
+
+        # forward pass: the solution at the checkpoints
+        tcheck = np.linspace(self.tstart, self.tend, ncheckpoints + 1)
+        checkpoints = [self.initialState()]
+        self.__log(f"Adjoint of {result}: forward pass with {ncheckpoints} checkpoint intervals")
+        for c in range(ncheckpoints):
+            for integrator in self.__stepsBDF(self.rhs, self.jacobian, checkpoints[c], tcheck[c], tcheck[c+1]):
+                pass
+            checkpoints.append(integrator.y)
+
+        output = 0.0 if integrated else float(weights @ checkpoints[-1])
+
+        # the adjoint, the parameter gradients and the integral
+        # of the output, all integrated backwards from tend
+        rows = (np.arange(nparameters)[:, None, None] * self.nnodes +
+                np.arange(self.nnodes)[None, None, :]).repeat(len(fieldnames), axis=1).ravel()
+        cols = np.tile(np.arange(n), nparameters)
+        zeros = csr_matrix((n, nparameters * self.nnodes + 1))
+        zeroBlock = csr_matrix((nparameters * self.nnodes + 1, nparameters * self.nnodes + 1))
+
+        z = np.concatenate([np.zeros(n) if integrated else weights, np.zeros(nparameters * self.nnodes + 1)])
+
+        for c in reversed(range(ncheckpoints)):
+            # the forward solution in this interval
+            ends = []
+            segments = []
+            for integrator in self.__stepsBDF(self.rhs, self.jacobian, checkpoints[c], tcheck[c], tcheck[c+1]):
+                ends.append(integrator.t)
+                segments.append(integrator.dense_output())
+
+            def forward(t):
+                return segments[min(bisect.bisect_left(ends, t), len(segments) - 1)](t)
+
+            def fun(t, z):
+                y = forward(t)
+                a = z[:n].reshape(len(fieldnames), self.nnodes)
+                derivatives = self.__parameterDerivatives(y)
+
+                da = -(self.jacobian(t, y).T @ z[:n]) - v
+                dQ = [-(derivatives[name] * a).sum(axis=0) for name in self.parameters]
+                return np.concatenate([da] + dQ + [[-(v @ y)]])
+
+            def jac(t, z):
+                y = forward(t)
+                derivatives = self.__parameterDerivatives(y)
+                values = -np.concatenate([derivatives[name].ravel() for name in self.parameters])
+                dQda = csr_matrix((values, (rows, cols)), shape=(nparameters * self.nnodes + 1, n))
+                return bmat([[-self.jacobian(t, y).T, zeros], [dQda, zeroBlock]], format='csc')
+
+            for integrator in self.__stepsBDF(fun, jac, z, tcheck[c+1], tcheck[c]):
+                pass
+            z = integrator.y
+
+        output += z[-1]
+        a = z[:n].reshape(len(fieldnames), self.nnodes)
+        Q = z[n:-1].reshape(nparameters, self.nnodes)
+
+        return output, {fieldnames[f]: a[f] for f in range(len(fieldnames))}, \
+            {name: Q[i] for i, name in enumerate(self.parameters)}
+
+    # ---------------------------------------------------------
+    # Steady states.  At an equilibrium s (lambda - lambda_inf)
+    # = 0 and s (1 - q) = 0 with s = B p + tau D q.  Where the
+    # protein persists (p > 0, so s > 0 with B > 0) the
+    # clearance collapses to lambda = lambda_inf and q = 1,
+    # whatever the initial clearance, and the protein solves
+    #
+    #     F(p) = -diag(rho) L p + G (mu - lambda) p - alpha p^2 = 0
+    #
+    # Where the protein dies out s decays to zero and the
+    # clearance and damage stop at values set by the transient
+    # (lambda - lambda_inf and 1 - q shrink by the factor
+    # exp(-integral of s)).
+    #
+    # Which of the two happens is decided on every seeded
+    # (initial p > 0) connected component of the graph by the
+    # leading eigenvalue of the linearization about p = 0,
+    # -diag(rho) L + diag(G (mu - lambda)), at the clearance
+    # the component ends with:
+    #
+    #   - with non-local degradation (tau > 0 on a component
+    #     with edges and some damage, which B p creates) the
+    #     damage spreads through the whole component: q -> 1
+    #     and lambda -> lambda_inf whether or not the protein
+    #     persists
+    #   - with B = 0 the clearance keeps its initial value
+    #   - otherwise the clearance decreases from its initial
+    #     value towards lambda_inf while there is protein.  The
+    #     protein persists if the linearization grows at the
+    #     larger of the initial clearance and lambda_inf; else
+    #     the model is integrated until the protein persists or
+    #     has died out, which also gives the clearance and
+    #     damage it leaves behind (see __settleComponents).
+    #
+    # Unseeded components keep p = 0 and their initial
+    # clearance and damage (unless the damage spreads).  Where
+    # the protein persists the Jacobian of the full model is
+    # block triangular with the blocks dF/dp and -diag(s), so
+    # the stability is decided by the leading eigenvalue of
+    # dF/dp; where it died out the clearance and damage are
+    # neutral (s = 0) and the leading eigenvalue of the
+    # linearization about p = 0 is reported.
+    # ---------------------------------------------------------
+
+    # ---------------------------------------------------------
+    # The nodes on which the protein persists from the initial
+    # values, the (nodes,) clearance and damage of the steady
+    # state, the nodes whose clearance collapses to lambda_inf
+    # (and damage to 1), and the leading eigenvalue of the
+    # linearization about p = 0 on the seeded components in
+    # which the protein dies out (-inf if there are none)
+    # ---------------------------------------------------------
+    def __equilibriumNodes(self, prm):
+        ncomponents, component = connected_components(self.laplacian, directed=False)
+        p0, lam0, q0 = self.__splitState(self.initialState())
+        B = prm['Toxic-Degradation-Rate']
+        lamInf = prm['Asymptotic-Minimal-Clearance']
+
+        def anyNode(mask):
+            return np.bincount(component, weights=mask, minlength=ncomponents) > 0
+
+        seeded = anyNode(p0 > 0.0)
+        toxic = anyNode(B > 0.0)
+
+        # with non-local degradation the damage spreads through
+        # a component with edges once a node is damaged
+        degrading = anyNode(prm['Nonlocal-Degradation-Rate'] > 0.0)
+        edges = np.bincount(component, minlength=ncomponents) > 1
+        spreading = degrading & edges & (anyNode(q0 > 0.0) | (seeded & toxic))
+
+        lam = np.where(spreading[component], lamInf, lam0)
+        q = np.where(spreading[component], 1.0, q0)
+
+        persists = np.zeros(ncomponents, dtype=bool)
+        undecided = []
+        for c in np.nonzero(seeded)[0]:
+            nodes = np.nonzero(component == c)[0]
+            if spreading[c] or not toxic[c]:
+                # the clearance of the component does not depend
+                # on the protein
+                persists[c] = self.__growthRate(prm, nodes, lam) > 0.0
+            elif self.__growthRate(prm, nodes, np.where(B > 0.0, np.maximum(lam0, lamInf), lam0)) > 0.0:
+                persists[c] = True
+            else:
+                undecided.append(c)
+
+        if undecided:
+            persists[undecided], lam, q = self.__settleComponents(prm, component, undecided, lam, q)
+
+        collapsed = spreading[component] | (persists[component] & (B > 0.0))
+        clearance = np.where(collapsed, lamInf, lam)
+        rate = max((self.__growthRate(prm, np.nonzero(component == c)[0], clearance)
+                    for c in np.nonzero(seeded & ~persists)[0]), default=-np.inf)
+
+        return np.nonzero(persists[component])[0], lam, q, collapsed, rate
+
+    # ---------------------------------------------------------
+    # Integrate the model from the initial values until the
+    # protein of every component of `undecided' (on which s =
+    # B p) either persists, i.e. the linearization about p = 0
+    # grows at the largest clearance the component can still
+    # reach, or has died out: the linearization decays, at the
+    # rate r < 0, and the clearance the remaining protein can
+    # still remove, about B max(p) / |r|, is below the
+    # tolerance of the integrator.  The state is checked at
+    # doubling times up to `settlehorizon'.
+    #
+    # Returns whether the protein persists on every component
+    # of `undecided', and the clearance `lam' and damage `q'
+    # with the values reached on the components on which it
+    # died out.
+    # ---------------------------------------------------------
+    def __settleComponents(self, prm, component, undecided, lam, q):
+        B = prm['Toxic-Degradation-Rate']
+        lamInf = prm['Asymptotic-Minimal-Clearance']
+        lam, q = lam.copy(), q.copy()
+        persists = {}
+
+        self.__log(f"Integrating until the protein persists or dies out on {len(undecided)} components")
+        self.__prepareOperators(prm, 1)
+        tcheck = 1.0
+        for integrator in self.__stepsBDF(self.rhs, self.jacobian, self.initialState(), 0.0, settlehorizon):
+            if integrator.t < tcheck and integrator.status == 'running':
+                continue
+            tcheck = 2.0 * integrator.t
+
+            p, lamt, qt = self.__splitState(integrator.y)
+            for c in undecided:
+                if c in persists:
+                    continue
+
+                nodes = np.nonzero(component == c)[0]
+                if self.__growthRate(prm, nodes, np.where(B > 0.0, np.maximum(lamt, lamInf), lamt)) > 0.0:
+                    persists[c] = True
+                    continue
+
+                rate = self.__growthRate(prm, nodes, lamt)
+                if rate < 0.0 and np.max(B[nodes]) * np.max(np.abs(p[nodes])) <= -rate * self.tol:
+                    persists[c] = False
+                    lam[nodes] = lamt[nodes]
+                    q[nodes] = qt[nodes]
+
+            if len(persists) == len(undecided):
+                break
+
+        if len(persists) < len(undecided):
+            raise RuntimeError(f"[{solvername}] The protein neither persists nor dies out by t = {settlehorizon} "
+                               f"(the linearization about p = 0 is close to neutral)")
+
+        return np.array([persists[c] for c in undecided]), lam, q
+
+    # the leading eigenvalue of the linearization about p = 0
+    # on the `nodes' at the (nodes,) clearance `lam'
+    def __growthRate(self, prm, nodes, lam):
+        L = self.laplacian[nodes][:, nodes].tocsr()
+        F, J, partials = self.__equilibriumSystem(np.zeros(len(nodes)), prm, nodes, L, lam,
+                                                  np.zeros(self.nnodes, dtype=bool))
+        return self.__leadingEigenvalue(J, prm, nodes, L)
+
+    # F(p) and dF/dp on the `nodes' (the restriction of the
+    # Laplacian `L') at the clearance `lam', lambda_inf on the
+    # `collapsed' nodes, and the partial derivative of F with
+    # respect to every parameter of equilibriumparameters
+    def __equilibriumSystem(self, p, prm, nodes, L, lam, collapsed):
+        rho = prm['Diffusion-Coefficient'][nodes]
+        G = prm['Linear-Growth-Coefficient'][nodes]
+        gap = prm['Critical-Clearance'][nodes] - np.where(collapsed, prm['Asymptotic-Minimal-Clearance'], lam)[nodes]
+        growth = G * gap
+        alpha = prm['Saturation-Growth-Coefficient'][nodes]
+
+        Lp = L @ p
+        F = -rho * Lp + growth * p - alpha * p * p
+        J = (diags(-rho) @ L + diags(growth - 2.0 * alpha * p)).tocsc()
+
+        partials = {'Asymptotic-Minimal-Clearance': np.where(collapsed[nodes], -G * p, 0.0),
+                    'Critical-Clearance': G * p,
+                    'Diffusion-Coefficient': -Lp,
+                    'Linear-Growth-Coefficient': gap * p,
+                    'Saturation-Growth-Coefficient': -p * p}
+        return F, J, partials
+
+    # the largest real part of the eigenvalues of dF/dp.  With
+    # rho > 0, dF/dp is similar to the symmetric matrix
+    # -diag(r) L diag(r) + diag(dF/dp), r = sqrt(rho).
+    def __leadingEigenvalue(self, J, prm, nodes, L):
+        if len(nodes) == 0:
+            return -np.inf
+
+        rho = prm['Diffusion-Coefficient'][nodes]
+        if np.any(rho <= 0.0):
+            return float(np.max(eigvals(J.toarray()).real))
+
+        r = np.sqrt(rho)
+        S = diags(-r) @ L @ diags(r) + diags(J.diagonal() + rho * L.diagonal())
+        if len(nodes) <= denseeigenlimit:
+            return float(eigh(S.toarray(), eigvals_only=True)[-1])
+        return float(eigsh(S, k=1, which='LA', return_eigenvectors=False)[0])
+
+    # Newton's method with backtracking for F(p) = 0 from `p'
+    def __equilibriumNewton(self, p, prm, nodes, L, lam, collapsed, tol, maxiter):
+        F, J, partials = self.__equilibriumSystem(p, prm, nodes, L, lam, collapsed)
+        for it in range(maxiter):
+            residual = np.max(np.abs(F), initial=0.0)
+            if residual <= tol:
+                self.__log(f"Newton converged in {it} iterations (residual {residual:.3e})")
+                return p, J
+
+            dp = spsolve(J, -F)
+            step = 1.0
+            while step > 1e-4:
+                Fnew, Jnew, partials = self.__equilibriumSystem(p + step * dp, prm, nodes, L, lam, collapsed)
+                if np.linalg.norm(Fnew) < np.linalg.norm(F):
+                    break
+                step *= 0.5
+
+            p = p + step * dp
+            F, J = Fnew, Jnew
+
+        raise RuntimeError(f"[{solvername}] Newton's method did not converge in {maxiter} iterations "
+                           f"(residual {np.max(np.abs(F)):.3e})")
+
+    # the (fields x nodes) steady state with the protein `p' on
+    # the nodes `nodes' on which it persists
+    def __equilibriumState(self, p, prm, nodes, lam, q, collapsed):
+        state = np.stack([np.zeros(self.nnodes),
+                          np.where(collapsed, prm['Asymptotic-Minimal-Clearance'], lam),
+                          np.where(collapsed, 1.0, q)])
+        state[0, nodes] = p
+        return state
+
+    # ---------------------------------------------------------
+    # The steady state reached from the initial values set on
+    # the solver, computed with Newton's method on the
+    # equilibrium equations (see above) instead of a long
+    # integration.
+    #
+    # [optional] parameters: {parameter: (nodes,) array}
+    #   overriding the parameters of the solver
+    # [optional] guess: (nodes,) initial guess of the protein
+    #   concentration, e.g. the end state of a solve.  Default:
+    #   the local equilibria max(G (mu - lambda), 0) / alpha
+    # [optional] tol: maximum residual (Default: 1e-10)
+    # [optional] maxiter: maximum Newton iterations (Default: 50)
+    #
+    # Returns the (fields x nodes) steady state and the leading
+    # eigenvalue of its Jacobian (negative: stable).  Newton's
+    # method only solves for the protein on the components on
+    # which it persists and converges to the equilibrium
+    # nearest to the guess.
+    # ---------------------------------------------------------
+    def steadyState(self, parameters=None, guess=None, tol=1e-10, maxiter=50):
+        prm = self.__systemParameters(1, parameters)
+        nodes, lam, q, collapsed, rate = self.__equilibriumNodes(prm)
+        L = self.laplacian[nodes][:, nodes].tocsr()
+
+        alpha = prm['Saturation-Growth-Coefficient'][nodes]
+        if np.any(alpha <= 0.0):
+            raise ValueError("The steady state requires a positive Saturation-Growth-Coefficient where the protein persists")
+
+        if guess is None:
+            clearance = np.where(collapsed, prm['Asymptotic-Minimal-Clearance'], lam)
+            growth = prm['Linear-Growth-Coefficient'] * (prm['Critical-Clearance'] - clearance)
+            p = np.maximum(growth[nodes], 0.0) / alpha
+        else:
+            p = np.asarray(guess, dtype=np.float64)[nodes]
+
+        self.__log(f"Solving for the steady state of the {len(nodes)} nodes on which the protein persists")
+        p, J = self.__equilibriumNewton(p, prm, nodes, L, lam, collapsed, tol, maxiter)
+
+        return self.__equilibriumState(p, prm, nodes, lam, q, collapsed), \
+            max(self.__leadingEigenvalue(J, prm, nodes, L), rate)
+
+    # ---------------------------------------------------------
+    # Trace the branch of steady states (see steadyState) while
+    # the parameter `name' varies as
+    #
+    #     base + theta direction,   theta from thetaStart to thetaEnd
+    #
+    # by pseudo-arclength continuation: a tangent predictor
+    # followed by Newton corrections of the bordered system
+    # [dF/dp dF/dtheta; tangent] on the hyperplane normal to
+    # the tangent, with an adaptive arclength step.  The branch
+    # of the protein on the components on which it persists at
+    # thetaStart is followed through folds, and ends when theta
+    # leaves the range, the protein concentration becomes
+    # negative (the branch meets the protein free state p = 0)
+    # or the protein no longer persists on the same components
+    # from the initial values; the last point is then the
+    # steady state reached from the initial values.
+    #
+    # `name' is one of equilibriumparameters.  With the defaults
+    # (base 0, direction 1) theta is the uniform value of the
+    # parameter, e.g. mu for 'Critical-Clearance'; a
+    # heterogeneity scale is traced with base the mean and
+    # direction the deviation from the mean of a per node
+    # profile (e.g. of a clearance).
+    #
+    # [optional] direction, base: (nodes,) arrays or scalars
+    # [optional] parameters: {parameter: (nodes,) array}
+    #   overriding the other parameters of the solver
+    # [optional] ds: initial arclength step (Default: 1/100 of
+    #   the theta range)
+    # [optional] maxsteps: maximum number of steps (Default: 500)
+    # [optional] tol: maximum residual (Default: 1e-10)
+    #
+    # Returns the values of theta, the (points x fields x nodes)
+    # steady states and the leading eigenvalues along the
+    # branch; a sign change of the eigenvalue marks a
+    # bifurcation.  The requested results of the steady states
+    # are written to the continuation file (see
+    # getContinuationFile).
+    # ---------------------------------------------------------
+    def continuation(self, name, thetaStart, thetaEnd, direction=1.0, base=0.0, parameters=None,
+                     ds=None, maxsteps=500, tol=1e-10):
+        if name not in equilibriumparameters:
+            raise ValueError(f"The steady state does not depend on {name} (use one of {equilibriumparameters})")
+
+        direction = np.broadcast_to(np.asarray(direction, dtype=np.float64), (self.nnodes,))
+        base = np.broadcast_to(np.asarray(base, dtype=np.float64), (self.nnodes,))
+
+        overrides = dict(parameters) if parameters is not None else {}
+
+        def systemParameters(theta):
+            overrides[name] = base + theta * direction
+            return self.__systemParameters(1, overrides)
+
+        prm = systemParameters(thetaStart)
+        nodes, lam, q, collapsed, rate = self.__equilibriumNodes(prm)
+        if len(nodes) == 0:
+            raise ValueError(f"The protein does not persist from the initial values at {name} = {thetaStart}: "
+                             f"there is no branch to follow (see steadyState)")
+        L = self.laplacian[nodes][:, nodes].tocsr()
+        dtheta = direction[nodes]
+
+        span = abs(thetaEnd - thetaStart)
+        if span == 0.0:
+            raise ValueError("The continuation range is empty")
+        orientation = 1.0 if thetaEnd > thetaStart else -1.0
+        ds = 0.01 * span if ds is None else float(ds)
+        dsmax = 0.1 * span
+        dsmin = 1e-8 * span
+
+        # the first point and the tangent (dp/dtheta, 1)
+        state, eigenvalue = self.steadyState(parameters=overrides, tol=tol)
+        p = state[0, nodes]
+        theta = float(thetaStart)
+
+        F, J, partials = self.__equilibriumSystem(p, prm, nodes, L, lam, collapsed)
+        tangent = np.append(spsolve(J, -partials[name] * dtheta), 1.0) * orientation
+        tangent /= np.linalg.norm(tangent)
+
+        thetas = [theta]
+        states = [state]
+        eigenvalues = [eigenvalue]
+
+        self.__log(f"Continuation of the steady state in {name} from {thetaStart} to {thetaEnd}")
+        for step in range(maxsteps):
+            predicted = np.append(p, theta) + ds * tangent
+
+            # Newton corrections on the hyperplane through the
+            # predicted point normal to the tangent
+            x = predicted.copy()
+            converged = False
+            for it in range(10):
+                prm = systemParameters(x[-1])
+                F, J, partials = self.__equilibriumSystem(x[:-1], prm, nodes, L, lam, collapsed)
+                arclength = tangent @ (x - predicted)
+                A = bmat([[J, (partials[name] * dtheta)[:, None]], [tangent[None, :-1], tangent[None, -1:]]], format='csc')
+                if np.max(np.abs(F), initial=0.0) <= tol and abs(arclength) <= tol:
+                    converged = True
+                    break
+
+                x = x + spsolve(A, -np.append(F, arclength))
+
+            if not converged:
+                ds *= 0.5
+                if ds < dsmin:
+                    print(f"[WARNING] [{solvername}] Continuation stopped at {name} = {theta}: no convergence with the minimal step")
+                    break
+                continue
+
+            # the new tangent, oriented along the old one
+            tangent = spsolve(A, np.append(np.zeros(len(nodes)), 1.0))
+            tangent /= np.linalg.norm(tangent)
+
+            p, theta = x[:-1], float(x[-1])
+            if np.all(p >= -tol):
+                # the clearance and damage left where the protein
+                # dies out depend on theta
+                reached = self.__equilibriumNodes(prm)
+                if not np.array_equal(reached[0], nodes):
+                    self.__log(f"The protein persists on other nodes from the initial values at {name} = {theta}")
+                    state, eigenvalue = self.steadyState(parameters=overrides, tol=tol)
+                    thetas.append(theta)
+                    states.append(state)
+                    eigenvalues.append(eigenvalue)
+                    break
+                lam, q, rate = reached[1], reached[2], reached[4]
+
+            thetas.append(theta)
+            states.append(self.__equilibriumState(p, prm, nodes, lam, q, collapsed))
+            eigenvalues.append(max(self.__leadingEigenvalue(J, prm, nodes, L), rate))
+
+            if (theta - thetaEnd) * orientation >= 0.0 or (theta - thetaStart) * orientation < 0.0:
+                break
+            if np.any(p < -tol):
+                self.__log(f"The branch meets the protein free state at {name} = {theta}")
+                break
+
+            ds = min(1.5 * ds, dsmax) if it <= 3 else ds
+
+        thetas = np.asarray(thetas)
+        states = np.asarray(states)
+        eigenvalues = np.asarray(eigenvalues)
+
+        self.writeContinuation(name, thetas, states, eigenvalues)
+        return thetas, states, eigenvalues
+
+    def getContinuationFile(self):
+        return os.path.join(self.outputdirectory, f"{solvername}-Continuation.csv")
+
+    # write the parameter, the leading eigenvalue and the
+    # requested results (see writeResults) of every steady
+    # state of a continuation to the continuation file
+    def writeContinuation(self, name, thetas, states, eigenvalues):
+        if len(self.results) == 0:
+            return
+
+        if not os.path.exists(self.outputdirectory):
+            os.makedirs(self.outputdirectory)
+
+        self.compileResults()
+        results = np.stack([self.reduceResults(y.ravel())[:, :, 0] for y in states])
+
+        header = [name, 'Leading-Eigenvalue']
+        for result in self.discoverResults():
+            header += [result + ':Mean', result + ':Min', result + ':Max']
+
+        table = np.column_stack([thetas, eigenvalues, results.reshape(len(thetas), -1)])
+
+        with open(self.getContinuationFile(), mode='w') as outcsv:
+            csv_writer = csv.writer(outcsv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+            csv_writer.writerow(header)
+            csv_writer.writerows(table.tolist())
+
+    # ---------------------------------------------------------
+    # Write the (times x results x 3) results buffer to the
+    # results file: a Time column followed by the columns
+    # <result>:Mean, <result>:Min and <result>:Max of every
+    # result
+    # ---------------------------------------------------------
+    def writeResults(self, times, results):
+        if len(self.results) == 0:
+            return
+
+        if not os.path.exists(self.outputdirectory):
+            os.makedirs(self.outputdirectory)
+
+        header = ['Time']
+        for name in self.discoverResults():
+            header += [name + ':Mean', name + ':Min', name + ':Max']
+
+        table = np.column_stack([times, results.reshape(len(times), -1)])
+
+        with open(self.getResultsFile(), mode='w') as outcsv:
+            csv_writer = csv.writer(outcsv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+            csv_writer.writerow(header)
+            csv_writer.writerows(table.tolist())
+
+    # one legacy VTK polydata file per output time: the nodes
+    # as points, the edges as lines and the fields as point data.
+    # The files are numbered from `first' (the output index of
+    # times[0]).
+    def writeVisualization(self, times, states, first=0):
+        prefix, outdir = self.visualization
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+
+        position = {int(self.graph.nodeids[i]): i for i in range(self.nnodes)}
+        edges = [(position[int(s)], position[int(t)]) for s, t in zip(self.graph.edgesource, self.graph.edgetarget)]
+
+        for k in range(len(times)):
+            with open(os.path.join(outdir, f"{prefix}-{first + k:05d}.vtk"), mode='w') as f:
+                f.write("# vtk DataFile Version 3.0\n")
+                f.write(f"{solvername} t = {times[k]}\nASCII\nDATASET POLYDATA\n")
+
+                f.write(f"POINTS {self.nnodes} double\n")
+                for c in self.graph.coords:
+                    f.write(f"{c[0]} {c[1]} {c[2]}\n")
+
+                f.write(f"LINES {len(edges)} {3 * len(edges)}\n")
+                for s, t in edges:
+                    f.write(f"2 {s} {t}\n")
+
+                f.write(f"POINT_DATA {self.nnodes}\n")
+                for fi in range(len(fieldnames)):
+                    f.write(f"SCALARS {fieldnames[fi]} double 1\nLOOKUP_TABLE default\n")
+                    for v in states[k, fi]:
+                        f.write(f"{v}\n")
+
+
+# ---------------------------------------------------------
+# Continuous extension of a solve (see solverBG.setDenseOutput):
+# the cubic Hermite interpolant of the states and time
+# derivatives at the accepted steps of the integrator.  Any
+# times, fields, regions or results are evaluated at once,
+# without solving again.  save() writes the interpolant to an
+# .npz file that loadDenseOutput() reads back.
+# ---------------------------------------------------------
+class hermiteSolution:
+
+    def __init__(self, times, states, derivatives, nsystems, nnodes, results, membership, indices, starts):
+        self.times = times
+        self.states = states
+        self.derivatives = derivatives
+        self.nsystems = int(nsystems)
+        self.nnodes = int(nnodes)
+
+        self.results = list(results)
+        self.membership = membership
+        self.membershipIndices = indices
+        self.membershipStarts = starts
+
+    def discoverResults(self):
+        return list(self.results)
+
+    # the interpolated (times x columns) values of the state
+    # entries `columns' (Default: all) at the times `t'
+    def __interpolate(self, t, columns=slice(None)):
+        t = np.atleast_1d(np.asarray(t, dtype=np.float64))
+        if t.min() < self.times[0] or t.max() > self.times[-1]:
+            raise ValueError(f"The times must be in [{self.times[0]}, {self.times[-1]}]")
+
+        i = np.clip(np.searchsorted(self.times, t, side='right') - 1, 0, len(self.times) - 2)
+        h = (self.times[i+1] - self.times[i])[:, None]
+        s = (t[:, None] - self.times[i][:, None]) / h
+
+        return (2*s**3 - 3*s**2 + 1) * self.states[i][:, columns] + (s**3 - 2*s**2 + s) * h * self.derivatives[i][:, columns] + \
+               (3*s**2 - 2*s**3) * self.states[i+1][:, columns] + (s**3 - s**2) * h * self.derivatives[i+1][:, columns]
+
+    # ---------------------------------------------------------
+    # The solution at the times `t': (times x fields x nodes)
+    # for a single system, (times x fields x systems x nodes)
+    # for an ensemble.
+    #
+    # [optional] fields: the fields to evaluate (Default: all)
+    # [optional] nodes: the node indices to evaluate (Default:
+    #   all), e.g. solverBG.getRegionNodes(label)
+    # ---------------------------------------------------------
+    def evaluate(self, t, fields=None, nodes=None):
+        findex = np.arange(len(fieldnames)) if fields is None else np.asarray([fieldnames.index(f) for f in fields])
+        nodes = np.arange(self.nnodes) if nodes is None else np.asarray(nodes, dtype=np.int64)
+
+        columns = ((findex[:, None, None] * self.nsystems + np.arange(self.nsystems)[None, :, None]) * self.nnodes +
+                   nodes[None, None, :]).ravel()
+        values = self.__interpolate(t, columns).reshape(-1, len(findex), self.nsystems, len(nodes))
+
+        return values[:, :, 0, :] if self.nsystems == 1 else values
+
+    # the (times x results x 3) mean, minimum and maximum of
+    # the results of the solve at the times `t' ((times x
+    # results x 3 x systems) for an ensemble)
+    def evaluateResults(self, t):
+        if len(self.results) == 0:
+            raise ValueError("The solve had no results (see addGlobalResult, addRegionalResult)")
+
+        Y = self.__interpolate(t).reshape(-1, len(fieldnames), self.nsystems, self.nnodes)
+        ntimes = Y.shape[0]
+
+        Y = Y.transpose(1, 3, 0, 2).reshape(len(fieldnames) * self.nnodes, -1)
+        values = reduceStates(Y, self.membership, self.membershipIndices, self.membershipStarts)
+        values = values.reshape(len(self.results), 3, ntimes, self.nsystems).transpose(2, 0, 1, 3)
+
+        return values[:, :, :, 0] if self.nsystems == 1 else values
+
+    def save(self, path):
+        m = self.membership.tocsr()
+        np.savez(path, times=self.times, states=self.states, derivatives=self.derivatives,
+                 nsystems=self.nsystems, nnodes=self.nnodes, results=np.asarray(self.results, dtype=str),
+                 membershipData=m.data, membershipIndices=m.indices, membershipIndptr=m.indptr,
+                 membershipShape=np.asarray(m.shape), indices=self.membershipIndices, starts=self.membershipStarts)
+
+
+# read a hermiteSolution written by hermiteSolution.save
+def loadDenseOutput(path):
+    with np.load(path) as data:
+        membership = csr_matrix((data['membershipData'], data['membershipIndices'], data['membershipIndptr']),
+                                shape=tuple(data['membershipShape']))
+        return hermiteSolution(data['times'], data['states'], data['derivatives'], data['nsystems'], data['nnodes'],
+                               data['results'].tolist(), membership, data['indices'], data['starts'])
+
+
+# ---------------------------------------------------------
+# Reader for the results files written by solverBG (and for
+# PrYon-style .stat files with Time, Mean, Min and Max
+# columns)
+# ---------------------------------------------------------
+class resultsReader:
+
+    def __init__(self):
+        self.columns = {}
+        self.results = []
+
+    # load the result `result' (e.g. Global-Clearance, see
+    # solverBG.discoverResults) of the results file
+    # `resultsfile', or a .stat file if `result' is None
+    def loadResults(self, resultsfile, result=None):
+        with open(resultsfile) as incsv:
+            csv_reader = csv.reader(incsv, delimiter=',')
+            header = next(csv_reader)
+            rows = [[float(v) for v in row] for row in csv_reader]
+
+        data = np.asarray(rows, dtype=np.float64).reshape(-1, len(header))
+        columns = {header[i]: data[:, i] for i in range(len(header))}
+        self.results = [h[:-len(':Mean')] for h in header if h.endswith(':Mean')]
+
+        if result is None:
+            self.columns = columns
+            return
+
+        if result + ':Mean' not in columns:
+            raise KeyError(f"No result {result} in {resultsfile}")
+
+        self.columns = {'Time': columns['Time'],
+                        'Mean': columns[result + ':Mean'],
+                        'Min': columns[result + ':Min'],
+                        'Max': columns[result + ':Max']}
+
+    # the results stored in the last loaded file
+    def discoverResults(self):
+        return list(self.results)
+
+    def readTime(self):
+        return self.columns['Time']
+
+    def readMeanValue(self):
+        return self.columns['Mean']
+
+    def readMinValue(self):
+        return self.columns['Min']
+
+    def readMaxValue(self):
+        return self.columns['Max']
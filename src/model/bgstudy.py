@@ -0,0 +1,155 @@
+# --------------------------------------------------------
+#
+#  ***Oxford Mathematical Brain Modeling Group***
+#
+#   The model set-up of bg_clearance_dynamics.py, shared by
+#   the cohort scripts (bgsweep.py, bguncertainty.py and
+#   bgbenchmark.py): the uniform parameters, the diffusion
+#   coefficient, the seed regions and the Braak stages and
+#   lobes of the regional results.
+#
+#   The diffusion coefficient is an explicit choice:
+#
+#     regional   1e-2 / (voxels x nodes) of every region, from
+#                the region tables `voxelcountscsv' and
+#                `roinodescsv', as bg_clearance_dynamics.py
+#                sets it
+#     uniform    1e-2 in every node
+#
+#   The regional coefficients are 2-4 orders of magnitude
+#   smaller than the uniform one, so the two choices give
+#   different models.
+#
+#  Authors:
+#  ================================================
+#       Georgia S. Brennan      brennan@maths.ox.ac.uk
+#                   ----
+#       Travis B. Thompson      thompsont@maths.ox.ac.uk
+#                   ----
+#       Marie E. Rognes         meg@simula.no
+#                   ----
+#       Vegard Vinje            vegard@simula.no
+#                   ----
+#       Alain Goriely           goriely@maths.ox.ac.uk
+# ---------------------------------------------------------
+
+import os
+
+from bgsolver import fieldnames, joinRegionTables
+
+
+# ---------- Configuration ----------
+# the uniform parameters of bg_clearance_dynamics.py
+parameters = {'Asymptotic-Minimal-Clearance': 1e-6,
+              'Critical-Clearance': 0.72,
+              'Linear-Growth-Coefficient': 1.0,
+              'Nonlocal-Degradation-Rate': 0.0,
+              'Saturation-Growth-Coefficient': 2.1,
+              'Toxic-Degradation-Rate': 1.0}
+
+# the diffusion coefficient ('regional' or 'uniform', see above)
+diffusion = 'regional'
+diffusionchoices = ['regional', 'uniform']
+diffusioncoefficient = 1e-2
+
+# the region tables (region name, value) of the regional
+# diffusion coefficient
+voxelcountscsv = 'voxels_allpatients_ascending.csv'
+roinodescsv = 'nodes_rois_ascending.csv'
+
+# initial misfolded protein concentration of the seed regions
+seeds = {'cortical.entorhinal.right': 0.1, 'cortical.entorhinal.left': 0.1}
+
+# the Braak stages and lobes of bg_clearance_dynamics.py
+stagingregions = {
+    'braak1': ['cortical.entorhinal.right', 'cortical.entorhinal.left'],
+    'braak2': ['subcortical.Right-Hippocampus.right', 'subcortical.Left-Hippocampus.left'],
+    'braak3': ['cortical.parahippocampal.right', 'cortical.parahippocampal.left', 'cortical.fusiform.right',
+               'cortical.fusiform.left', 'cortical.lingual.right', 'cortical.lingual.left',
+               'subcortical.Left-Amygdala.left', 'subcortical.Right-Amygdala.right'],
+    'braak4': ['cortical.rostralanteriorcingulate.right', 'cortical.caudalanteriorcingulate.right',
+               'cortical.rostralanteriorcingulate.left', 'cortical.caudalanteriorcingulate.left',
+               'cortical.middletemporal.left', 'cortical.middletemporal.right', 'cortical.posteriorcingulate.left',
+               'cortical.posteriorcingulate.right', 'cortical.isthmuscingulate.right', 'cortical.isthmuscingulate.left',
+               'cortical.insula.right', 'cortical.insula.left', 'cortical.inferiortemporal.right',
+               'cortical.inferiortemporal.left', 'cortical.temporalpole.right', 'cortical.temporalpole.left'],
+    'braak5': ['cortical.lateraloccipital.right', 'cortical.lateraloccipital.left', 'cortical.superiorfrontal.left',
+               'cortical.superiorfrontal.right', 'cortical.lateralorbitofrontal.left',
+               'cortical.lateralorbitofrontal.right', 'cortical.medialorbitofrontal.left',
+               'cortical.medialorbitofrontal.right', 'cortical.frontalpole.left', 'cortical.frontalpole.right',
+               'cortical.caudalmiddlefrontal.left', 'cortical.caudalmiddlefrontal.right',
+               'cortical.rostralmiddlefrontal.right', 'cortical.rostralmiddlefrontal.left',
+               'cortical.parsopercularis.right', 'cortical.parsopercularis.left', 'cortical.parsorbitalis.right',
+               'cortical.parsorbitalis.left', 'cortical.parstriangularis.left', 'cortical.parstriangularis.right',
+               'cortical.supramarginal.right', 'cortical.supramarginal.left', 'cortical.inferiorparietal.right',
+               'cortical.inferiorparietal.left', 'cortical.superiortemporal.right', 'cortical.superiortemporal.left',
+               'cortical.superiorparietal.right', 'cortical.superiorparietal.left', 'cortical.precuneus.right',
+               'cortical.precuneus.left', 'cortical.bankssts.right', 'cortical.bankssts.left',
+               'cortical.transversetemporal.right', 'cortical.transversetemporal.left'],
+    'braak6': ['cortical.cuneus.right', 'cortical.pericalcarine.right', 'cortical.cuneus.left',
+               'cortical.pericalcarine.left', 'cortical.postcentral.left', 'cortical.postcentral.right',
+               'cortical.precentral.left', 'cortical.precentral.right', 'cortical.paracentral.left',
+               'cortical.paracentral.right'],
+    'frontal': ['cortical.lateralorbitofrontal.right', 'cortical.parsorbitalis.right', 'cortical.frontalpole.right',
+                'cortical.medialorbitofrontal.right', 'cortical.parstriangularis.right',
+                'cortical.parsopercularis.right', 'cortical.rostralmiddlefrontal.right',
+                'cortical.superiorfrontal.right', 'cortical.caudalmiddlefrontal.right', 'cortical.precentral.right'],
+    'parietal': ['cortical.paracentral.right', 'cortical.postcentral.right', 'cortical.supramarginal.right',
+                 'cortical.superiorparietal.right', 'cortical.inferiorparietal.right', 'cortical.precuneus.right'],
+    'limbic': ['cortical.rostralanteriorcingulate.right', 'cortical.caudalanteriorcingulate.right',
+               'cortical.posteriorcingulate.right', 'cortical.isthmuscingulate.right',
+               'cortical.parahippocampal.right', 'cortical.entorhinal.right'],
+    'occipital': ['cortical.precuneus.right', 'cortical.pericalcarine.right', 'cortical.lateraloccipital.right',
+                  'cortical.lingual.right'],
+    'temporal': ['cortical.fusiform.right', 'cortical.temporalpole.right', 'cortical.inferiortemporal.right',
+                 'cortical.middletemporal.right', 'cortical.bankssts.right', 'cortical.superiortemporal.right',
+                 'cortical.transversetemporal.right', 'cortical.insula.right', 'subcortical.Right-Hippocampus.right'],
+    'basal': ['subcortical.Right-Thalamus-Proper.right', 'subcortical.Right-Caudate.right',
+              'subcortical.Right-Putamen.right', 'subcortical.Right-Pallidum.right',
+              'subcortical.Right-Accumbens-area.right', 'subcortical.Right-Amygdala.right']}
+
+
+# ---------------------------------------------------------
+# The regions and the regional diffusion coefficients
+# 1e-2 / (voxels x nodes) of the region tables.  Raises
+# FileNotFoundError if a table does not exist.
+# ---------------------------------------------------------
+def regionalDiffusion(voxelcsv=voxelcountscsv, nodecsv=roinodescsv):
+    for path in [voxelcsv, nodecsv]:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"The region table {path} of the regional diffusion coefficient does not exist")
+
+    regions, (voxelcounts, roinodes) = joinRegionTables([voxelcsv, nodecsv])
+    return regions, diffusioncoefficient * (1.0 / voxelcounts) * (1.0 / roinodes)
+
+
+# ---------------------------------------------------------
+# Set the parameters of the study on the solver `bg'.
+#
+# [optional] diffusion: 'regional' or 'uniform' (Default:
+#   `diffusion')
+# [optional] regional: the (regions, coefficients) of
+#   regionalDiffusion, read once by the caller (Default: read
+#   the region tables)
+# ---------------------------------------------------------
+def setStudyParameters(bg, diffusion=diffusion, regional=None):
+    if diffusion not in diffusionchoices:
+        raise ValueError(f"Unknown diffusion {diffusion} (use {' or '.join(diffusionchoices)})")
+
+    for name, value in parameters.items():
+        bg.setUniformParameter(name, value)
+
+    # regions without a table entry keep the uniform coefficient
+    bg.setUniformParameter('Diffusion-Coefficient', diffusioncoefficient)
+    if diffusion == 'regional':
+        regions, values = regionalDiffusion() if regional is None else regional
+        bg.setRegionalParameters('Diffusion-Coefficient', regions, values)
+
+
+# set every solution field to zero and seed the misfolded
+# protein in the seed regions
+def setStudyInitialValues(bg):
+    for field in fieldnames:
+        bg.setUniformInitialValue(field, 0.0)
+    for label, value in seeds.items():
+        bg.setInitialValue('Misfolded-Protein-Concentration', label, value)
@@ -0,0 +1,307 @@
+# --------------------------------------------------------
+#
+#  ***Oxford Mathematical Brain Modeling Group***
+#
+#   Parameter sweeps of the Brennan-Goriely (BG) model over
+#   a cohort of patients.
+#
+#   A design over the model parameters of `sweepranges' (a
+#   full grid or a Latin hypercube) is combined with every
+#   patient clearance file of `clearancedirectory' (the
+#   averaged clearances written by
+#   4b-average-computed-clearance.py).  Every (design point,
+#   patient) run is integrated with bgsolver.solverBG, set up
+#   as in bg_clearance_dynamics.py (see bgstudy.py; the
+#   parameters that are not swept, the seeds and, with
+#   --diffusion, the regional or a uniform diffusion
+#   coefficient), on a pool of worker processes that load
+#   the connectome once (the connectome cache is
+#   memory-mapped and shared between the workers).
+#
+#   One summary row per run is appended to the results table
+#   `resultscsv' as soon as the run finishes:
+#
+#     Point, Patient, Diffusion, <swept parameters>, Status, Seconds,
+#     Final-Mean-<field> (every solution field),
+#     Final-Max-Misfolded-Protein-Concentration,
+#     Half-Damage-Time (first time the mean damage reaches 0.5,
+#     empty if it is never reached), Message
+#
+#   Runs that completed (Status ok) are skipped when the
+#   sweep is started again, so a failed or interrupted sweep
+#   is resumed by re-running the same command; failed runs
+#   are retried.  Use --restart to discard the table.
+#
+#   Usage:
+#       python3 bgsweep.py [--design grid|lhs] [--samples N] [--jobs N]
+#                          [--diffusion regional|uniform] [--results file] [--restart]
+#
+#  Authors:
+#  ================================================
+#       Georgia S. Brennan      brennan@maths.ox.ac.uk
+#                   ----
+#       Travis B. Thompson      thompsont@maths.ox.ac.uk
+#                   ----
+#       Marie E. Rognes         meg@simula.no
+#                   ----
+#       Vegard Vinje            vegard@simula.no
+#                   ----
+#       Alain Goriely           goriely@maths.ox.ac.uk
+# ---------------------------------------------------------
+
+import os
+import csv
+import sys
+import time
+import argparse
+import itertools
+
+import numpy as np
+from scipy.stats import qmc
+
+from bgsolver import solverBG, fieldnames
+import bgstudy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'clearance_extraction_pipeline'))
+import pipelinepool
+
+
+# ---------- Configuration ----------
+connectome = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'clearance_extraction_pipeline', 'master-std33.graphml')
+clearancedirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'clearance_extraction_pipeline',
+                                  'reformatted-data', '4-clearance-initial', 'averaged', 'proximity-averaged')
+resultscsv = './bg-sweep-results.csv'
+
+tstart = 0.0
+tend = 300.0
+dtout = 1.0
+tolerance = 1e-8
+
+# swept parameters: (low, high)
+sweepranges = {'Critical-Clearance': (0.5, 0.9),
+               'Saturation-Growth-Coefficient': (1.0, 3.0)}
+
+# grid design: number of values of every swept parameter
+gridpoints = 5
+
+# Latin hypercube design: number of samples (--samples) and seed
+lhssamples = 32
+lhsseed = 0
+
+
+# ---------------------------------------------------------
+# The design points: a list of {parameter: value}
+# ---------------------------------------------------------
+def gridDesign(ranges, npoints):
+    names = list(ranges.keys())
+    axes = [np.linspace(ranges[n][0], ranges[n][1], npoints) for n in names]
+    return [dict(zip(names, [float(v) for v in values])) for values in itertools.product(*axes)]
+
+
+def latinHypercubeDesign(ranges, nsamples, seed=0):
+    names = list(ranges.keys())
+    unit = qmc.LatinHypercube(d=len(names), seed=seed).random(nsamples)
+    samples = qmc.scale(unit, [ranges[n][0] for n in names], [ranges[n][1] for n in names])
+    return [dict(zip(names, [float(v) for v in row])) for row in samples]
+
+
+# Read the patient clearance files {patient id: {region label: clearance}}
+def loadPatientClearances(directory):
+    patients = {}
+    for flnm in sorted(os.listdir(directory)):
+        if not flnm.endswith('.csv'):
+            continue
+
+        with open(os.path.join(directory, flnm)) as incsv:
+            csv_reader = csv.reader(incsv, delimiter=',')
+            next(csv_reader)
+            patients[flnm[:-4]] = {row[0]: float(row[1]) for row in csv_reader}
+
+    return patients
+
+
+# ---------------------------------------------------------
+# Worker processes: every process builds one solver when it
+# starts and reuses it for all of its runs.  `diffusion' and
+# `regional' are the diffusion coefficient of the runs (see
+# bgstudy.setStudyParameters).
+# ---------------------------------------------------------
+workerSolver = None
+workerDiffusion = None
+
+
+def initWorker(graphml, diffusion, regional):
+    global workerSolver, workerDiffusion
+
+    workerSolver = solverBG(graphml)
+    workerSolver.setup(tstart, tend, dtout, tolerance)
+    workerDiffusion = (diffusion, regional)
+
+
+# the first time at which `values' reaches `level' (linear
+# interpolation between the output times), None if never
+def firstCrossing(times, values, level):
+    above = np.nonzero(values >= level)[0]
+    if len(above) == 0:
+        return None
+
+    k = above[0]
+    if k == 0:
+        return float(times[0])
+
+    return float(times[k-1] + (level - values[k-1]) * (times[k] - times[k-1]) / (values[k] - values[k-1]))
+
+
+# ---------------------------------------------------------
+# One run: `task' is (point index, design point, patient id,
+# {region label: clearance}).  Returns the summary row.
+# Errors are reported in the row instead of being raised so
+# that one failing run does not stop the sweep.
+# ---------------------------------------------------------
+def runSweepTask(task):
+    point, values, pid, clearance = task
+    bg = workerSolver
+
+    row = {'Point': point, 'Patient': pid, 'Diffusion': workerDiffusion[0]}
+    row.update(values)
+
+    start = time.time()
+    try:
+        bgstudy.setStudyParameters(bg, *workerDiffusion)
+        for name, value in values.items():
+            bg.setUniformParameter(name, value)
+
+        bgstudy.setStudyInitialValues(bg)
+        bg.setRegionalInitialValues('Clearance', list(clearance.keys()), list(clearance.values()))
+
+        times, states = bg.solve()
+
+        means = states.mean(axis=2)
+        for f in range(len(fieldnames)):
+            row['Final-Mean-' + fieldnames[f]] = float(means[-1, f])
+        row['Final-Max-Misfolded-Protein-Concentration'] = float(states[-1, 0].max())
+
+        crossing = firstCrossing(times, means[:, fieldnames.index('Damage-Percentage')], 0.5)
+        row['Half-Damage-Time'] = '' if crossing is None else crossing
+        row['Status'] = 'ok'
+        row['Message'] = ''
+    except Exception as err:
+        row['Status'] = 'failed'
+        row['Message'] = f"{type(err).__name__}: {err}"
+
+    row['Seconds'] = round(time.time() - start, 3)
+    return row
+
+
+def resultsHeader(names):
+    return ['Point', 'Patient', 'Diffusion'] + names + ['Status', 'Seconds'] + ['Final-Mean-' + f for f in fieldnames] + \
+           ['Final-Max-Misfolded-Protein-Concentration', 'Half-Damage-Time', 'Message']
+
+
+# the key identifying a run in the results table
+def runKey(pid, diffusion, values, names):
+    return (str(pid), diffusion) + tuple(repr(float(values[n])) for n in names)
+
+
+# ---------------------------------------------------------
+# Read the completed runs of an existing results table and
+# rewrite the table with only these rows (dropping failed
+# runs, which are retried).  Returns the keys of the
+# completed runs.
+# ---------------------------------------------------------
+def resumeResults(path, header, names):
+    if not os.path.exists(path):
+        return set()
+
+    with open(path) as incsv:
+        csv_reader = csv.DictReader(incsv)
+        if csv_reader.fieldnames != header:
+            print(f"[ERROR] The results table {path} was written for a different sweep; use --restart or another --results file")
+            sys.exit()
+        rows = [row for row in csv_reader if row['Status'] == 'ok']
+
+    tmpfile = path + '.tmp'
+    with open(tmpfile, mode='w', newline='') as outcsv:
+        csv_writer = csv.DictWriter(outcsv, fieldnames=header)
+        csv_writer.writeheader()
+        csv_writer.writerows(rows)
+    os.replace(tmpfile, path)
+
+    return set(runKey(row['Patient'], row['Diffusion'], row, names) for row in rows)
+
+
+# Execution starts here
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Sweep the BG model parameters over a cohort of patients")
+    parser.add_argument('--design', choices=['grid', 'lhs'], default='grid',
+                        help=f'full grid of {gridpoints} values per parameter (default) or a Latin hypercube')
+    parser.add_argument('--samples', type=int, default=lhssamples,
+                        help=f'number of Latin hypercube samples (default: {lhssamples})')
+    parser.add_argument('--diffusion', choices=bgstudy.diffusionchoices, default=bgstudy.diffusion,
+                        help=f'diffusion coefficient of the model (see bgstudy.py; default: {bgstudy.diffusion})')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of worker processes (default: 1)')
+    parser.add_argument('--results', default=resultscsv,
+                        help=f'results table (default: {resultscsv})')
+    parser.add_argument('--restart', action='store_true',
+                        help='discard the results of a previous sweep instead of resuming it')
+    args = parser.parse_args()
+
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    if not os.path.exists(clearancedirectory):
+        print(f"The clearance directory {clearancedirectory} does not exist (run the clearance pipeline first)")
+        sys.exit()
+
+    regional = None
+    if args.diffusion == 'regional':
+        try:
+            regional = bgstudy.regionalDiffusion()
+        except FileNotFoundError as err:
+            print(f"[ERROR] {err}; use --diffusion uniform for a uniform coefficient")
+            sys.exit()
+
+    names = list(sweepranges.keys())
+    if args.design == 'grid':
+        design = gridDesign(sweepranges, gridpoints)
+    else:
+        design = latinHypercubeDesign(sweepranges, args.samples, seed=lhsseed)
+
+    patients = loadPatientClearances(clearancedirectory)
+
+    header = resultsHeader(names)
+    if args.restart and os.path.exists(args.results):
+        os.remove(args.results)
+    done = resumeResults(args.results, header, names)
+
+    tasks = [(point, design[point], pid, patients[pid]) for point in range(len(design)) for pid in patients
+             if runKey(pid, args.diffusion, design[point], names) not in done]
+
+    print(f"{len(design)} design points x {len(patients)} patients: {len(tasks)} runs to do, "
+          f"{len(design) * len(patients) - len(tasks)} completed runs skipped")
+
+    newfile = not os.path.exists(args.results)
+    nfailed = 0
+    with open(args.results, mode='a', newline='') as outcsv:
+        csv_writer = csv.DictWriter(outcsv, fieldnames=header)
+        if newfile:
+            csv_writer.writeheader()
+
+        ndone = 0
+        try:
+            for i, row in pipelinepool.streamPatients(runSweepTask, tasks, jobs=args.jobs,
+                                                      initializer=initWorker, initargs=(connectome, args.diffusion, regional)):
+                csv_writer.writerow(row)
+                outcsv.flush()
+                ndone += 1
+
+                if row['Status'] != 'ok':
+                    nfailed += 1
+                    print(f"[WARNING] Run {row['Point']} of patient {row['Patient']} failed: {row['Message']}")
+        except KeyboardInterrupt:
+            print(f"Interrupted after {ndone} of {len(tasks)} runs; run the same command again to resume the sweep")
+            sys.exit(1)
+
+    print(f"{ndone - nfailed} runs completed, {nfailed} failed")
@@ -0,0 +1,382 @@
+# --------------------------------------------------------
+#
+#  ***Oxford Mathematical Brain Modeling Group***
+#
+#   Monte Carlo propagation of the uncertainty of the
+#   clearance fits into the predictions of the
+#   Brennan-Goriely (BG) model.
+#
+#   The clearance of every region of every patient is a point
+#   estimate of the fit of 4-compute-clearance.py (fitted(),
+#   batched in clearancefit.py) to three measured values.
+#   Here `ndraws' clearance maps are drawn for every patient
+#   from a per-region model of the measurement noise:
+#
+#     residual    Gaussian relative noise, with the standard
+#                 deviation of the relative residuals of the
+#                 region (see below)
+#     bootstrap   relative residuals of the region resampled
+#                 with replacement
+#
+#   The residuals are those of the linear fits of the
+#   degenerate cells of the cohort (see sserrs in
+#   4-compute-clearance.py; a three point line leaves one
+#   degree of freedom, so the residuals are scaled by sqrt(3)),
+#   pooled per region over the patients.  A region with fewer
+#   than `minimumresiduals' residuals uses the pool of the
+#   whole cohort.
+#
+#   The exponential fit passes through the first two values
+#   and takes the 30 day value as its asymptote, so a draw
+#   perturbs the three measured values of every region that
+#   was fitted with an exponential (in the clearance files of
+#   `clearancedirectory' and by the refit of the culled data
+#   of `culleddirectory') and fits the perturbed values again.
+#   All draws of the cohort are fitted in one call of
+#   clearancefit.fitClearanceBatch.  The draws are
+#   conditioned on an exponential fit: degenerate draws are
+#   drawn again (see drawClearances).  Averaged regions keep
+#   the point estimate.
+#
+#   The model is set up as in bg_clearance_dynamics.py (see
+#   bgstudy.py; --diffusion chooses the regional or a uniform
+#   diffusion coefficient).  The draws of a patient are
+#   integrated as one ensemble (solverBG.solveEnsemble, in
+#   batches of `batchsize' systems) together with the point
+#   estimate, and patients run in parallel on a pool of
+#   worker processes.  For every Braak stage and lobe of
+#   bgstudy.stagingregions the table `bandscsv' holds, at
+#   every output time, the mean misfolded protein
+#   concentration of the point estimate and its quantiles
+#   over the draws:
+#
+#     Patient, Result, Time, Point, Quantile-<q> (every q of
+#     `quantiles')
+#
+#   Usage:
+#       python3 bguncertainty.py [--model residual|bootstrap] [--draws N]
+#                                [--diffusion regional|uniform] [--noise sigma]
+#                                [--jobs N] [--results file]
+#
+#  Authors:
+#  ================================================
+#       Georgia S. Brennan      brennan@maths.ox.ac.uk
+#                   ----
+#       Travis B. Thompson      thompsont@maths.ox.ac.uk
+#                   ----
+#       Marie E. Rognes         meg@simula.no
+#                   ----
+#       Vegard Vinje            vegard@simula.no
+#                   ----
+#       Alain Goriely           goriely@maths.ox.ac.uk
+# ---------------------------------------------------------
+
+import os
+import csv
+import sys
+import time
+import argparse
+
+import numpy as np
+
+from bgsolver import solverBG
+import bgstudy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'clearance_extraction_pipeline'))
+import clearancefit
+import pipelinepool
+
+
+# ---------- Configuration ----------
+pipelinedirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'clearance_extraction_pipeline')
+connectome = os.path.join(pipelinedirectory, 'master-std33.graphml')
+culleddirectory = os.path.join(pipelinedirectory, 'reformatted-data', '3-culled-data')
+clearancedirectory = os.path.join(pipelinedirectory, 'reformatted-data', '4-clearance-initial', 'averaged', 'proximity-averaged')
+bandscsv = './bg-uncertainty-bands.csv'
+
+tstart = 0.0
+tend = 300.0
+dtout = 1.0
+tolerance = 1e-8
+
+ndraws = 200
+drawseed = 0
+minimumresiduals = 5
+maxredraws = 20
+batchsize = 100
+quantiles = [0.025, 0.25, 0.5, 0.75, 0.975]
+
+
+# Read a culled patient file (see 3-cull-data.py): the times
+# and {region: three values}
+def readCulledPatient(path):
+    with open(path) as incsv:
+        csv_reader = csv.reader(incsv, delimiter=',')
+        times = [float(t) for t in next(csv_reader)[1:]]
+        values = {row[0]: [float(v) for v in row[1:]] for row in csv_reader if len(row) == len(times) + 1}
+    return times, values
+
+
+# Read a clearance file (see 4b-average-computed-clearance.py):
+# {region: (clearance, model type)}
+def readClearance(path):
+    with open(path) as incsv:
+        csv_reader = csv.reader(incsv, delimiter=',')
+        next(csv_reader)
+        return {row[0]: (float(row[1]), row[2]) for row in csv_reader}
+
+
+# ---------------------------------------------------------
+# The cells of the cohort: every (patient, region) with three
+# culled values.  Returns the regions, the patient and region
+# index of every cell and the (cells x 3) times and values.
+# ---------------------------------------------------------
+def loadCells(patients):
+    regions = []
+    rindex = {}
+    cells = ([], [], [], [])
+
+    for p in range(len(patients)):
+        times, values = readCulledPatient(os.path.join(culleddirectory, patients[p] + '.csv'))
+        if len(times) != 3:
+            print(f"[WARNING] Patient {patients[p]} does not have three timepoints and is skipped")
+            continue
+
+        for region, yv in values.items():
+            if region not in rindex:
+                rindex[region] = len(regions)
+                regions.append(region)
+            for c, value in zip(cells, [p, rindex[region], times, yv]):
+                c.append(value)
+
+    patient, region, xcells, ycells = [np.asarray(c) for c in cells]
+    return regions, patient, region, xcells.astype(np.float64), ycells.astype(np.float64)
+
+
+# ---------------------------------------------------------
+# The pooled relative residuals of the linear fits of the
+# `linear' cells: a (residuals,) array, ordered by region,
+# and the start and number of the residuals of every region
+# (those of the cohort for a region with fewer than
+# `minimumresiduals').
+# ---------------------------------------------------------
+def residualPools(region, xcells, ycells, linear, nregions):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ynorm = ycells / ycells[:, 2:3]
+    slope, intercept, relmse = clearancefit.fitLinearBatch(xcells, ynorm)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        residuals = np.sqrt(3.0) * (ynorm - (slope[:, None] * xcells + intercept[:, None])) / ynorm
+
+    keep = linear & np.all(np.isfinite(residuals), axis=-1)
+    order = np.argsort(region[keep], kind='stable')
+    pool = residuals[keep][order].ravel()
+    counts = 3 * np.bincount(region[keep], minlength=nregions)
+
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    few = counts < minimumresiduals
+    starts[few] = 0
+    counts[few] = len(pool)
+
+    return pool, starts, counts
+
+
+# ---------------------------------------------------------
+# Draw `n' clearances of every cell of `drawn' in one pass.
+# The point fit of these cells is exponential, so the draws
+# are conditioned on an exponential fit: draws whose
+# perturbed values are degenerate (or have no finite fit)
+# are drawn again, at most `maxredraws' times, after which
+# they keep the point estimate.  Returns the (n x cells)
+# clearances and the mask of the draws that kept the point
+# estimate.
+#
+#   model: 'residual' or 'bootstrap'
+#   noise: uniform relative standard deviation of the
+#       residual model (Default: that of the pooled
+#       residuals of every region)
+# ---------------------------------------------------------
+def drawClearances(region, xcells, ycells, drawn, pools, n, model, noise=None, seed=0):
+    rng = np.random.default_rng(seed)
+    pool, starts, counts = pools
+
+    cells = np.nonzero(drawn)[0]
+    if noise is None:
+        cumsq = np.concatenate([[0.0], np.cumsum(pool * pool)])
+        sigma = np.sqrt((cumsq[starts + counts] - cumsq[starts]) / np.maximum(counts, 1))
+    else:
+        sigma = np.full(len(starts), float(noise))
+
+    # the (draws, 3) relative perturbations of the cells `c'
+    def perturbation(c):
+        r = region[c][:, None]
+        if model == 'bootstrap':
+            return pool[starts[r] + (rng.random((len(c), 3)) * counts[r]).astype(np.int64)]
+        return sigma[r] * rng.standard_normal((len(c), 3))
+
+    draws = np.tile(cells, n)
+    clearance = np.full(len(draws), np.nan)
+    pending = np.arange(len(draws))
+
+    for attempt in range(maxredraws + 1):
+        c = draws[pending]
+        k, modeltype, relmse, degenerate, unresolved = \
+            clearancefit.fitClearanceBatch(xcells[c], ycells[c] * (1.0 + perturbation(c)))
+
+        ok = (degenerate == clearancefit.DEGENERATE_NONE) & ~unresolved
+        clearance[pending[ok]] = k[ok]
+        pending = pending[~ok]
+        if len(pending) == 0:
+            break
+
+    return clearance.reshape(n, len(cells)), np.isnan(clearance).reshape(n, len(cells))
+
+
+# ---------------------------------------------------------
+# Worker processes: every process builds one solver, with
+# the set-up of bgstudy.py and the staging results, when it
+# starts.  `regional' is the (regions, coefficients) of the
+# regional diffusion (None for a uniform diffusion).
+# ---------------------------------------------------------
+workerSolver = None
+
+
+def initWorker(graphml, diffusion, regional):
+    global workerSolver
+
+    workerSolver = solverBG(graphml)
+    workerSolver.setup(tstart, tend, dtout, tolerance)
+
+    bgstudy.setStudyParameters(workerSolver, diffusion, regional)
+    bgstudy.setStudyInitialValues(workerSolver)
+
+    for tag, labels in bgstudy.stagingregions.items():
+        workerSolver.addRegionalResult(labels, 'Misfolded-Protein-Concentration', optionalIdTag=tag)
+
+
+# ---------------------------------------------------------
+# One patient: `task' is (patient id, region labels, point
+# clearances, (draws x regions) drawn clearances).  The point
+# estimate and the draws are integrated as ensembles of at
+# most `batchsize' systems.  Returns the patient id, the
+# output times, the (results x times) mean concentration of
+# the point estimate and its (quantiles x results x times)
+# quantiles over the draws (None and the error message if
+# the solve fails).
+# ---------------------------------------------------------
+def runUncertaintyTask(task):
+    pid, labels, point, draws = task
+    bg = workerSolver
+
+    try:
+        clearance = bg.regionalArray(labels, np.vstack([point, draws]))
+
+        means = []
+        for batch in range(0, len(clearance), batchsize):
+            times, results = bg.solveEnsemble(clearance[batch:batch + batchsize], reduce=True)
+            means.append(results[:, 0])
+        means = np.concatenate(means, axis=1)
+
+        return pid, times, means[:, 0], np.quantile(means[:, 1:], quantiles, axis=1), ''
+    except Exception as err:
+        return pid, None, None, None, f"{type(err).__name__}: {err}"
+
+
+def bandsHeader():
+    return ['Patient', 'Result', 'Time', 'Point'] + [f'Quantile-{q}' for q in quantiles]
+
+
+# Execution starts here
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Propagate the uncertainty of the clearance fits into the BG model")
+    parser.add_argument('--model', choices=['residual', 'bootstrap'], default='residual',
+                        help='Gaussian residual noise (default) or bootstrap of the residuals')
+    parser.add_argument('--draws', type=int, default=ndraws,
+                        help=f'number of clearance maps drawn per patient (default: {ndraws})')
+    parser.add_argument('--diffusion', choices=bgstudy.diffusionchoices, default=bgstudy.diffusion,
+                        help=f'diffusion coefficient of the model (see bgstudy.py; default: {bgstudy.diffusion})')
+    parser.add_argument('--noise', type=float, default=None,
+                        help='uniform relative noise of the residual model (default: estimated per region)')
+    parser.add_argument('--seed', type=int, default=drawseed,
+                        help=f'seed of the draws (default: {drawseed})')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of worker processes (default: 1)')
+    parser.add_argument('--results', default=bandscsv,
+                        help=f'quantile bands table (default: {bandscsv})')
+    args = parser.parse_args()
+
+    if args.jobs < 1 or args.draws < 1:
+        parser.error("--jobs and --draws must be at least 1")
+    if args.noise is not None and args.model != 'residual':
+        parser.error("--noise applies to the residual model only")
+
+    for directory in [culleddirectory, clearancedirectory]:
+        if not os.path.exists(directory):
+            print(f"The directory {directory} does not exist (run the clearance pipeline first)")
+            sys.exit()
+
+    regional = None
+    if args.diffusion == 'regional':
+        try:
+            regional = bgstudy.regionalDiffusion()
+        except FileNotFoundError as err:
+            print(f"[ERROR] {err}; use --diffusion uniform for a uniform coefficient")
+            sys.exit()
+
+    patients = sorted(flnm[:-4] for flnm in os.listdir(clearancedirectory)
+                      if flnm.endswith('.csv') and os.path.exists(os.path.join(culleddirectory, flnm)))
+    points = [readClearance(os.path.join(clearancedirectory, pid + '.csv')) for pid in patients]
+
+    regions, patient, region, xcells, ycells = loadCells(patients)
+    clearance, modeltype, relmse, degenerate, unresolved = clearancefit.fitClearanceBatch(xcells, ycells)
+    linear = modeltype == clearancefit.MODEL_LINEAR
+
+    pools = residualPools(region, xcells, ycells, linear, len(regions))
+    if len(pools[0]) == 0 and args.noise is None:
+        print("[ERROR] The cohort has no linear fits from which to estimate the noise; use --noise")
+        sys.exit()
+
+    # the cells fitted with an exponential in the clearance files
+    exponential = np.array([points[patient[c]].get(regions[region[c]], (0.0, ''))[1] == 'Exponential'
+                            for c in range(len(region))], dtype=bool)
+    drawn = exponential & ~linear & ~unresolved
+
+    start = time.time()
+    drawclearance, kept = drawClearances(region, xcells, ycells, drawn, pools, args.draws, args.model,
+                                         noise=args.noise, seed=args.seed)
+    print(f"{args.draws} draws of {np.sum(drawn)} cells of {len(patients)} patients fitted in {time.time() - start:.2f} s; "
+          f"{100.0 * kept.mean():.2f}% of the draws keep the point estimate")
+
+    tasks = []
+    cellpatient = patient[drawn]
+    cellregion = region[drawn]
+    for p in range(len(patients)):
+        labels = list(points[p].keys())
+        point = np.array([points[p][label][0] for label in labels])
+
+        draws = np.tile(point, (args.draws, 1))
+        mine = np.nonzero(cellpatient == p)[0]
+        column = np.array([labels.index(regions[r]) for r in cellregion[mine]], dtype=np.int64)
+        draws[:, column] = np.where(kept[:, mine], point[column], drawclearance[:, mine])
+
+        tasks.append((patients[p], labels, point, draws))
+
+    nfailed = 0
+    with open(args.results, mode='w', newline='') as outcsv:
+        csv_writer = csv.writer(outcsv)
+        csv_writer.writerow(bandsHeader())
+
+        for i, (pid, times, point, bands, message) in pipelinepool.streamPatients(runUncertaintyTask, tasks, jobs=args.jobs,
+                                                                                 initializer=initWorker, initargs=(connectome, args.diffusion, regional)):
+            if times is None:
+                nfailed += 1
+                print(f"[WARNING] Patient {pid} failed: {message}")
+                continue
+
+            for r, tag in enumerate(bgstudy.stagingregions):
+                for k in range(len(times)):
+                    csv_writer.writerow([pid, tag, times[k], point[r, k]] + list(bands[:, r, k]))
+            outcsv.flush()
+            print(f"Patient {pid}: {args.draws} draws done")
+
+    print(f"{len(patients) - nfailed} patients completed, {nfailed} failed; quantile bands written to {args.results}")
@@ -0,0 +1,272 @@
+# --------------------------------------------------------
+#
+#  ***Oxford Mathematical Brain Modeling Group***
+#
+#   Columnar result store for the Brennan-Goriely (BG) model
+#   solver.
+#
+#   Instead of one results file per solve (or one .stat file
+#   per result), a run or an ensemble of runs writes the full
+#   nodal solution into a single memory-mappable store.  A
+#   store is a directory (by convention named <name>.store/)
+#   containing
+#
+#     values.npy    float64 (runs x times x fields x nodes)
+#     times.npy     float64 (times,) output times
+#     written.npy   int64 (runs,) number of output times
+#                   written for every run
+#     runs.txt      one run ID per line
+#     fields.txt    one solution field per line
+#     labels.txt    the region label of every node
+#     groups.json   the results of the solver: {name: {'field':
+#                   field, 'nodes': node indices}}
+#     meta.json     the solver name
+#
+#   The store is allocated for all output times when it is
+#   created and filled one output time at a time during the
+#   integration (values not yet written are NaN), so a solve
+#   can be read while it runs and a killed solve keeps what it
+#   has written.  Reads are memory-mapped slices: a region, a
+#   field or a range of times is read without loading the
+#   rest of the store.
+#
+#   Results are exported to the CSV layouts used today:
+#   exportResultsCSV writes the results file of a solve
+#   (Time, <result>:Mean, <result>:Min, <result>:Max, ...) and
+#   exportRegionTable the regions x timepoints table of
+#   scripts/uni_output.csv (StructName, ID, 1, 2, ...).
+#
+#   Usage (CSV export):
+#       python3 resultstore.py <store directory> <results csv> [run]
+#
+#  Authors:
+#  ================================================
+#       Georgia S. Brennan      brennan@maths.ox.ac.uk
+#                   ----
+#       Travis B. Thompson      thompsont@maths.ox.ac.uk
+#                   ----
+#       Marie E. Rognes         meg@simula.no
+#                   ----
+#       Vegard Vinje            vegard@simula.no
+#                   ----
+#       Alain Goriely           goriely@maths.ox.ac.uk
+# ---------------------------------------------------------
+
+import os
+import csv
+import sys
+import json
+import shutil
+
+import numpy as np
+
+
+# the right hemisphere cortical regions of scripts/uni_output.csv,
+# in the order of the rows of that table (the node order of the
+# plotting scripts)
+uniregions = ['lateralorbitofrontal', 'parsorbitalis', 'frontalpole', 'medialorbitofrontal', 'parstriangularis',
+              'parsopercularis', 'rostralmiddlefrontal', 'superiorfrontal', 'caudalmiddlefrontal', 'precentral',
+              'paracentral', 'rostralanteriorcingulate', 'caudalanteriorcingulate', 'posteriorcingulate',
+              'isthmuscingulate', 'postcentral', 'supramarginal', 'superiorparietal', 'inferiorparietal', 'precuneus',
+              'cuneus', 'pericalcarine', 'lateraloccipital', 'lingual', 'fusiform', 'parahippocampal', 'entorhinal',
+              'temporalpole', 'inferiortemporal', 'middletemporal', 'bankssts', 'superiortemporal',
+              'transversetemporal', 'insula']
+
+
+def readLines(path):
+    with open(path) as f:
+        return [l.rstrip('\n') for l in f]
+
+
+def writeLines(path, lines):
+    with open(path, mode='w') as f:
+        for l in lines:
+            f.write(str(l) + '\n')
+
+
+class resultstore:
+
+    # open the store in the directory `path'.  With `mode' 'r'
+    # (Default) the arrays are memory-mapped read-only, with
+    # 'r+' the store can be appended to.
+    def __init__(self, path, mode='r'):
+        self.path = path
+
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(path, 'groups.json')) as f:
+            self.groups = {name: (g['field'], np.asarray(g['nodes'], dtype=np.int64)) for name, g in json.load(f).items()}
+
+        self.runs = readLines(os.path.join(path, 'runs.txt'))
+        self.fields = readLines(os.path.join(path, 'fields.txt'))
+        self.labels = readLines(os.path.join(path, 'labels.txt'))
+
+        self.data = np.load(os.path.join(path, 'values.npy'), mmap_mode=mode)
+        self.times = np.load(os.path.join(path, 'times.npy'))
+        self.written = np.load(os.path.join(path, 'written.npy'), mmap_mode=mode)
+
+        self.__runndx = {self.runs[i]: i for i in range(len(self.runs))}
+        self.__regionnodes = {}
+        for i in range(len(self.labels)):
+            self.__regionnodes.setdefault(self.labels[i], []).append(i)
+
+    # the (runs x fields x nodes x times) values, a view of the
+    # memory-mapped store
+    @property
+    def values(self):
+        return self.data.transpose(0, 2, 3, 1)
+
+    def getRunIndex(self, run):
+        return self.__runndx[str(run)]
+
+    def getRegionNodes(self, label):
+        if label not in self.__regionnodes:
+            raise KeyError(f"Unknown region label {label}")
+        return np.asarray(self.__regionnodes[label], dtype=np.int64)
+
+    def discoverResults(self):
+        return list(self.groups.keys())
+
+    # ---------------------------------------------------------
+    # Write the (fields x nodes) solution of the run at index
+    # `run' (or the (runs x fields x nodes) solutions of the
+    # runs `run', an index array or slice) at the output time
+    # times[k]
+    # ---------------------------------------------------------
+    def append(self, run, k, states):
+        self.data[run, k] = states
+        self.written[run] = k + 1
+
+    def flush(self):
+        self.data.flush()
+        self.written.flush()
+
+    # ---------------------------------------------------------
+    # The (runs x times x nodes) values of `field', optionally
+    # restricted to the nodes of the regions `labels', the
+    # output times in [tmin, tmax] and the runs `runs' (IDs).
+    # Returns the times and the values.
+    # ---------------------------------------------------------
+    def read(self, field, labels=None, tmin=None, tmax=None, runs=None):
+        k0 = 0 if tmin is None else int(np.searchsorted(self.times, tmin, side='left'))
+        k1 = len(self.times) if tmax is None else int(np.searchsorted(self.times, tmax, side='right'))
+
+        rows = slice(None) if runs is None else [self.getRunIndex(r) for r in runs]
+        values = self.data[rows, k0:k1, self.fields.index(field)]
+
+        if labels is not None:
+            values = values[:, :, np.concatenate([self.getRegionNodes(l) for l in labels])]
+
+        return self.times[k0:k1], values
+
+    # the (runs x 3 x times) mean, minimum and maximum of the
+    # result `name' (see discoverResults)
+    def readResult(self, name, runs=None):
+        if name not in self.groups:
+            raise KeyError(f"No result {name} in {self.path}")
+
+        field, nodes = self.groups[name]
+        rows = slice(None) if runs is None else [self.getRunIndex(r) for r in runs]
+        values = self.data[rows, :, self.fields.index(field)][:, :, nodes]
+
+        return np.stack([values.mean(axis=2), values.min(axis=2), values.max(axis=2)], axis=1)
+
+
+# ---------------------------------------------------------
+# Create a store in the directory `path' (any existing store
+# at this path is replaced) and open it for appending.
+#
+#   runs:   list of run IDs
+#   times:  the output times
+#   fields: the solution fields
+#   labels: the region label of every node
+#   groups: {result name: (field, node indices)}
+#   [optional] meta: dictionary stored in meta.json
+# ---------------------------------------------------------
+def createStore(path, runs, times, fields, labels, groups, meta=None):
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    times = np.asarray(times, dtype=np.float64)
+    values = np.lib.format.open_memmap(os.path.join(path, 'values.npy'), mode='w+', dtype=np.float64,
+                                       shape=(len(runs), len(times), len(fields), len(labels)))
+    values[:] = np.nan
+    values.flush()
+    del values
+
+    np.save(os.path.join(path, 'times.npy'), times)
+    np.save(os.path.join(path, 'written.npy'), np.zeros(len(runs), dtype=np.int64))
+
+    writeLines(os.path.join(path, 'runs.txt'), runs)
+    writeLines(os.path.join(path, 'fields.txt'), fields)
+    writeLines(os.path.join(path, 'labels.txt'), labels)
+
+    with open(os.path.join(path, 'groups.json'), mode='w') as f:
+        json.dump({name: {'field': field, 'nodes': [int(n) for n in nodes]} for name, (field, nodes) in groups.items()}, f)
+
+    with open(os.path.join(path, 'meta.json'), mode='w') as f:
+        json.dump({} if meta is None else meta, f, indent=1)
+
+    return resultstore(path, mode='r+')
+
+
+# ---------------------------------------------------------
+# Write the results of the run `run' (ID) of a store to the
+# CSV file `csvout' in the layout of the solver results file:
+# Time, <result>:Mean, <result>:Min, <result>:Max, ...
+# ---------------------------------------------------------
+def exportResultsCSV(store, csvout, run):
+    i = store.getRunIndex(run)
+    ntimes = int(store.written[i])
+
+    names = store.discoverResults()
+    header = ['Time']
+    columns = [store.times[:ntimes]]
+    for name in names:
+        header += [name + ':Mean', name + ':Min', name + ':Max']
+        columns += list(store.readResult(name, runs=[run])[0, :, :ntimes])
+
+    with open(csvout, mode='w') as outcsv:
+        csv_writer = csv.writer(outcsv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        csv_writer.writerow(header)
+        csv_writer.writerows(np.column_stack(columns).tolist())
+
+
+# ---------------------------------------------------------
+# Write the regions x timepoints table of scripts/uni_output.csv
+# for the run `run' (ID): StructName, ID, 1, 2, ... with the
+# mean of `field' over the nodes of every region at the
+# output times closest to `timepoints'.
+#
+# [optional] regions: the StructNames (Default: uniregions)
+# [optional] labelformat: the region label of a StructName
+#   (Default: right hemisphere cortical labels)
+# ---------------------------------------------------------
+def exportRegionTable(store, csvout, run, field, timepoints, regions=None, labelformat='cortical.{}.right'):
+    if regions is None:
+        regions = uniregions
+
+    i = store.getRunIndex(run)
+    f = store.fields.index(field)
+    ks = [int(np.argmin(np.abs(store.times - t))) for t in timepoints]
+
+    with open(csvout, mode='w') as outcsv:
+        csv_writer = csv.writer(outcsv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        csv_writer.writerow(['StructName', 'ID'] + [str(j + 1) for j in range(len(ks))])
+
+        for r in range(len(regions)):
+            nodes = store.getRegionNodes(labelformat.format(regions[r]))
+            values = store.data[i, ks, f][:, nodes].mean(axis=1)
+            csv_writer.writerow([regions[r], r + 1] + values.tolist())
+
+
+# Execution starts here
+if __name__ == "__main__":
+
+    if len(sys.argv) not in [3, 4]:
+        print("usage: python3 resultstore.py <store directory> <results csv> [run]")
+        sys.exit()
+
+    store = resultstore(sys.argv[1])
+    exportResultsCSV(store, sys.argv[2], sys.argv[3] if len(sys.argv) == 4 else store.runs[0])